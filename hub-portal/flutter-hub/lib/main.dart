@@ -67,19 +67,30 @@ class MicroService {
 class ServiceDiscovery {
   static const String registryUrl = 'http://127.0.0.1:5000';
 
+  // ETag последнего списка: если он не изменился, Registry отвечает 304
+  String? _etag;
+  List<MicroService> _services = [];
+
   Future<List<MicroService>> discoverServices() async {
     try {
       final response = await http.get(
         Uri.parse('$registryUrl/api/services'),
+        headers: _etag != null ? {'If-None-Match': _etag!} : null,
       ).timeout(Duration(seconds: 5));
 
+      if (response.statusCode == 304) {
+        return _services;
+      }
+
       if (response.statusCode == 200) {
         final data = json.decode(response.body);
 
         if (data['success'] == true && data['services'] != null) {
-          return (data['services'] as List)
+          _services = (data['services'] as List)
               .map((s) => MicroService.fromJson(s))
               .toList();
+          _etag = response.headers['etag'];
+          return _services;
         }
       }
 
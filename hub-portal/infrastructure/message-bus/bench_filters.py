@@ -0,0 +1,73 @@
+"""
+Бенчмарк фильтров подписок Message Bus
+
+Измеряет, сколько стоит проверка фильтра подписки на одном событии
+(нс/событие) для типичных выражений, и разовую стоимость компиляции
+при подписке. Для сравнения приводится json.dumps payload - работа,
+которую шина всё равно делает при записи каждого события.
+
+Запуск:
+    python bench_filters.py --events 200000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import message_bus as bus
+
+FILTERS = [
+    "payload.category == 'Телефоны'",
+    'total > 100000',
+    "category in ['Телефоны', 'Ноутбуки'] and 50000 <= total < 200000",
+    'customer.address.city == "Москва" or not paid',
+    'missing.field > 5'
+]
+
+PAYLOADS = [
+    {'order_id': i, 'category': category, 'total': total, 'paid': i % 3 == 0,
+     'customer': {'id': i, 'address': {'city': city}},
+     'items': [{'product_id': i, 'quantity': 2}]}
+    for i, (category, total, city) in enumerate([
+        ('Телефоны', 119990, 'Москва'),
+        ('Ноутбуки', 45990, 'Казань'),
+        ('Аксессуары', 1990, 'Москва'),
+        ('Телефоны', 89990, 'Самара')
+    ])
+]
+
+def per_event_ns(events, evaluate):
+    """Среднее время одного вызова evaluate(payload) в наносекундах"""
+    payloads = (PAYLOADS * (events // len(PAYLOADS) + 1))[:events]
+    started = time.perf_counter_ns()
+    for payload in payloads:
+        evaluate(payload)
+    return (time.perf_counter_ns() - started) / events
+
+def main():
+    parser = argparse.ArgumentParser(description='Message Bus subscription filter benchmark')
+    parser.add_argument('--events', type=int, default=200000)
+    args = parser.parse_args()
+
+    print("=" * 50)
+    print(f"📊 {args.events} events per filter, ns/event")
+    print("=" * 50)
+
+    baseline = per_event_ns(args.events, json.dumps)
+    print(f"json.dumps(payload) for comparison: {baseline:8.0f}")
+
+    print(f"{'compile':>9} {'filter':>8} {'pass':>6}   expression")
+    for source in FILTERS:
+        started = time.perf_counter_ns()
+        event_filter = bus.EventFilter(source)
+        compile_ns = time.perf_counter_ns() - started
+
+        filter_ns = per_event_ns(args.events, event_filter.match)
+        passed = event_filter.matched / event_filter.evaluated
+        print(f"{compile_ns / 1000:7.0f}us {filter_ns:8.0f} {passed:6.0%}   {source}")
+
+if __name__ == '__main__':
+    main()
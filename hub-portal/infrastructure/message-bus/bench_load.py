@@ -0,0 +1,449 @@
+"""
+Нагрузочный бенчмарк Message Bus
+
+Поднимает шину отдельным процессом (временный HOME, свободный порт)
+и N локальных подписчиков-заглушек с заданной задержкой ответа и
+долей отказов, затем публикует события с целевой частотой (открытый
+цикл: отправка по расписанию, а не по готовности ответа) и измеряет:
+- publish:  достигнутая пропускная способность, задержка ответа
+  /api/publish (p50/p95/p99), отказы 429 и ошибки
+- delivery: задержка от публикации до получения подписчиком
+  (p50/p95/p99/max), недоставленные события и дубликаты
+- process:  потоки и RSS процесса шины (пик и в конце), байты записи
+- sqlite:   коммиты и операции писателя в секунду (/api/stats)
+
+Результаты сохраняются в JSON; --compare печатает разницу с
+предыдущим прогоном.
+
+Запуск:
+    python bench_load.py --rate 500 --duration 30 --subscribers 4 \\
+        --latency-ms 20 --jitter-ms 10 --fail-rate 0.01
+    python bench_load.py --rate 500 --bus-env BUS_DELIVERY_WORKERS=32 \\
+        --compare bench-load-20260101-120000.json
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Empty
+from threading import Thread, Lock, Event
+
+import requests
+
+EVENT_TYPE = 'bench.load'
+BUS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'message_bus.py')
+
+def percentiles(values):
+    """p50/p95/p99/max в миллисекундах (values - секунды)"""
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    ordered = sorted(values)
+    def at(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+    return {'p50': at(0.50), 'p95': at(0.95), 'p99': at(0.99), 'max': round(ordered[-1] * 1000, 2)}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# ============= ПОДПИСЧИКИ-ЗАГЛУШКИ =============
+
+class StubSubscriber:
+    """
+    HTTP-подписчик с искусственной задержкой и отказами
+
+    Задержка доставки считается по полю sent_at в payload; повторные
+    доставки одного seq (после отказа или таймаута) учитываются как
+    дубликаты, а не как новые события.
+    """
+
+    def __init__(self, index, latency_ms, jitter_ms, fail_rate):
+        self.index = index
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.fail_rate = fail_rate
+        self.lock = Lock()
+        self.latencies = []
+        self.seen = set()
+        self.duplicates = 0
+        self.failed = 0
+        self.requests = 0
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status = stub.handle(json.loads(body))
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/events'
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, message):
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        with self.lock:
+            self.requests += 1
+            if random.random() < self.fail_rate:
+                self.failed += 1
+                return 500
+
+            # Пачка - массив {"id", "event", "payload"}, одиночное событие - сам payload
+            payloads = [item['payload'] for item in message] if isinstance(message, list) else [message]
+            received = time.time()
+            for payload in payloads:
+                if payload['seq'] in self.seen:
+                    self.duplicates += 1
+                    continue
+                self.seen.add(payload['seq'])
+                self.latencies.append(received - payload['sent_at'])
+        return 200
+
+    def received(self):
+        with self.lock:
+            return len(self.seen)
+
+# ============= ШИНА =============
+
+class BusProcess:
+    """Message Bus в дочернем процессе с отдельным HOME"""
+
+    def __init__(self, bus_env):
+        self.home = tempfile.mkdtemp(prefix='bus-bench-load-')
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.log_path = os.path.join(self.home, 'message_bus.log')
+        self.env = dict(os.environ, HOME=self.home, BUS_PORT=str(self.port), **bus_env)
+        self.process = None
+
+    def start(self, timeout=30):
+        self.log = open(self.log_path, 'w')
+        self.process = subprocess.Popen(
+            [sys.executable, BUS_SCRIPT],
+            env=self.env, stdout=self.log, stderr=subprocess.STDOUT
+        )
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'message bus exited, see {self.log_path}')
+            try:
+                if requests.get(f'{self.url}/health', timeout=1).status_code == 200:
+                    return
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f'message bus did not start in {timeout}s, see {self.log_path}')
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log.close()
+
+    def stats(self):
+        return requests.get(f'{self.url}/api/stats', timeout=10).json()['stats']
+
+    def proc_sample(self):
+        """Потоки, RSS (КБ) и байты записи процесса из /proc"""
+        sample = {}
+        try:
+            with open(f'/proc/{self.process.pid}/status') as f:
+                for line in f:
+                    if line.startswith('Threads:'):
+                        sample['threads'] = int(line.split()[1])
+                    elif line.startswith('VmRSS:'):
+                        sample['rss_kb'] = int(line.split()[1])
+        except OSError:
+            pass
+        try:
+            with open(f'/proc/{self.process.pid}/io') as f:
+                for line in f:
+                    if line.startswith('write_bytes:'):
+                        sample['write_bytes'] = int(line.split()[1])
+        except OSError:
+            pass
+        return sample
+
+class ProcessSampler:
+    """Периодический опрос /proc процесса шины"""
+
+    def __init__(self, bus, interval):
+        self.bus = bus
+        self.interval = interval
+        self.samples = []
+        self.stopped = Event()
+
+    def start(self):
+        Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        self.samples.append(self.bus.proc_sample())
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.samples.append(self.bus.proc_sample())
+
+    def summary(self):
+        def series(key):
+            return [sample[key] for sample in self.samples if key in sample]
+        threads, rss = series('threads'), series('rss_kb')
+        return {
+            'threads_peak': max(threads, default=None),
+            'threads_end': threads[-1] if threads else None,
+            'rss_mb_peak': round(max(rss) / 1024, 1) if rss else None,
+            'rss_mb_end': round(rss[-1] / 1024, 1) if rss else None
+        }
+
+# ============= НАГРУЗКА =============
+
+def publish_load(bus_url, rate, duration, publishers):
+    """
+    Публиковать события rate/сек в течение duration секунд
+
+    Каждый из publishers потоков шлёт события по своему расписанию
+    (i-е событие - в start + i / rate); отставшие события отправляются
+    сразу, отставание от расписания попадает в отчёт.
+    """
+    results = Queue()
+    started = time.time() + 0.1
+    total = int(rate * duration)
+
+    def worker(index):
+        session = requests.Session()
+        service_id = f'bench-load-{index}'
+        for seq in range(index, total, publishers):
+            scheduled = started + seq / rate
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            sent_at = time.time()
+            try:
+                response = session.post(f'{bus_url}/api/publish', json={
+                    'event': EVENT_TYPE,
+                    'service_id': service_id,
+                    'payload': {'seq': seq, 'sent_at': sent_at}
+                }, timeout=30)
+                status = response.status_code
+            except requests.exceptions.RequestException:
+                status = None
+            results.put((seq, status, time.time() - sent_at, sent_at - scheduled))
+        session.close()
+
+    pool = [Thread(target=worker, args=(index,)) for index in range(publishers)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.time() - started
+
+    outcomes = []
+    while True:
+        try:
+            outcomes.append(results.get_nowait())
+        except Empty:
+            break
+    return outcomes, elapsed
+
+def wait_delivered(stubs, expected, timeout):
+    """Ждать, пока каждый подписчик получит expected событий; вернуть время ожидания"""
+    started = time.time()
+    while time.time() - started < timeout:
+        if all(stub.received() >= expected for stub in stubs):
+            break
+        time.sleep(0.2)
+    return time.time() - started
+
+def run(args):
+    bus_env = dict(item.split('=', 1) for item in args.bus_env)
+    bus = BusProcess(bus_env)
+    stubs = [StubSubscriber(index, args.latency_ms, args.jitter_ms, args.fail_rate)
+             for index in range(args.subscribers)]
+
+    print(f"📁 Bus home: {bus.home}")
+    bus.start()
+    for stub in stubs:
+        stub.start()
+        subscription = {'event': EVENT_TYPE, 'callback_url': stub.url,
+                        'service_id': f'bench-stub-{stub.index}'}
+        if args.batch:
+            subscription['batch'] = {'max_events': args.batch, 'max_wait_ms': args.batch_wait_ms}
+        requests.post(f'{bus.url}/api/subscribe', json=subscription, timeout=10).raise_for_status()
+    print(f"✅ Bus on {bus.url}, {len(stubs)} subscribers")
+
+    sampler = ProcessSampler(bus, args.sample_interval)
+    try:
+        before, io_before = bus.stats(), bus.proc_sample()
+        sampler.start()
+
+        print(f"📤 Publishing {args.rate}/s for {args.duration}s from {args.publishers} threads")
+        outcomes, elapsed = publish_load(bus.url, args.rate, args.duration, args.publishers)
+        after, io_after = bus.stats(), bus.proc_sample()
+
+        accepted = [outcome for outcome in outcomes if outcome[1] == 200]
+        print(f"⏳ Waiting for deliveries of {len(accepted)} events (up to {args.drain_timeout}s)")
+        drain = wait_delivered(stubs, len(accepted), args.drain_timeout)
+        sampler.stop()
+        final = bus.stats()
+    finally:
+        for stub in stubs:
+            stub.stop()
+        bus.stop()
+
+    latencies = [latency for stub in stubs for latency in stub.latencies]
+    writer_before, writer_after = before['writer'], after['writer']
+    write_bytes = (io_after.get('write_bytes', 0) - io_before.get('write_bytes', 0)
+                   if 'write_bytes' in io_before else None)
+
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'config': {
+            'rate': args.rate,
+            'duration': args.duration,
+            'publishers': args.publishers,
+            'subscribers': args.subscribers,
+            'latency_ms': args.latency_ms,
+            'jitter_ms': args.jitter_ms,
+            'fail_rate': args.fail_rate,
+            'batch': args.batch,
+            'bus_env': bus_env
+        },
+        'publish': {
+            'attempted': len(outcomes),
+            'accepted': len(accepted),
+            'rejected_429': sum(1 for outcome in outcomes if outcome[1] == 429),
+            'errors': sum(1 for outcome in outcomes if outcome[1] not in (200, 429)),
+            'throughput': round(len(accepted) / elapsed, 1),
+            'latency_ms': percentiles([outcome[2] for outcome in accepted]),
+            'schedule_lag_ms': percentiles([max(0, outcome[3]) for outcome in outcomes])
+        },
+        'delivery': {
+            'expected': len(accepted) * len(stubs),
+            'delivered': len(latencies),
+            'lost': len(accepted) * len(stubs) - len(latencies),
+            'duplicates': sum(stub.duplicates for stub in stubs),
+            'stub_failures': sum(stub.failed for stub in stubs),
+            'latency_ms': percentiles(latencies),
+            'drain_seconds': round(drain, 2)
+        },
+        'process': sampler.summary(),
+        'sqlite': {
+            'commits_per_sec': round((writer_after['commits'] - writer_before['commits']) / elapsed, 1),
+            'operations_per_sec': round((writer_after['operations'] - writer_before['operations']) / elapsed, 1),
+            'avg_group_size': writer_after['avg_group_size'],
+            'write_mb_per_sec': round(write_bytes / elapsed / 1024 / 1024, 2) if write_bytes is not None else None,
+            'writer_failed': final['writer']['failed']
+        }
+    }
+
+# ============= ОТЧЁТ =============
+
+METRICS = [
+    ('publish', 'throughput', 'publish events/sec'),
+    ('publish', 'latency_ms.p50', 'publish p50 ms'),
+    ('publish', 'latency_ms.p99', 'publish p99 ms'),
+    ('publish', 'rejected_429', 'publish 429'),
+    ('publish', 'errors', 'publish errors'),
+    ('publish', 'schedule_lag_ms.p99', 'schedule lag p99 ms'),
+    ('delivery', 'latency_ms.p50', 'delivery p50 ms'),
+    ('delivery', 'latency_ms.p95', 'delivery p95 ms'),
+    ('delivery', 'latency_ms.p99', 'delivery p99 ms'),
+    ('delivery', 'latency_ms.max', 'delivery max ms'),
+    ('delivery', 'lost', 'delivery lost'),
+    ('delivery', 'duplicates', 'delivery duplicates'),
+    ('process', 'threads_peak', 'threads peak'),
+    ('process', 'rss_mb_peak', 'RSS peak MB'),
+    ('sqlite', 'commits_per_sec', 'sqlite commits/sec'),
+    ('sqlite', 'operations_per_sec', 'sqlite ops/sec'),
+    ('sqlite', 'write_mb_per_sec', 'disk write MB/sec')
+]
+
+def metric(results, section, path):
+    value = results.get(section, {})
+    for key in path.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+def report(results, previous=None):
+    print("=" * 50)
+    header = f"{'':22} {'this run':>12}"
+    if previous:
+        header += f" {'previous':>12} {'change':>8}"
+    print(header)
+    for section, path, title in METRICS:
+        value = metric(results, section, path)
+        line = f"{title:22} {'-' if value is None else value:>12}"
+        if previous:
+            old = metric(previous, section, path)
+            change = f"{(value - old) / old:+.0%}" if value is not None and old else ''
+            line += f" {'-' if old is None else old:>12} {change:>8}"
+        print(line)
+    print("=" * 50)
+
+def main():
+    parser = argparse.ArgumentParser(description='Message Bus load benchmark')
+    parser.add_argument('--rate', type=float, default=200, help='публикаций в секунду')
+    parser.add_argument('--duration', type=float, default=20, help='секунд нагрузки')
+    parser.add_argument('--publishers', type=int, default=16, help='потоков публикации')
+    parser.add_argument('--subscribers', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=10, help='задержка ответа подписчика')
+    parser.add_argument('--jitter-ms', type=float, default=5)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='доля ответов 500')
+    parser.add_argument('--batch', type=int, default=0, help='batch.max_events подписок (0 - без пачек)')
+    parser.add_argument('--batch-wait-ms', type=float, default=50)
+    parser.add_argument('--drain-timeout', type=float, default=120)
+    parser.add_argument('--sample-interval', type=float, default=0.5)
+    parser.add_argument('--bus-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='настройка шины для прогона, например BUS_DELIVERY_WORKERS=32')
+    parser.add_argument('--output', help='файл результатов (по умолчанию bench-load-<время>.json)')
+    parser.add_argument('--compare', help='JSON предыдущего прогона для сравнения')
+    args = parser.parse_args()
+
+    print("=" * 50)
+    print("📊 Message Bus load benchmark")
+    print("=" * 50)
+
+    results = run(args)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    report(results, previous)
+
+    output = args.output or f"bench-load-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"💾 Results saved to {output}")
+
+if __name__ == '__main__':
+    main()
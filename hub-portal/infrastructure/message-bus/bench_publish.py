@@ -0,0 +1,109 @@
+"""
+Бенчмарк записи событий Message Bus
+
+Сравнивает пропускную способность (events/sec) двух путей записи:
+- before: каждый publish открывает своё соединение, делает INSERT и COMMIT
+  (как было до единственного писателя, журнал rollback)
+- after:  publish ставит вставку в очередь EventLogWriter, который
+  фиксирует операции группами в режиме WAL
+
+Запуск:
+    python bench_publish.py --events 5000 --threads 16
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import message_bus as bus
+
+PAYLOAD = {'order_id': 1, 'items': [{'product_id': 1, 'quantity': 2}], 'total': 119990}
+
+def run_threads(threads, events, publish_one):
+    """Опубликовать events событий из threads потоков, вернуть (events/sec, ошибки)"""
+    per_thread = events // threads
+    errors = []
+
+    def worker():
+        for _ in range(per_thread):
+            try:
+                publish_one()
+            except Exception as e:
+                errors.append(e)
+
+    pool = [Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return per_thread * threads / elapsed, len(errors)
+
+def bench_before(db_path, events, threads):
+    """Соединение и коммит на каждое событие"""
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_type TEXT NOT NULL,
+            payload TEXT,
+            published_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            notified_count INTEGER DEFAULT 0
+        )
+    ''')
+    conn.close()
+
+    def publish_one():
+        conn = sqlite3.connect(db_path)
+        conn.execute(
+            'INSERT INTO events (event_type, payload) VALUES (?, ?)',
+            ('bench.event', json.dumps(PAYLOAD))
+        )
+        conn.commit()
+        conn.close()
+
+    return run_threads(threads, events, publish_one)
+
+def bench_after(db_path, events, threads):
+    """Единственный писатель с групповым коммитом (WAL)"""
+    bus.DB_PATH = db_path
+    bus.init_db()
+    bus.writer.start()
+
+    def publish_one():
+        bus.store_events([('bench.event', PAYLOAD)])
+
+    return run_threads(threads, events, publish_one)
+
+def main():
+    parser = argparse.ArgumentParser(description='Message Bus publish benchmark')
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='bus-bench-')
+
+    print("=" * 50)
+    print(f"📊 Publishing {args.events} events from {args.threads} threads")
+    print(f"📁 Temp dir: {tmp_dir}")
+    print("=" * 50)
+
+    before, before_errors = bench_before(os.path.join(tmp_dir, 'before.db'), args.events, args.threads)
+    print(f"before: {before:10.0f} events/sec  (errors: {before_errors})")
+
+    after, after_errors = bench_after(os.path.join(tmp_dir, 'after.db'), args.events, args.threads)
+    print(f"after:  {after:10.0f} events/sec  (errors: {after_errors})")
+
+    print(f"speedup: x{after / before:.1f}")
+    print(f"writer: {bus.writer.stats()}")
+
+if __name__ == '__main__':
+    main()
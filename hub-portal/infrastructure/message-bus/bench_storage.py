@@ -0,0 +1,121 @@
+"""
+Бенчмарк хранилищ истории событий Message Bus
+
+Сравнивает два значения BUS_STORAGE на одинаковой нагрузке:
+- sqlite: посуточные таблицы events_YYYYMMDD
+- log:    append-only файлы сегментов с mmap-чтением
+
+Для каждого хранилища в отдельном процессе (настройки шины читаются
+при импорте) измеряются:
+- publish:  запись событий через писателя пачками по --batch
+- history:  листание /api/events назад страницами по 1000
+- filtered: то же с фильтром по редкому типу события
+- replay:   NDJSON-replay всего журнала
+- fetch:    выборка случайных событий по id (как у повторной доставки)
+
+Запуск:
+    python bench_storage.py --events 100000 --batch 100
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+PAYLOAD = {'order_id': 1, 'items': [{'product_id': 1, 'quantity': 2}], 'total': 119990}
+RARE_EVERY = 50
+
+def run_backend(events, batch):
+    """Дочерний процесс: нагрузка на хранилище из BUS_STORAGE"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import message_bus as bus
+
+    os.makedirs(os.path.dirname(bus.DB_PATH), exist_ok=True)
+    bus.init_db()
+    bus.writer.start()
+    results = {}
+
+    started = time.perf_counter()
+    for start in range(0, events, batch):
+        bus.store_events([
+            ('order.created' if (start + offset) % RARE_EVERY == 0 else 'product.updated', PAYLOAD)
+            for offset in range(min(batch, events - start))
+        ])
+    results['publish'] = events / (time.perf_counter() - started)
+
+    def page_through(event_type):
+        conn = bus.get_db()
+        read = 0
+        before_id = None
+        started = time.perf_counter()
+        while True:
+            page = bus.query_events(conn, event_type, before_id, None, 1000)
+            read += len(page)
+            if len(page) < 1000:
+                break
+            before_id = page[-1]['id']
+        elapsed = time.perf_counter() - started
+        conn.close()
+        return read / elapsed
+
+    results['history'] = page_through(None)
+    results['filtered'] = page_through('order.created')
+
+    started = time.perf_counter()
+    replayed = sum(chunk.count('\n' if isinstance(chunk, str) else b'\n')
+                   for chunk in bus.replay_events(0, '#', 0))
+    results['replay'] = replayed / (time.perf_counter() - started)
+
+    ids = [random.randint(1, events) for _ in range(1000)]
+    conn = bus.get_db()
+    started = time.perf_counter()
+    for start in range(0, len(ids), 100):
+        chunk = ids[start:start + 100]
+        if bus.event_log:
+            bus.event_log.fetch(chunk)
+        else:
+            bus.segments.fetch(conn, chunk)
+    results['fetch'] = len(ids) / (time.perf_counter() - started)
+    conn.close()
+
+    print(json.dumps(results))
+
+def main():
+    parser = argparse.ArgumentParser(description='Message Bus storage benchmark')
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_backend(args.events, args.batch)
+        return
+
+    print("=" * 50)
+    print(f"📊 {args.events} events, batches of {args.batch}")
+    print("=" * 50)
+
+    results = {}
+    for backend in ('sqlite', 'log'):
+        home = tempfile.mkdtemp(prefix=f'bus-bench-{backend}-')
+        env = dict(os.environ, HOME=home, BUS_STORAGE=backend)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child',
+             '--events', str(args.events), '--batch', str(args.batch)],
+            env=env, capture_output=True, text=True, check=True
+        ).stdout
+        results[backend] = json.loads(output.strip().splitlines()[-1])
+        print(f"✅ {backend} done ({home})")
+
+    print(f"{'':10} {'sqlite':>12} {'log':>12} {'ratio':>8}   (events/sec)")
+    for name in ('publish', 'history', 'filtered', 'replay', 'fetch'):
+        sqlite_rate = results['sqlite'][name]
+        log_rate = results['log'][name]
+        print(f"{name:10} {sqlite_rate:12.0f} {log_rate:12.0f} {log_rate / sqlite_rate:7.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+Клиент локальной доставки Message Bus через Unix-сокет
+
+Сервис на той же машине, что и шина, может получать события без
+HTTP и Flask: он слушает Unix-сокет, шина подключается к нему и шлёт
+кадры по постоянному соединению. Кадр - 4 байта длины (big-endian)
+и JSON:
+- одиночное событие: {"event": "order.created", "payload": {...}}
+- пачка (подписка с batch): [{"id", "event", "payload"}, ...]
+На каждый кадр клиент отвечает {"ok": true} или {"ok": false, "error"};
+ошибка обработчика - обычный отказ, шина повторит доставку.
+
+Использование:
+    from bus_client import LocalSubscriber
+
+    def on_event(event, payload):
+        ...
+
+    subscriber = LocalSubscriber('/path/to/service.sock', on_event)
+    subscriber.start()
+    subscriber.subscribe('http://127.0.0.1:5999', 'order.created', service_id='product-service')
+
+Модуль использует только стандартную библиотеку.
+"""
+
+import json
+import os
+import socket
+import struct
+import urllib.request
+from threading import Thread, Lock
+
+FRAME = struct.Struct('>I')
+
+# Предельный размер входящего кадра (пачка событий)
+MAX_FRAME = int(os.environ.get('BUS_CLIENT_MAX_FRAME', 64 * 1024 * 1024))
+
+def read_frame(sock):
+    """Прочитать кадр: bytes или None, если шина закрыла соединение"""
+    header = _read(sock, FRAME.size)
+    if header is None:
+        return None
+    size, = FRAME.unpack(header)
+    if size > MAX_FRAME:
+        raise ValueError(f'frame of {size} bytes is too large')
+    return _read(sock, size)
+
+def write_frame(sock, body):
+    sock.sendall(FRAME.pack(len(body)) + body)
+
+def _read(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+class LocalSubscriber:
+    """
+    Приём событий Message Bus через Unix-сокет
+
+    handler(event, payload) вызывается для каждого события в потоке
+    соединения; шина держит несколько соединений, поэтому обработчик
+    должен быть потокобезопасным.
+    """
+
+    def __init__(self, socket_path, handler):
+        self.socket_path = os.path.abspath(socket_path)
+        self.handler = handler
+        self.server = None
+        self.connections = set()
+        self.lock = Lock()
+        self.received = 0
+        self.failed = 0
+
+    def start(self):
+        """Начать слушать сокет (старый файл сокета заменяется)"""
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.server.listen(16)
+        Thread(target=self._accept, daemon=True).start()
+        print(f"🔌 Listening for events on {self.socket_path}")
+
+    def subscribe(self, bus_url, event, service_id=None, **options):
+        """Подписать сокет на событие (options - batch, filter)"""
+        body = dict(options, event=event, socket_path=self.socket_path)
+        if service_id:
+            body['service_id'] = service_id
+        request = urllib.request.Request(
+            f'{bus_url}/api/subscribe',
+            data=json.dumps(body).encode(),
+            headers={'Content-Type': 'application/json'}
+        )
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return json.loads(response.read())
+
+    def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+        with self.lock:
+            connections, self.connections = self.connections, set()
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _accept(self):
+        while self.server:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with self.lock:
+            self.connections.add(conn)
+        try:
+            while self.server:
+                frame = read_frame(conn)
+                if frame is None:
+                    return
+                write_frame(conn, json.dumps(self._handle(frame)).encode())
+        except (OSError, ValueError):
+            return
+        finally:
+            with self.lock:
+                self.connections.discard(conn)
+            conn.close()
+
+    def _handle(self, frame):
+        try:
+            message = json.loads(frame)
+            # Пачка - массив событий, одиночное событие - объект
+            for item in message if isinstance(message, list) else [message]:
+                self.handler(item['event'], item['payload'])
+                self.received += 1
+            return {'ok': True}
+        except Exception as e:
+            self.failed += 1
+            print(f"❌ Event handler failed: {e}")
+            return {'ok': False, 'error': str(e) or type(e).__name__}
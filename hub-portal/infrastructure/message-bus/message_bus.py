@@ -8,337 +8,5442 @@ Message Bus - Pub/Sub система для межсервисного взаи
 - Event-driven архитектура между микросервисами
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response, stream_with_context
 import requests
-from collections import defaultdict
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from collections import defaultdict, OrderedDict, deque
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta, timezone
 import sqlite3
 import os
 import json
-from threading import Thread
+import random
+import ast
+import operator
+import calendar
+import math
+import mmap
+import fcntl
+import socket
+import struct
+import zlib
+from bisect import bisect_left, bisect_right
+from threading import Thread, Lock, Condition, BoundedSemaphore
+from queue import Queue, Full, Empty
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import lru_cache
 import time
 
 app = Flask(__name__)
 
 # Конфигурация
 DB_PATH = os.path.expanduser('~/termux-backend/data/message_bus.db')
+PORT = int(os.environ.get('BUS_PORT', 5999))
 
-# In-memory хранилище подписчиков
-# {event_name: [callback_urls]}
-subscribers = defaultdict(list)
+# Пул доставки: фиксированное число воркеров и ограниченная очередь
+DELIVERY_WORKERS = int(os.environ.get('BUS_DELIVERY_WORKERS', 4))
+DELIVERY_QUEUE_SIZE = int(os.environ.get('BUS_DELIVERY_QUEUE_SIZE', 1000))
+# Общий предел ждущих заданий по всем дорожкам и цепочкам ключей
+# (BUS_DELIVERY_QUEUE_SIZE - предел одной дорожки)
+DELIVERY_QUEUE_TOTAL = int(os.environ.get('BUS_DELIVERY_QUEUE_TOTAL', 2 * DELIVERY_QUEUE_SIZE))
+
+# Дорожки доставки: веса взвешенного справедливого выбора ({дорожка: вес})
+# и дорожки по шаблонам событий ({шаблон: дорожка}, остальные - normal)
+DELIVERY_LANES = json.loads(os.environ.get('BUS_DELIVERY_LANES', '{"high": 8, "normal": 4, "low": 1}'))
+DELIVERY_LANE_ROUTES = json.loads(os.environ.get(
+    'BUS_DELIVERY_LANE_ROUTES', '{"order.#": "high", "product.created": "low"}'
+))
+DEFAULT_LANE = 'normal'
+DELIVERY_LANES.setdefault(DEFAULT_LANE, 1)
+
+# Ключ партиции: поле payload по шаблону события ({шаблон: поле});
+# события с одинаковым ключом доставляются каждому подписчику по порядку
+PARTITION_KEYS = json.loads(os.environ.get('BUS_PARTITION_KEYS', '{"order.#": "order_id"}'))
+
+# Параллельная рассылка: общий лимит запросов в полёте и лимит на подписчика
+FANOUT_MAX_IN_FLIGHT = int(os.environ.get('BUS_FANOUT_MAX_IN_FLIGHT', 32))
+FANOUT_PER_SUBSCRIBER = int(os.environ.get('BUS_FANOUT_PER_SUBSCRIBER', 4))
+# Запросов, ждущих свободного слота своего подписчика (дальше submit ждёт)
+FANOUT_MAX_QUEUED = int(os.environ.get('BUS_FANOUT_MAX_QUEUED', 4096))
+
+# Единственный писатель БД: группировка коммитов по размеру и окну времени
+WRITER_BATCH_SIZE = int(os.environ.get('BUS_WRITER_BATCH_SIZE', 256))
+WRITER_WINDOW_MS = float(os.environ.get('BUS_WRITER_WINDOW_MS', 2))
+WRITER_QUEUE_SIZE = int(os.environ.get('BUS_WRITER_QUEUE_SIZE', 10000))
+SQLITE_SYNCHRONOUS = os.environ.get('BUS_SQLITE_SYNCHRONOUS', 'FULL')
+
+# История событий: максимум на страницу JSON и размер страницы NDJSON-потока
+EVENTS_MAX_LIMIT = int(os.environ.get('BUS_EVENTS_MAX_LIMIT', 1000))
+EVENTS_STREAM_PAGE = int(os.environ.get('BUS_EVENTS_STREAM_PAGE', 1000))
+
+# Хранилище истории событий: sqlite (таблицы events_YYYYMMDD) или
+# log (append-only файлы сегментов в BUS_LOG_DIR, рядом с БД по умолчанию)
+STORAGE_BACKEND = os.environ.get('BUS_STORAGE', 'sqlite')
+LOG_DIR = os.environ.get('BUS_LOG_DIR')
+LOG_SEGMENT_BYTES = int(os.environ.get('BUS_LOG_SEGMENT_BYTES', 64 * 1024 * 1024))
+LOG_INDEX_INTERVAL = int(os.environ.get('BUS_LOG_INDEX_INTERVAL', 64))
+LOG_FSYNC = os.environ.get('BUS_LOG_FSYNC', '1') == '1'
+
+# Хранение событий посуточными сегментами и их срок жизни (в днях)
+# BUS_RETENTION_POLICY - JSON {"event_type": days} для отдельных типов
+RETENTION_DAYS = max(1, int(os.environ.get('BUS_RETENTION_DAYS', 30)))
+RETENTION_POLICY = {
+    event_type: max(1, int(days))
+    for event_type, days in json.loads(os.environ.get('BUS_RETENTION_POLICY', '{}')).items()
+}
+RETENTION_INTERVAL = float(os.environ.get('BUS_RETENTION_INTERVAL', 600))
+RETENTION_ARCHIVE_DIR = os.environ.get('BUS_RETENTION_ARCHIVE_DIR')
+RETENTION_CHUNK = int(os.environ.get('BUS_RETENTION_CHUNK', 500))
+
+# Replay для групп потребителей: размер страницы чтения журнала
+REPLAY_PAGE = int(os.environ.get('BUS_REPLAY_PAGE', 5000))
+
+# SSE-подписки: число одновременных потоков, буфер на поток, keep-alive
+STREAM_MAX_CLIENTS = int(os.environ.get('BUS_STREAM_MAX_CLIENTS', 100))
+STREAM_BUFFER_SIZE = int(os.environ.get('BUS_STREAM_BUFFER_SIZE', 1000))
+STREAM_KEEPALIVE = float(os.environ.get('BUS_STREAM_KEEPALIVE', 15))
+
+# Счётчики /api/stats: период сохранения итогов в БД (секунды)
+COUNTERS_PERSIST_INTERVAL = float(os.environ.get('BUS_COUNTERS_PERSIST_INTERVAL', 30))
+# Сколько секунд /api/stats отдаёт подсчёт outbox по статусам без нового запроса
+OUTBOX_STATS_INTERVAL = float(os.environ.get('BUS_OUTBOX_STATS_INTERVAL', 5))
+
+# Максимальный размер пачки в /api/publish/batch
+BATCH_MAX_EVENTS = int(os.environ.get('BUS_BATCH_MAX_EVENTS', 1000))
+
+# Допуск публикаций: общая корзина и корзины отправителей (событий/сек,
+# запас), предел недоставленных доставок в outbox; 0 выключает проверку
+ADMISSION_RATE = float(os.environ.get('BUS_ADMISSION_RATE', 2000))
+ADMISSION_BURST = float(os.environ.get('BUS_ADMISSION_BURST', 4000))
+ADMISSION_PRODUCER_RATE = float(os.environ.get('BUS_ADMISSION_PRODUCER_RATE', 500))
+ADMISSION_PRODUCER_BURST = float(os.environ.get('BUS_ADMISSION_PRODUCER_BURST', 1000))
+ADMISSION_MAX_PRODUCERS = int(os.environ.get('BUS_ADMISSION_MAX_PRODUCERS', 1024))
+ADMISSION_MAX_PENDING = int(os.environ.get('BUS_ADMISSION_MAX_PENDING', 50000))
+ADMISSION_DEPTH_INTERVAL = float(os.environ.get('BUS_ADMISSION_DEPTH_INTERVAL', 1))
+
+# Dead letters (доставки в статусе failed): размер страницы чтения,
+# скорость redrive по умолчанию и предельная (строк/сек), число одновременных
+# заданий и сколько завершённых помнить; задание ждёт, пока в outbox
+# не меньше BUS_REDRIVE_MAX_PENDING недоставленных строк
+DEAD_LETTERS_PAGE = int(os.environ.get('BUS_DEAD_LETTERS_PAGE', 500))
+REDRIVE_DEFAULT_RATE = float(os.environ.get('BUS_REDRIVE_RATE', 100))
+REDRIVE_MAX_RATE = float(os.environ.get('BUS_REDRIVE_MAX_RATE', 5000))
+REDRIVE_MAX_JOBS = int(os.environ.get('BUS_REDRIVE_MAX_JOBS', 4))
+REDRIVE_HISTORY = int(os.environ.get('BUS_REDRIVE_HISTORY', 20))
+REDRIVE_MAX_PENDING = int(os.environ.get('BUS_REDRIVE_MAX_PENDING', ADMISSION_MAX_PENDING // 2))
+
+# Идемпотентная публикация: сколько секунд помнить idempotency_key,
+# сколько последних ключей держать в памяти, предельная длина ключа
+IDEMPOTENCY_WINDOW = float(os.environ.get('BUS_IDEMPOTENCY_WINDOW', 24 * 3600))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('BUS_IDEMPOTENCY_CACHE_SIZE', 100000))
+IDEMPOTENCY_KEY_MAX_LENGTH = int(os.environ.get('BUS_IDEMPOTENCY_KEY_MAX_LENGTH', 256))
+# Вычистка истёкших ключей: период (секунды) и ключей на одну операцию писателя
+IDEMPOTENCY_EXPIRE_INTERVAL = float(os.environ.get('BUS_IDEMPOTENCY_EXPIRE_INTERVAL', 60))
+IDEMPOTENCY_EXPIRE_CHUNK = int(os.environ.get('BUS_IDEMPOTENCY_EXPIRE_CHUNK', 5000))
+
+# Пакетная доставка (опция подписки batch): значения по умолчанию и предел ожидания
+BATCH_DEFAULT_EVENTS = int(os.environ.get('BUS_BATCH_DEFAULT_EVENTS', 100))
+BATCH_DEFAULT_WAIT_MS = float(os.environ.get('BUS_BATCH_DEFAULT_WAIT_MS', 200))
+BATCH_MAX_WAIT_MS = float(os.environ.get('BUS_BATCH_MAX_WAIT_MS', 60000))
+
+# HTTP-клиент доставки: keep-alive сессия на каждый origin подписчика
+HTTP_POOL_SIZE = int(os.environ.get('BUS_HTTP_POOL_SIZE', FANOUT_PER_SUBSCRIBER + 2))
+HTTP_MAX_ORIGINS = int(os.environ.get('BUS_HTTP_MAX_ORIGINS', 64))
+HTTP_IDLE_TIMEOUT = float(os.environ.get('BUS_HTTP_IDLE_TIMEOUT', 60))
+
+# Локальная доставка через Unix-сокет (callback_url вида unix:///path/to.sock):
+# свободных соединений на сокет, таймаут ответа, предельный размер кадра ответа
+LOCAL_SCHEME = 'unix://'
+LOCAL_POOL_SIZE = int(os.environ.get('BUS_LOCAL_POOL_SIZE', FANOUT_PER_SUBSCRIBER + 2))
+LOCAL_TIMEOUT = float(os.environ.get('BUS_LOCAL_TIMEOUT', 5))
+LOCAL_MAX_FRAME = int(os.environ.get('BUS_LOCAL_MAX_FRAME', 1024 * 1024))
+
+# Повторная доставка (outbox): экспоненциальная задержка с jitter
+RETRY_MAX_ATTEMPTS = int(os.environ.get('BUS_RETRY_MAX_ATTEMPTS', 8))
+RETRY_BASE_DELAY = float(os.environ.get('BUS_RETRY_BASE_DELAY', 2))
+RETRY_MAX_DELAY = float(os.environ.get('BUS_RETRY_MAX_DELAY', 300))
+RETRY_WORKERS = int(os.environ.get('BUS_RETRY_WORKERS', 2))
+RETRY_QUEUE_SIZE = int(os.environ.get('BUS_RETRY_QUEUE_SIZE', 500))
+RETRY_POLL_INTERVAL = float(os.environ.get('BUS_RETRY_POLL_INTERVAL', 1))
+RETRY_BATCH = int(os.environ.get('BUS_RETRY_BATCH', 100))
+
+# Circuit breaker на callback_url: окно последних вызовов, пороги ошибок
+# и медленных ответов, время в разомкнутом состоянии, число проб
+BREAKER_WINDOW = int(os.environ.get('BUS_BREAKER_WINDOW', 20))
+BREAKER_MIN_CALLS = int(os.environ.get('BUS_BREAKER_MIN_CALLS', 10))
+BREAKER_ERROR_RATE = float(os.environ.get('BUS_BREAKER_ERROR_RATE', 0.5))
+BREAKER_SLOW_MS = float(os.environ.get('BUS_BREAKER_SLOW_MS', 2000))
+BREAKER_SLOW_RATE = float(os.environ.get('BUS_BREAKER_SLOW_RATE', 0.8))
+BREAKER_OPEN_SECONDS = float(os.environ.get('BUS_BREAKER_OPEN_SECONDS', 30))
+BREAKER_HALF_OPEN_PROBES = int(os.environ.get('BUS_BREAKER_HALF_OPEN_PROBES', 1))
+
+# Ошибка доставки, отложенной разомкнутым автоматом (попыткой не считается)
+CIRCUIT_OPEN = 'circuit open'
+
+# Фильтры подписок по содержимому: максимальная длина выражения
+FILTER_MAX_LENGTH = int(os.environ.get('BUS_FILTER_MAX_LENGTH', 1000))
+
+# Сколько результатов сопоставления топиков держать в кэше
+TOPIC_CACHE_SIZE = int(os.environ.get('BUS_TOPIC_CACHE_SIZE', 10000))
+
+# ============= TOPICS =============
+
+def is_valid_pattern(pattern):
+    """* и # допустимы только как целый сегмент топика"""
+    return all(
+        segment and (segment in ('*', '#') or ('*' not in segment and '#' not in segment))
+        for segment in pattern.split('.')
+    )
+
+class TopicTrie:
+    """
+    Trie шаблонов подписки с кэшем сопоставлений
+
+    Сегменты разделяются точкой: "*" совпадает ровно с одним сегментом,
+    "#" - с нулём или более сегментов ("order.*", "product.#").
+    Поиск идёт по уровням топика и на каждом проверяет только
+    точный сегмент, "*" и "#", поэтому не зависит от числа шаблонов.
+    Результат для топика запоминается и сбрасывается при любом
+    изменении подписок.
+    """
+
+    def __init__(self, cache_size):
+        self.root = self._node()
+        self.cache = {}
+        self.cache_size = cache_size
+        self.lock = Lock()
+
+    @staticmethod
+    def _node():
+        return {'children': {}, 'urls': []}
+
+    def add(self, pattern, callback_url):
+        with self.lock:
+            node = self.root
+            for segment in pattern.split('.'):
+                node = node['children'].setdefault(segment, self._node())
+            if callback_url not in node['urls']:
+                node['urls'].append(callback_url)
+            self.cache.clear()
+
+    def remove(self, pattern, callback_url):
+        with self.lock:
+            path = [self.root]
+            segments = pattern.split('.')
+            for segment in segments:
+                node = path[-1]['children'].get(segment)
+                if node is None:
+                    return
+                path.append(node)
+
+            if callback_url in path[-1]['urls']:
+                path[-1]['urls'].remove(callback_url)
+
+            # Удалить опустевшие узлы
+            for depth in range(len(segments), 0, -1):
+                node = path[depth]
+                if node['urls'] or node['children']:
+                    break
+                del path[depth - 1]['children'][segments[depth - 1]]
+
+            self.cache.clear()
+
+    def match(self, topic):
+        """Все значения, чьи шаблоны совпадают с топиком"""
+        with self.lock:
+            urls = self.cache.get(topic)
+            if urls is None:
+                found = {}
+                self._walk(self.root, topic.split('.'), 0, found)
+                urls = tuple(found)
+
+                if len(self.cache) >= self.cache_size:
+                    self.cache.clear()
+                self.cache[topic] = urls
+            return urls
+
+    def _walk(self, node, parts, i, found):
+        children = node['children']
+
+        if i == len(parts):
+            found.update(dict.fromkeys(node['urls']))
+        else:
+            for key in (parts[i], '*'):
+                child = children.get(key)
+                if child is not None:
+                    self._walk(child, parts, i + 1, found)
+
+        # "#" поглощает от нуля до всех оставшихся сегментов
+        hash_node = children.get('#')
+        if hash_node is not None:
+            for j in range(i, len(parts) + 1):
+                self._walk(hash_node, parts, j, found)
+
+# ============= FILTERS =============
+
+class EventFilter:
+    """
+    Фильтр подписки по содержимому события
+
+    Выражение в синтаксисе Python разбирается один раз при подписке
+    и превращается в дерево замыканий; при доставке eval не вызывается.
+    Допускаются:
+    - поля payload: payload.category, total (то же, что payload.total),
+      вложенные через точку; отсутствующее поле - null;
+    - литералы: строки, числа, true / false / null, списки литералов;
+    - сравнения == != < <= > >= in, not in (в том числе цепочки 1 < x < 5);
+    - and, or, not и скобки.
+    Сравнение несравнимых значений (null > 5) даёт false.
+    """
+
+    ORDERING = (ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+    COMPARATORS = {
+        ast.Eq: operator.eq,
+        ast.NotEq: operator.ne,
+        ast.Lt: operator.lt,
+        ast.LtE: operator.le,
+        ast.Gt: operator.gt,
+        ast.GtE: operator.ge,
+        ast.In: lambda value, container: value in container,
+        ast.NotIn: lambda value, container: value not in container
+    }
+    CONSTANTS = {'true': True, 'false': False, 'null': None}
+
+    def __init__(self, source):
+        if len(source) > FILTER_MAX_LENGTH:
+            raise ValueError(f'filter is limited to {FILTER_MAX_LENGTH} characters')
+        try:
+            tree = ast.parse(source.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f'filter syntax error: {e.msg}')
+
+        self.source = source
+        self.predicate = self._compile(tree.body)
+        self.evaluated = 0
+        self.matched = 0
+        self.errors = 0
+
+    def match(self, payload):
+        """Проходит ли payload фильтр (счётчики ведёт только поток писателя)"""
+        self.evaluated += 1
+        try:
+            result = bool(self.predicate(payload))
+        except Exception:
+            self.errors += 1
+            return False
+        if result:
+            self.matched += 1
+        return result
+
+    def _compile(self, node):
+        if isinstance(node, ast.BoolOp):
+            # a and b and c -> and(and(a, b), c) без генераторов на каждом событии
+            parts = [self._compile(value) for value in node.values]
+            combined = parts[0]
+            for part in parts[1:]:
+                if isinstance(node.op, ast.And):
+                    combined = (lambda a, b: lambda payload: a(payload) and b(payload))(combined, part)
+                else:
+                    combined = (lambda a, b: lambda payload: a(payload) or b(payload))(combined, part)
+            return combined
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            operand = self._compile(node.operand)
+            return lambda payload: not operand(payload)
+
+        if isinstance(node, ast.Compare):
+            return self._compile_compare(node)
+
+        value = self._value(node)
+        return value
+
+    def _compile_compare(self, node):
+        left = self._value(node.left)
+        pairs = []
+        for op, right in zip(node.ops, node.comparators):
+            comparator = self.COMPARATORS.get(type(op))
+            if comparator is None:
+                raise ValueError(f'filter: operator {type(op).__name__} is not supported')
+            pairs.append((comparator, self._value(right)))
+
+        # Частый случай: поле сравнивается с литералом
+        if len(pairs) == 1 and getattr(pairs[0][1], 'constant', False):
+            comparator, right = pairs[0]
+            constant = right(None)
+
+            if isinstance(node.ops[0], self.ORDERING):
+                # Отсутствующее поле не упорядочивается - без исключения
+                def order_constant(payload):
+                    value = left(payload)
+                    if value is None:
+                        return False
+                    try:
+                        return comparator(value, constant)
+                    except TypeError:
+                        return False
+                return order_constant
+
+            def compare_constant(payload):
+                try:
+                    return comparator(left(payload), constant)
+                except TypeError:
+                    return False
+            return compare_constant
+
+        def compare(payload):
+            value = left(payload)
+            for comparator, right in pairs:
+                other = right(payload)
+                try:
+                    if not comparator(value, other):
+                        return False
+                except TypeError:
+                    return False
+                value = other
+            return True
+        return compare
+
+    def _value(self, node):
+        """Замыкание payload -> значение для поля или литерала"""
+        if isinstance(node, ast.Constant) and isinstance(node.value, (str, int, float, bool, type(None))):
+            return self._constant(node.value)
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) \
+                and isinstance(node.operand, ast.Constant) and isinstance(node.operand.value, (int, float)):
+            return self._constant(-node.operand.value)
+
+        if isinstance(node, ast.Name) and node.id in self.CONSTANTS:
+            return self._constant(self.CONSTANTS[node.id])
+
+        if isinstance(node, (ast.List, ast.Tuple)):
+            items = tuple(self._value(item) for item in node.elts)
+            if not all(getattr(item, 'constant', False) for item in items):
+                raise ValueError('filter: lists may contain only literals')
+            return self._constant(frozenset(item(None) for item in items))
+
+        if isinstance(node, (ast.Name, ast.Attribute)):
+            return self._field(node)
+
+        if isinstance(node, (ast.BoolOp, ast.UnaryOp, ast.Compare)):
+            return self._compile(node)
+
+        raise ValueError(f'filter: {type(node).__name__} is not supported')
+
+    @staticmethod
+    def _constant(value):
+        def constant(payload):
+            return value
+        constant.constant = True
+        return constant
+
+    @staticmethod
+    def _field(node):
+        path = []
+        while isinstance(node, ast.Attribute):
+            path.append(node.attr)
+            node = node.value
+        if not isinstance(node, ast.Name):
+            raise ValueError('filter: fields must look like payload.name or name')
+        path.append(node.id)
+        path.reverse()
+        if path[0] == 'payload':
+            path = path[1:]
+
+        if not path:
+            return lambda payload: payload
+        if len(path) == 1:
+            key = path[0]
+
+            def field(payload):
+                return payload.get(key) if isinstance(payload, dict) else None
+            return field
+
+        def nested_field(payload):
+            for key in path:
+                if not isinstance(payload, dict):
+                    return None
+                payload = payload.get(key)
+            return payload
+        return nested_field
+
+    def stats(self):
+        return {
+            'evaluated': self.evaluated,
+            'matched': self.matched,
+            'errors': self.errors
+        }
+
+# ============= SUBSCRIPTIONS =============
+
+class SubscriptionSnapshot:
+    """
+    Неизменяемый снимок подписок одной версии
+
+    Строится целиком из таблицы subscriptions и после этого не меняется:
+    читатели берут ссылку на текущий снимок без блокировок, изменение
+    подписок собирает новый снимок и подменяет ссылку.
+    - subscribers: {шаблон: (callback_url, ...)}
+    - filters:     {(шаблон, callback_url): EventFilter или None}
+    - batches:     {callback_url: (max_events, max_wait_ms)}
+    - topics:      trie шаблонов, значения - пары (callback_url, фильтр)
+    """
+
+    def __init__(self, version, rows=(), previous=None):
+        self.version = version
+        self.topics = TopicTrie(TOPIC_CACHE_SIZE)
+        self.filters = {}
+        self.batches = {}
+        subscribers = defaultdict(list)
+
+        for row in rows:
+            pattern = row['event_type']
+            callback_url = row['callback_url']
+            subscribers[pattern].append(callback_url)
+
+            event_filter = self._compile(pattern, callback_url, row['filter'], previous)
+            self.filters[(pattern, callback_url)] = event_filter
+            self.topics.add(pattern, (callback_url, event_filter))
+
+            if row['batch']:
+                self.batches[callback_url] = tuple(json.loads(row['batch']))
+
+        self.subscribers = {pattern: tuple(urls) for pattern, urls in subscribers.items()}
+        self.urls = frozenset(self.batches).union(*self.subscribers.values())
+
+    @staticmethod
+    def _compile(pattern, callback_url, source, previous):
+        if not source:
+            return None
+
+        # Тот же фильтр прошлого снимка - без перекомпиляции и с его счётчиками
+        if previous:
+            event_filter = previous.filters.get((pattern, callback_url))
+            if event_filter is not None and event_filter.source == source:
+                return event_filter
+
+        try:
+            return EventFilter(source)
+        except ValueError as e:
+            print(f"⚠️ Filter of {pattern} → {callback_url} ignored: {e}")
+            return None
+
+    def count(self):
+        return sum(len(urls) for urls in self.subscribers.values())
+
+    def match(self, event, payload):
+        """callback_url подписчиков события, чьи фильтры пропускают payload"""
+        urls = []
+        for callback_url, event_filter in self.topics.match(event):
+            if callback_url in urls:
+                continue
+            if event_filter is None or event_filter.match(payload):
+                urls.append(callback_url)
+        return urls
+
+class SubscriptionCache:
+    """
+    Подписки, согласованные между процессами шины через БД
+
+    Источник истины - таблица subscriptions, каждое её изменение
+    увеличивает счётчик subscriptions_version в bus_state в той же
+    транзакции. Процесс держит SubscriptionSnapshot и перед
+    использованием сверяет версию: сначала дешёвый PRAGMA data_version
+    (меняется, только если БД фиксировало другое соединение), и лишь
+    тогда - чтение счётчика. Снимок перестраивается, если версия
+    в БД отличается от версии снимка.
+    """
+
+    VERSION_KEY = 'subscriptions_version'
+
+    def __init__(self):
+        self.snapshot = SubscriptionSnapshot(-1)
+        self.lock = Lock()
+        # Своё соединение для проверок из потоков запросов
+        self.conn = None
+        self.conn_lock = Lock()
+        # id соединения -> последний увиденный PRAGMA data_version
+        self.data_versions = {}
+        self.rebuilds = 0
+        self.version_reads = 0
+
+    def current(self, conn=None):
+        """
+        Актуальный снимок подписок
+
+        conn - соединение потока писателя; без него проверка идёт
+        через собственное соединение кэша.
+        """
+        if conn is None:
+            with self.conn_lock:
+                if self.conn is None:
+                    self.conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+                    self.conn.row_factory = sqlite3.Row
+                return self._check(self.conn)
+        return self._check(conn)
+
+    def _check(self, conn):
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if self.data_versions.get(id(conn)) == data_version:
+            return self.snapshot
+        self.data_versions[id(conn)] = data_version
+
+        self.version_reads += 1
+        if self._version(conn) == self.snapshot.version:
+            return self.snapshot
+
+        # Версия и строки подписок - из одной транзакции чтения
+        own = not conn.in_transaction
+        if own:
+            conn.execute('BEGIN')
+        try:
+            snapshot = self._build(conn)
+        finally:
+            if own:
+                conn.execute('COMMIT')
+        self._install(snapshot)
+        return self.snapshot
+
+    def load(self, conn):
+        self._install(self._build(conn))
+        return self.snapshot
+
+    def apply(self, change):
+        """
+        Изменить подписки: change(conn) выполняется писателем вместе
+        с увеличением версии, новый снимок ставится после COMMIT.
+        Возвращает результат change.
+        """
+        def operation(conn):
+            result = change(conn)
+            conn.execute('''
+                INSERT INTO bus_state (key, value) VALUES (?, 1)
+                ON CONFLICT(key) DO UPDATE SET value = value + 1
+            ''', (self.VERSION_KEY,))
+            snapshot = self._build(conn)
+            writer.on_commit(lambda: self._install(snapshot))
+            return result
+
+        return writer.execute(operation)
+
+    def _version(self, conn):
+        row = conn.execute('SELECT value FROM bus_state WHERE key = ?', (self.VERSION_KEY,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def _build(self, conn):
+        rows = conn.execute('SELECT event_type, callback_url, batch, filter FROM subscriptions ORDER BY id').fetchall()
+        return SubscriptionSnapshot(self._version(conn), rows, self.snapshot)
+
+    def _install(self, snapshot):
+        with self.lock:
+            previous = self.snapshot
+            # Снимки из разных потоков могут прийти не по порядку
+            if snapshot.version <= previous.version:
+                return
+            self.snapshot = snapshot
+            self.rebuilds += 1
+
+            # Привести пакетный режим и соединения сокетов к новому снимку
+            for callback_url in previous.batches.keys() | snapshot.batches.keys():
+                options = snapshot.batches.get(callback_url)
+                if options != previous.batches.get(callback_url):
+                    batcher.configure(callback_url, options)
+            for callback_url in previous.urls - snapshot.urls:
+                if callback_url.startswith(LOCAL_SCHEME):
+                    local_pool.forget(callback_url[len(LOCAL_SCHEME):])
+
+    def stats(self):
+        return {
+            'version': self.snapshot.version,
+            'subscriptions': self.snapshot.count(),
+            'rebuilds': self.rebuilds,
+            'version_reads': self.version_reads
+        }
+
+subscriptions = SubscriptionCache()
 
 # ============= DATABASE =============
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+def get_db():
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def init_db():
+    conn = get_db()
+
+    # WAL: читатели (/api/events, /api/stats) не блокируют писателя
+    conn.execute('PRAGMA journal_mode=WAL')
+
+    # Каталог посуточных сегментов истории событий (events_YYYYMMDD)
+    # status: active / archived / dropped
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS event_segments (
+            name TEXT PRIMARY KEY,
+            day TEXT NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            dropped_at TIMESTAMP
+        )
+    ''')
+    migrate_legacy_events(conn)
+
+    # Подписки (для персистентности)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_type TEXT NOT NULL,
+            callback_url TEXT NOT NULL,
+            service_id TEXT,
+            batch TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(event_type, callback_url)
+        )
+    ''')
+    # Опция пакетной доставки (JSON) для баз прежних версий
+    columns = [row['name'] for row in conn.execute('PRAGMA table_info(subscriptions)')]
+    if 'batch' not in columns:
+        conn.execute('ALTER TABLE subscriptions ADD COLUMN batch TEXT')
+    if 'filter' not in columns:
+        conn.execute('ALTER TABLE subscriptions ADD COLUMN filter TEXT')
+
+    # Outbox: статус доставки события каждому подписчику
+    # status: pending / inflight / delivered / failed
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS deliveries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER NOT NULL,
+            callback_url TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_deliveries_due
+        ON deliveries (status, next_attempt_at)
+    ''')
+    # Dead letters: листание failed-доставок по id
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_deliveries_failed
+        ON deliveries (id) WHERE status = 'failed'
+    ''')
+    # Очистка outbox при удалении сегмента
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_deliveries_event
+        ON deliveries (event_id)
+    ''')
+
+    # Группы потребителей: committed_id - последнее обработанное событие
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS consumer_groups (
+            name TEXT PRIMARY KEY,
+            event_type TEXT NOT NULL DEFAULT '#',
+            committed_id INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Итоги счётчиков /api/stats и служебные значения шины
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS event_counters (
+            event_type TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bus_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS publish_keys (
+            key TEXT PRIMARY KEY,
+            event_id INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_publish_keys_created ON publish_keys(created_at)')
+
+    # Доставки, прерванные остановкой шины, вернуть в очередь повторов
+    cursor = conn.execute('''
+        UPDATE deliveries SET status = 'pending', next_attempt_at = ?
+        WHERE status = 'inflight'
+    ''', (time.time(),))
+    if cursor.rowcount:
+        print(f"♻️ Resumed {cursor.rowcount} interrupted deliveries")
+
+    conn.commit()
+    if event_log:
+        # Записи журнала после закоммиченного счётчика id - от COMMIT,
+        # не состоявшегося из-за падения; при первом запуске счётчика нет
+        row = conn.execute('SELECT value FROM bus_state WHERE key = ?', (segments.ID_KEY,)).fetchone()
+        event_log.open(int(row[0]) - 1 if row else None)
+    segments.load(conn, event_log.next_id if event_log else 1)
+    counters.load(conn)
+    idempotency.load(conn)
+    conn.close()
+
+    # Загрузить подписки из БД в память
+    load_subscriptions()
+
+    print("✅ Message Bus database initialized")
+
+def migrate_legacy_events(conn):
+    """
+    Превратить таблицу events прежних версий в сегмент events_legacy
+
+    Переименование не трогает строки; сегмент истечёт вместе
+    с последним записанным в него событием. Индекс (event_type, id),
+    как у новых сегментов, создаётся и для уже перенесённой таблицы.
+    """
+    legacy = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'events_legacy' AND type = 'table'").fetchone()
+    if legacy:
+        EventSegments.create_index(conn, 'events_legacy')
+
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'events'").fetchone()
+    if row is None or row['type'] != 'table':
+        return
+
+    bounds = conn.execute('''
+        SELECT MIN(id) as first_id, MAX(id) as last_id, MAX(published_at) as last_at
+        FROM events
+    ''').fetchone()
+
+    if bounds['first_id'] is None:
+        # Пустая таблица: сохранить только последний выданный id
+        seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'events'").fetchone()
+        conn.execute('DROP TABLE events')
+        if seq:
+            conn.execute('''
+                INSERT OR IGNORE INTO event_segments (name, day, first_id, last_id, status)
+                VALUES ('events_legacy', ?, 1, ?, 'dropped')
+            ''', (utc_day(), seq['seq']))
+        return
+
+    conn.execute('ALTER TABLE events RENAME TO events_legacy')
+    EventSegments.create_index(conn, 'events_legacy')
+    conn.execute('''
+        INSERT INTO event_segments (name, day, first_id)
+        VALUES ('events_legacy', ?, ?)
+    ''', (bounds['last_at'][:10].replace('-', ''), bounds['first_id']))
+    print(f"📦 Legacy events table moved to segment events_legacy (up to id {bounds['last_id']})")
+
+def load_subscriptions():
+    """Загрузить подписки из БД при старте"""
+    conn = get_db()
+    snapshot = subscriptions.load(conn)
+    conn.close()
+
+    print(f"📥 Loaded {snapshot.count()} subscriptions from database")
+
+# ============= WRITER =============
+
+class EventLogWriter:
+    """
+    Единственный писатель в БД с групповым коммитом
+
+    Все изменения (вставка событий, outbox, notified_count, подписки)
+    ставятся в очередь как функции fn(conn). Поток писателя выбирает
+    из очереди до batch_size операций или сколько успеет за окно
+    window_ms и фиксирует их одним COMMIT - один fsync на группу
+    вместо одного на событие и никаких "database is locked" между
+    конкурирующими писателями.
+    """
+
+    def __init__(self, batch_size, window_ms, queue_size):
+        self.batch_size = batch_size
+        self.window = window_ms / 1000
+        self.queue = Queue(maxsize=queue_size)
+        self.lock = Lock()
+        self.thread = None
+        self.commits = 0
+        self.operations = 0
+        self.failed = 0
+        self.callbacks = []
+        self.prepares = []
+        self.rollbacks = []
+
+    def start(self):
+        if self.thread:
+            return
+
+        self.thread = Thread(target=self._loop, name='bus-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, fn):
+        """Поставить операцию в очередь. Future завершится после COMMIT"""
+        future = Future()
+        self.queue.put((fn, future))
+        return future
+
+    def execute(self, fn):
+        """Выполнить операцию и дождаться её фиксации"""
+        return self.submit(fn).result()
+
+    def on_commit(self, callback):
+        """
+        Вызвать callback после COMMIT текущей группы
+
+        Только для операций, выполняемых писателем: если операция
+        откатится, её callback не будет вызван.
+        """
+        self.callbacks.append(callback)
+
+    def before_commit(self, callback):
+        """
+        Вызвать callback перед COMMIT текущей группы
+
+        Ошибка callback откатывает всю группу. Колбэки откатившейся
+        операции отменяются.
+        """
+        self.prepares.append(callback)
+
+    def on_rollback(self, callback):
+        """
+        Вызвать callback, если операция или вся группа откатится
+
+        Колбэки отката вызываются в обратном порядке - как отменяются
+        изменения вне БД, сделанные операцией (например, байты журнала).
+        """
+        self.rollbacks.append(callback)
+
+    def _undo(self, start=0):
+        rollbacks = self.rollbacks[start:]
+        del self.rollbacks[start:]
+        for callback in reversed(rollbacks):
+            try:
+                callback()
+            except Exception as e:
+                print(f"❌ Writer rollback callback failed: {e}")
+
+    def _loop(self):
+        conn = sqlite3.connect(DB_PATH, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA synchronous = {SQLITE_SYNCHRONOUS}')
+
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        batch.append(self.queue.get(timeout=timeout))
+                    else:
+                        batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            self._commit(conn, batch)
+
+    def _commit(self, conn, batch):
+        results = []
+
+        try:
+            # IMMEDIATE: блокировка записи с начала группы, чтобы счётчик id
+            # читался уже после коммитов писателей других процессов
+            conn.execute('BEGIN IMMEDIATE')
+            for fn, future in batch:
+                # Ошибка одной операции не откатывает остальные в группе
+                conn.execute('SAVEPOINT op')
+                callbacks = len(self.callbacks)
+                prepares = len(self.prepares)
+                rollbacks = len(self.rollbacks)
+                try:
+                    results.append((future, fn(conn), None))
+                    conn.execute('RELEASE op')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO op')
+                    conn.execute('RELEASE op')
+                    del self.callbacks[callbacks:]
+                    del self.prepares[prepares:]
+                    self._undo(rollbacks)
+                    results.append((future, None, e))
+            prepares, self.prepares = self.prepares, []
+            for callback in prepares:
+                callback()
+            conn.execute('COMMIT')
+            self.rollbacks.clear()
+        except Exception as e:
+            print(f"❌ Writer commit failed: {e}")
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            results = [(future, None, e) for _, future in batch]
+            self.callbacks.clear()
+            self.prepares.clear()
+            self._undo()
+
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"❌ Writer commit callback failed: {e}")
+
+        failed = 0
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                failed += 1
+                future.set_exception(error)
+
+        with self.lock:
+            self.commits += 1
+            self.operations += len(batch)
+            self.failed += failed
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'commits': self.commits,
+                'operations': self.operations,
+                'failed': self.failed,
+                'avg_group_size': round(self.operations / self.commits, 2) if self.commits else 0
+            }
+
+writer = EventLogWriter(WRITER_BATCH_SIZE, WRITER_WINDOW_MS, WRITER_QUEUE_SIZE)
+
+# ============= SEGMENTS =============
+
+def utc_day(timestamp=None):
+    """Сутки (UTC) в формате сегмента: YYYYMMDD"""
+    return time.strftime('%Y%m%d', time.gmtime(timestamp))
+
+def is_missing_table(error):
+    """Сегмент удалён между снимком каталога и запросом"""
+    return isinstance(error, sqlite3.OperationalError) and 'no such table' in str(error)
+
+class EventSegments:
+    """
+    История событий в посуточных таблицах events_YYYYMMDD
+
+    События пишутся в сегмент текущих суток (UTC). id событий сквозные
+    и выдаются писателем, каталог event_segments хранит первый id
+    каждого сегмента, поэтому сегмент события находится по id двоичным
+    поиском. Истёкшие сутки удаляются целиком через DROP TABLE, без
+    построчного DELETE по всей истории.
+
+    snapshot - неизменяемый кортеж (first_id, name, day) по возрастанию
+    first_id; заменяется целиком, читатели берут его без блокировок.
+    Замену делают писатель (новый сегмент) и поток retention (удаление),
+    поэтому она идёт под lock.
+
+    Следующий id хранится в строке bus_state и выдаётся внутри
+    транзакции писателя, поэтому процессы, работающие с одной БД,
+    не выдают одинаковых id. Сегмент новых суток, созданный другим
+    процессом, подхватывается перечитыванием каталога.
+    """
+
+    ID_KEY = 'next_event_id'
+    # Не чаще раза в секунду перечитывать каталог в поисках сегмента суток
+    REFRESH_INTERVAL = 1.0
+
+    def __init__(self):
+        self.snapshot = ()
+        self.lock = Lock()
+        self.refreshed_at = 0.0
+
+    @staticmethod
+    def create_table(conn, name):
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {name} (
+                id INTEGER PRIMARY KEY,
+                event_type TEXT NOT NULL,
+                payload TEXT,
+                published_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                notified_count INTEGER DEFAULT 0
+            )
+        ''')
+        EventSegments.create_index(conn, name)
+
+    @staticmethod
+    def create_index(conn, name):
+        # Keyset-пагинация истории с фильтром по типу
+        conn.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_{name}_type_id
+            ON {name} (event_type, id)
+        ''')
+
+    @staticmethod
+    def _read(conn):
+        cursor = conn.execute('''
+            SELECT first_id, name, day FROM event_segments
+            WHERE status = 'active'
+            ORDER BY first_id
+        ''')
+        return tuple((row['first_id'], row['name'], row['day']) for row in cursor.fetchall())
+
+    def load(self, conn, log_next_id=1):
+        """
+        Прочитать каталог при старте, до запуска писателя
+
+        Счётчик id поднимается до следующего за последним записанным
+        событием (log_next_id - для журнала BUS_STORAGE=log), но не
+        уменьшается: его могли продвинуть другие процессы.
+        """
+        self.snapshot = self._read(conn)
+
+        last_ids = [
+            conn.execute(f'SELECT MAX(id) FROM {name}').fetchone()[0] or 0
+            for _, name, _ in self.snapshot
+        ]
+        retired = conn.execute('SELECT MAX(last_id) FROM event_segments').fetchone()[0] or 0
+        next_id = max(last_ids + [retired, log_next_id - 1]) + 1
+        conn.execute('''
+            INSERT INTO bus_state (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE
+            SET value = MAX(CAST(value AS INTEGER), excluded.value)
+        ''', (self.ID_KEY, next_id))
+        conn.commit()
+
+    def reserve(self, conn, count):
+        """Выделить count подряд идущих id в транзакции писателя, вернуть первый"""
+        conn.execute(
+            'UPDATE bus_state SET value = CAST(value AS INTEGER) + ? WHERE key = ?',
+            (count, self.ID_KEY)
+        )
+        next_id = conn.execute(
+            'SELECT value FROM bus_state WHERE key = ?', (self.ID_KEY,)
+        ).fetchone()[0]
+        return int(next_id) - count
+
+    def last_id(self, conn=None):
+        """Последний выданный id события по закоммиченному счётчику"""
+        own = conn is None
+        if own:
+            conn = get_db()
+        try:
+            row = conn.execute('SELECT value FROM bus_state WHERE key = ?', (self.ID_KEY,)).fetchone()
+        finally:
+            if own:
+                conn.close()
+        return int(row[0]) - 1 if row else 0
+
+    def allocate(self, conn, count):
+        """
+        Выделить count id и вернуть (сегмент, первый id) для вставки
+
+        Вызывается только писателем. Сегмент новых суток создаётся
+        в той же транзакции и появляется в snapshot после COMMIT;
+        если его уже создал другой процесс, берётся first_id из каталога.
+        """
+        day = utc_day()
+        first_id = self.reserve(conn, count)
+
+        if self.snapshot and self.snapshot[-1][2] == day:
+            return self.snapshot[-1][1], first_id
+
+        name = f'events_{day}'
+        self.create_table(conn, name)
+        conn.execute('''
+            INSERT OR IGNORE INTO event_segments (name, day, first_id)
+            VALUES (?, ?, ?)
+        ''', (name, day, first_id))
+        segment_first_id = conn.execute(
+            'SELECT first_id FROM event_segments WHERE name = ?', (name,)
+        ).fetchone()[0]
+        writer.on_commit(lambda: self._add(segment_first_id, name, day))
+        return name, first_id
+
+    def _add(self, first_id, name, day):
+        with self.lock:
+            if any(segment[1] == name for segment in self.snapshot):
+                return
+            self.snapshot = tuple(sorted(self.snapshot + ((first_id, name, day),)))
+        print(f"🗂️ New event segment: {name}")
+
+    def retire(self, name):
+        """Убрать сегмент из snapshot перед удалением"""
+        with self.lock:
+            self.snapshot = tuple(segment for segment in self.snapshot if segment[1] != name)
+
+    def current(self):
+        """
+        snapshot для чтения; пока в нём нет сегмента текущих суток,
+        каталог перечитывается - сегмент мог создать другой процесс
+        """
+        snapshot = self.snapshot
+        if snapshot and snapshot[-1][2] == utc_day():
+            return snapshot
+
+        now = time.monotonic()
+        if now - self.refreshed_at < self.REFRESH_INTERVAL:
+            return snapshot
+        self.refreshed_at = now
+
+        conn = get_db()
+        try:
+            # Под lock: замена не должна затереть сегмент, добавленный писателем
+            with self.lock:
+                self.snapshot = self._read(conn)
+        finally:
+            conn.close()
+        return self.snapshot
+
+    def table_for(self, event_id):
+        """Сегмент, в котором лежит событие, или None если он уже удалён"""
+        snapshot = self.current()
+        index = bisect_right([first_id for first_id, _, _ in snapshot], event_id) - 1
+        return snapshot[index][1] if index >= 0 else None
+
+    def upper_bound(self, name):
+        """Первый id следующего сегмента (None для последнего)"""
+        snapshot = self.current()
+        for index, (_, segment, _) in enumerate(snapshot[:-1]):
+            if segment == name:
+                return snapshot[index + 1][0]
+        return None
+
+    def tables(self, before_id=None, after_id=None):
+        """
+        Сегменты, пересекающие диапазон (after_id, before_id),
+        в порядке чтения: вперёд при after_id, иначе от новых к старым
+        """
+        snapshot = self.current()
+        names = []
+
+        for index, (first_id, name, _) in enumerate(snapshot):
+            upper = snapshot[index + 1][0] if index + 1 < len(snapshot) else None
+            if before_id is not None and first_id >= before_id:
+                continue
+            if after_id is not None and upper is not None and upper - 1 <= after_id:
+                continue
+            names.append(name)
+
+        return names if after_id is not None else names[::-1]
+
+    def fetch(self, conn, event_ids):
+        """{id: row} для списка id событий, уже удалённые пропускаются"""
+        by_table = defaultdict(list)
+        for event_id in set(event_ids):
+            table = self.table_for(event_id)
+            if table:
+                by_table[table].append(event_id)
+
+        rows = {}
+        for table, ids in by_table.items():
+            try:
+                cursor = conn.execute(
+                    f"SELECT * FROM {table} WHERE id IN ({','.join('?' * len(ids))})",
+                    ids
+                )
+            except sqlite3.OperationalError as e:
+                if is_missing_table(e):
+                    continue
+                raise
+            rows.update((row['id'], row) for row in cursor.fetchall())
+
+        return rows
+
+segments = EventSegments()
+
+class RetentionManager:
+    """
+    Фоновое удаление и архивирование устаревших сегментов
+
+    Сегмент старше самого длинного срока хранения удаляется целиком
+    (при заданном archive_dir - сначала копируется в отдельный файл
+    archive_dir/<сегмент>.db). Типы событий с более коротким сроком по
+    policy вычищаются из ещё живых сегментов небольшими порциями через
+    писателя, чтобы не задерживать публикацию.
+    """
+
+    def __init__(self, default_days, policy, interval, archive_dir, chunk):
+        self.default_days = default_days
+        self.policy = policy
+        self.max_days = max([default_days] + list(policy.values()))
+        self.interval = interval
+        self.archive_dir = archive_dir
+        self.chunk = chunk
+        self.thread = None
+        self.compacted = set()
+        self.dropped = 0
+        self.archived = 0
+        self.compacted_rows = 0
+
+    def start(self):
+        if self.thread:
+            return
+
+        self.thread = Thread(target=self._loop, name='bus-retention')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"❌ Retention error: {e}")
+            time.sleep(self.interval)
+
+    def run_once(self):
+        today = datetime.utcnow().date()
+        if event_log:
+            self.expire_log(today)
+
+        for _, name, day in segments.snapshot:
+            age = (today - datetime.strptime(day, '%Y%m%d').date()).days
+
+            if age > self.max_days:
+                self.drop(name)
+            elif (name, age) not in self.compacted:
+                self.compact(name, age)
+                self.compacted.add((name, age))
+
+    def drop(self, name):
+        upper = segments.upper_bound(name)
+        segments.retire(name)
+
+        archived = False
+        if self.archive_dir:
+            self.archive(name)
+            archived = True
+
+        def drop_segment(conn):
+            segment = conn.execute(
+                'SELECT first_id, status FROM event_segments WHERE name = ?', (name,)
+            ).fetchone()
+            # Сегмент уже удалил другой процесс, работающий с той же БД
+            if segment['status'] != 'active':
+                return None
+            first_id = segment['first_id']
+            last_id = conn.execute(f'SELECT MAX(id) FROM {name}').fetchone()[0]
+            removed = dict(conn.execute(
+                f'SELECT event_type, COUNT(*) FROM {name} GROUP BY event_type'
+            ).fetchall())
+            conn.execute(f'DROP TABLE {name}')
+            conn.execute('''
+                UPDATE event_segments
+                SET status = ?, last_id = ?, dropped_at = CURRENT_TIMESTAMP
+                WHERE name = ?
+            ''', ('archived' if archived else 'dropped', last_id, name))
+            counters.subtract(removed)
+            counters.persist(conn)
+            return first_id, last_id
+
+        dropped = writer.execute(drop_segment)
+        if dropped is None:
+            return
+        first_id, last_id = dropped
+
+        # Строки outbox для событий удалённого сегмента
+        last_id = upper - 1 if upper else (last_id or first_id)
+        self._delete_chunked(
+            'DELETE FROM deliveries WHERE id IN '
+            '(SELECT id FROM deliveries WHERE event_id BETWEEN ? AND ? LIMIT ?)',
+            [first_id, last_id]
+        )
+
+        if archived:
+            self.archived += 1
+        self.dropped += 1
+        print(f"🗑️ Event segment {name} {'archived' if archived else 'dropped'}")
+
+    def expire_log(self, today):
+        """
+        Удалить файлы журнала (BUS_STORAGE=log) старше самого длинного срока
+
+        Файлы неизменяемы, поэтому более короткие сроки policy для
+        отдельных типов к журналу не применяются, архив тоже не ведётся.
+        """
+        cutoff = (today - timedelta(days=self.max_days)).strftime('%Y%m%d')
+
+        for first_id, last_id, removed in event_log.expire(cutoff):
+            def forget(conn, removed=removed):
+                counters.subtract(removed)
+                counters.persist(conn)
+
+            writer.execute(forget)
+            self._delete_chunked(
+                'DELETE FROM deliveries WHERE id IN '
+                '(SELECT id FROM deliveries WHERE event_id BETWEEN ? AND ? LIMIT ?)',
+                [first_id, last_id]
+            )
+            self.dropped += 1
+
+    def archive(self, name):
+        """Скопировать сегмент в archive_dir/<name>.db отдельным соединением"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f'{name}.db')
+
+        conn = get_db()
+        conn.execute('ATTACH DATABASE ? AS archive', (path,))
+        conn.execute(f'DROP TABLE IF EXISTS archive.{name}')
+        conn.execute(f'CREATE TABLE archive.{name} AS SELECT * FROM main.{name}')
+        conn.commit()
+        conn.execute('DETACH DATABASE archive')
+        conn.close()
+
+    def compact(self, name, age):
+        """Вычистить из сегмента типы, чей срок хранения истёк"""
+        kept = [event_type for event_type, days in self.policy.items() if age <= days]
+        expired = [event_type for event_type, days in self.policy.items() if age > days]
+
+        if age > self.default_days:
+            condition = f"event_type NOT IN ({','.join('?' * len(kept))})"
+            params = kept
+        elif expired:
+            condition = f"event_type IN ({','.join('?' * len(expired))})"
+            params = expired
+        else:
+            return
+
+        def delete_chunk(conn):
+            rows = conn.execute(
+                f'SELECT id, event_type FROM {name} WHERE {condition} LIMIT ?',
+                params + [self.chunk]
+            ).fetchall()
+            if not rows:
+                return 0
+
+            removed = defaultdict(int)
+            for row in rows:
+                removed[row['event_type']] += 1
+            conn.executemany(f'DELETE FROM {name} WHERE id = ?', [(row['id'],) for row in rows])
+            counters.subtract(removed)
+            counters.persist(conn)
+            return len(rows)
+
+        deleted = 0
+        while True:
+            count = writer.execute(delete_chunk)
+            deleted += count
+            if count < self.chunk:
+                break
+
+        if deleted:
+            self.compacted_rows += deleted
+            print(f"🧹 Compacted {deleted} expired events from {name}")
+
+    def _delete_chunked(self, sql, params):
+        """DELETE порциями по chunk строк, каждая - отдельной операцией писателя"""
+        total = 0
+        while True:
+            deleted = writer.execute(
+                lambda conn: conn.execute(sql, params + [self.chunk]).rowcount
+            )
+            total += deleted
+            if deleted < self.chunk:
+                return total
+
+    def stats(self):
+        snapshot = segments.snapshot
+        return {
+            'segments': len(snapshot),
+            'oldest_segment': snapshot[0][1] if snapshot else None,
+            'newest_segment': snapshot[-1][1] if snapshot else None,
+            'default_days': self.default_days,
+            'policy': self.policy,
+            'dropped': self.dropped,
+            'archived': self.archived,
+            'compacted_rows': self.compacted_rows
+        }
+
+retention = RetentionManager(
+    RETENTION_DAYS, RETENTION_POLICY, RETENTION_INTERVAL,
+    RETENTION_ARCHIVE_DIR, RETENTION_CHUNK
+)
+
+# ============= COUNTERS =============
+
+class EventCounters:
+    """
+    Счётчики /api/stats, обновляемые при публикации
+
+    totals - число хранимых событий по типам, minutes - кольцо из 60
+    поминутных корзин (minute, count) для окна "за последний час".
+    Публикация увеличивает их после COMMIT, удаление сегментов и
+    вычистка retention - уменьшают, поэтому /api/stats не сканирует
+    историю.
+
+    Итоги периодически сохраняются писателем в event_counters вместе
+    с водяным знаком counted_id - последним учтённым id события. При
+    старте досчитываются только события с id > counted_id, а кольцо
+    восстанавливается по событиям последнего часа.
+    """
+
+    WINDOW_MINUTES = 60
+
+    def __init__(self, persist_interval):
+        self.persist_interval = persist_interval
+        self.lock = Lock()
+        self.totals = defaultdict(int)
+        self.minutes = [(0, 0)] * self.WINDOW_MINUTES
+        self.counted_id = 0
+        self.dirty = False
+        self.thread = None
+        self.persists = 0
+
+    def load(self, conn):
+        """Восстановить счётчики при старте, до запуска писателя"""
+        self.totals = defaultdict(int, (
+            (row['event_type'], row['count'])
+            for row in conn.execute('SELECT event_type, count FROM event_counters')
+        ))
+        row = conn.execute("SELECT value FROM bus_state WHERE key = 'counted_id'").fetchone()
+        self.counted_id = int(row['value']) if row else 0
+
+        if event_log:
+            self._load_log()
+            return
+
+        # События, записанные после последнего сохранения
+        recounted = 0
+        for table in segments.tables(after_id=self.counted_id):
+            cursor = conn.execute(f'''
+                SELECT event_type, COUNT(*) as count, MAX(id) as last_id
+                FROM {table} WHERE id > ?
+                GROUP BY event_type
+            ''', (self.counted_id,))
+            for row in cursor.fetchall():
+                self.totals[row['event_type']] += row['count']
+                self.counted_id = max(self.counted_id, row['last_id'])
+                recounted += row['count']
+        if recounted:
+            self.dirty = True
+            print(f"🔢 Recounted {recounted} events since last counters snapshot")
+
+        # Кольцо "за последний час" - только по свежим сегментам
+        hour_ago_day = utc_day(time.time() - 3600)
+        for _, table, day in segments.snapshot:
+            if day < hour_ago_day:
+                continue
+            cursor = conn.execute(f'''
+                SELECT CAST(strftime('%s', published_at) AS INTEGER) / 60 as minute,
+                       COUNT(*) as count
+                FROM {table}
+                WHERE published_at >= datetime('now', '-1 hour')
+                GROUP BY minute
+            ''')
+            for row in cursor.fetchall():
+                self._bump(row['minute'], row['count'])
+
+    def _load_log(self):
+        """То же по файлам журнала (BUS_STORAGE=log)"""
+        recounted = 0
+        for event_id, _, event_type, _ in event_log.forward(self.counted_id):
+            self.totals[event_type] += 1
+            self.counted_id = event_id
+            recounted += 1
+        if recounted:
+            self.dirty = True
+            print(f"🔢 Recounted {recounted} events since last counters snapshot")
+
+        for _, timestamp, _, _ in event_log.forward(event_log.id_at(time.time() - 3600)):
+            self._bump(int(timestamp) // 60, 1)
+
+    def start(self):
+        if self.thread:
+            return
+
+        self.thread = Thread(target=self._loop, name='bus-counters')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.persist_interval)
+            if not self.dirty:
+                continue
+            try:
+                writer.execute(self.persist)
+            except Exception as e:
+                print(f"❌ Counters persist error: {e}")
+
+    def add(self, event_types, last_id):
+        """Учесть опубликованные события (вызывается после COMMIT)"""
+        with self.lock:
+            for event_type in event_types:
+                self.totals[event_type] += 1
+            self._bump(int(time.time()) // 60, len(event_types))
+            self.counted_id = max(self.counted_id, last_id)
+            self.dirty = True
+
+    def subtract(self, counts):
+        """Вычесть удалённые retention события: {event_type: count}"""
+        with self.lock:
+            for event_type, count in counts.items():
+                left = self.totals.get(event_type, 0) - count
+                if left > 0:
+                    self.totals[event_type] = left
+                else:
+                    self.totals.pop(event_type, None)
+            self.dirty = True
+
+    def _bump(self, minute, count):
+        slot = minute % self.WINDOW_MINUTES
+        slot_minute, slot_count = self.minutes[slot]
+        self.minutes[slot] = (minute, slot_count + count if slot_minute == minute else count)
+
+    def persist(self, conn):
+        """
+        Сохранить итоги и водяной знак (выполняется писателем)
+
+        Вызывается и из операций retention, чтобы уменьшение счётчиков
+        попало в ту же транзакцию, что и удаление событий.
+        """
+        with self.lock:
+            totals = list(self.totals.items())
+            counted_id = self.counted_id
+            self.dirty = False
+
+        conn.execute('DELETE FROM event_counters')
+        conn.executemany('INSERT INTO event_counters (event_type, count) VALUES (?, ?)', totals)
+        conn.execute('''
+            INSERT OR REPLACE INTO bus_state (key, value) VALUES ('counted_id', ?)
+        ''', (str(counted_id),))
+        self.persists += 1
+
+    def snapshot(self, top=10):
+        """(всего событий, за последний час, топ типов)"""
+        since = int(time.time()) // 60 - self.WINDOW_MINUTES
+        with self.lock:
+            totals = list(self.totals.items())
+            minutes = list(self.minutes)
+
+        top_events = sorted(totals, key=lambda item: -item[1])[:top]
+        return (
+            sum(count for _, count in totals),
+            sum(count for minute, count in minutes if minute > since),
+            top_events
+        )
+
+    def stats(self):
+        return {
+            'event_types': len(self.totals),
+            'counted_id': self.counted_id,
+            'persists': self.persists,
+            'persist_interval': self.persist_interval
+        }
+
+counters = EventCounters(COUNTERS_PERSIST_INTERVAL)
+
+# ============= LOG STORAGE =============
+
+class LogSegment:
+    """
+    Файл журнала событий одних суток (UTC), начиная с first_id
+
+    Читатели видят записи только до size: писатель дописывает байты
+    до COMMIT (written - конец записанного), а после COMMIT обновляет
+    индекс и сдвигает size. index хранит
+    (id, смещение, время) каждой index_interval-й записи, blocks -
+    множество типов событий в каждом блоке индекса, чтобы чтение
+    с фильтром по типу пропускало блоки без него.
+    """
+
+    def __init__(self, path, day, first_id):
+        self.path = path
+        self.day = day
+        self.first_id = first_id
+        self.last_id = first_id - 1
+        self.last_timestamp = 0
+        self.size = 0
+        self.written = 0
+        self.count = 0
+        self.index_ids = []
+        self.index = []
+        self.blocks = []
+        self.types = defaultdict(int)
+        self.map = None
+        self.mapped = 0
+        self.lock = Lock()
+        self.fd = None
+
+    def indexed(self, event_id, offset, timestamp, event_type, interval):
+        """Учесть дописанную запись (только писатель; size сдвигается отдельно)"""
+        if self.count % interval == 0:
+            # index - последним: читатель, увидевший блок, найдёт и его типы
+            self.blocks.append(set())
+            self.index_ids.append(event_id)
+            self.index.append((event_id, offset, timestamp))
+        self.blocks[-1].add(event_type)
+        self.types[event_type] += 1
+        self.count += 1
+        self.last_id = event_id
+        self.last_timestamp = timestamp
+
+    def view(self):
+        """(mmap, size) - отображение файла, покрывающее size байт"""
+        size = self.size
+        if self.mapped < size:
+            with self.lock:
+                if self.mapped < size:
+                    with open(self.path, 'rb') as f:
+                        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.mapped = len(self.map)
+        return self.map, size
+
+    def block_range(self, block, size):
+        """
+        Смещения [начало, конец) блока индекса в пределах size
+
+        Читатель берёт size и mmap один раз, а писатель может тем
+        временем добавить блоки за этой границей - их не читаем.
+        """
+        end = self.index[block + 1][1] if block + 1 < len(self.index) else size
+        return min(self.index[block][1], size), min(end, size)
+
+class SegmentedEventLog:
+    """
+    Хранилище истории событий в append-only файлах (BUS_STORAGE=log)
+
+    Запись: длина (uint32) | crc32 (uint32) | id (int64) | время (double) |
+    длина типа (uint16) | тип события | payload (JSON). Файлы сегментов
+    <YYYYMMDD>-<first_id>.log сменяются с началом суток или при
+    превышении segment_bytes и удаляются retention целиком.
+
+    Дописывает только поток писателя, внутри операции и до COMMIT
+    группы, а читателям записи становятся видны после COMMIT. Если
+    операция или группа откатится в SQLite (outbox, ключ
+    идемпотентности), файл обрезается обратно; так же при ошибке
+    записи. При BUS_LOG_FSYNC файл сбрасывается на диск один раз на
+    группу, перед COMMIT - событие с закоммиченным ключом и outbox
+    не теряется при падении. При старте сегменты проверяются по crc,
+    оборванный хвост обрезается, как и записи с id после последнего
+    закоммиченного (падение между записью и COMMIT). Чтение идёт
+    через mmap без копирования payload:
+    разреженный индекс даёт блок по id, внутри блока записи
+    просматриваются подряд.
+
+    Outbox, подписки и счётчики остаются в SQLite; notified_count
+    для выдачи считается по доставленным строкам outbox.
+    """
+
+    HEADER = struct.Struct('<II')
+    BODY = struct.Struct('<qdH')
+    # Заголовок и тело одним разбором при чтении
+    RECORD = struct.Struct('<IIqdH')
+
+    def __init__(self, path, segment_bytes, index_interval, fsync):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.fsync = fsync
+        self.segments = ()
+        self.next_id = 1
+        self.dirty = False
+        self.lock_fd = None
+        # Ошибка, после которой файл не удалось вернуть к записанному
+        self.broken = None
+        self.types = {}
+        # Замена кортежа segments: писатель (новый сегмент) и retention
+        self.lock = Lock()
+
+    def open(self, committed_id=None):
+        """
+        Прочитать сегменты при старте, до запуска писателя
+
+        committed_id - последний id, закоммиченный в SQLite; записи
+        после него дописаны до несостоявшегося COMMIT и отбрасываются.
+        """
+        self.path = self.path or os.path.join(os.path.dirname(DB_PATH), 'message_bus_log')
+        os.makedirs(self.path, exist_ok=True)
+
+        # Файлы журнала дописывает один процесс: размер, индекс и хвост
+        # сегмента живут в его памяти. Несколько процессов шины - только
+        # с BUS_STORAGE=sqlite
+        self.lock_fd = os.open(os.path.join(self.path, 'LOCK'), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.lock_fd)
+            raise RuntimeError(f'event log {self.path} is already opened by another bus process')
+
+        opened = []
+        for name in sorted(os.listdir(self.path), key=self._first_id):
+            if not name.endswith('.log'):
+                continue
+            day, first_id = name[:-4].split('-')
+            segment = LogSegment(os.path.join(self.path, name), day, int(first_id))
+            self._recover(segment, committed_id)
+            if not segment.size and committed_id is not None and segment.first_id > committed_id:
+                # Сегмент открыла операция, чей COMMIT не состоялся
+                os.remove(segment.path)
+                continue
+            opened.append(segment)
+
+        self.segments = tuple(opened)
+        if opened:
+            last = opened[-1]
+            self.next_id = max(last.last_id, last.first_id - 1) + 1
+            last.fd = os.open(last.path, os.O_WRONLY | os.O_APPEND)
+
+        print(f"📚 Event log: {len(opened)} segments in {self.path}")
+
+    @staticmethod
+    def _first_id(name):
+        try:
+            return int(name[:-4].split('-')[1])
+        except (IndexError, ValueError):
+            return 0
+
+    def _recover(self, segment, committed_id=None):
+        """
+        Построить индекс сегмента, проверив crc; обрезать оборванный
+        хвост и записи после committed_id
+        """
+        file_size = os.path.getsize(segment.path)
+        segment.size = file_size
+        offset = 0
+        uncommitted = False
+
+        if file_size:
+            data, _ = segment.view()
+            for event_id, timestamp, event_type, _, end in self._records(data, 0, file_size, verify=True):
+                if committed_id is not None and event_id > committed_id:
+                    uncommitted = True
+                    break
+                segment.indexed(event_id, offset, timestamp, event_type, self.index_interval)
+                offset = end
+
+        if offset < file_size:
+            reason = 'written after the last commit' if uncommitted else 'of torn tail'
+            print(f"⚠️ Event log {segment.path}: truncating {file_size - offset} bytes {reason}")
+            os.truncate(segment.path, offset)
+            segment.map = None
+            segment.mapped = 0
+        segment.size = segment.written = offset
+
+    def _records(self, data, offset, end, verify=False, only_type=None):
+        """
+        Записи в [offset, end): (id, время, тип, payload, конец записи)
+
+        payload - memoryview на mmap без копирования. При verify
+        чтение останавливается на первой повреждённой записи.
+        only_type (bytes) пропускает записи других типов, не разбирая их.
+        """
+        view = memoryview(data)
+        unpack = self.RECORD.unpack_from
+        header_size = self.HEADER.size
+        fixed_size = self.RECORD.size
+        types = self.types
+
+        while offset + fixed_size <= end:
+            length, checksum, event_id, timestamp, type_length = unpack(data, offset)
+            start = offset + header_size
+            record_end = start + length
+            if length < self.BODY.size or record_end > end:
+                return
+            if verify and zlib.crc32(view[start:record_end]) != checksum:
+                return
+
+            type_start = offset + fixed_size
+            raw_type = data[type_start:type_start + type_length]
+            if only_type is not None and raw_type != only_type:
+                offset = record_end
+                continue
+            event_type = types.get(raw_type)
+            if event_type is None:
+                event_type = types[raw_type] = raw_type.decode()
+
+            offset = record_end
+            yield event_id, timestamp, event_type, view[type_start + type_length:record_end], offset
+
+    # ---------- запись ----------
+
+    def append(self, events, timestamp):
+        """
+        Дописать события в операции писателя (только писатель)
+
+        events: [(event_id, event_type, payload_json)] с возрастающими id.
+        Байты пишутся сразу, в индекс и size они попадают колбэком
+        коммита; при откате операции или группы файл обрезается.
+        """
+        if self.broken:
+            raise RuntimeError(f'event log is not writable until restart: {self.broken}')
+
+        records = []
+        for event_id, event_type, payload in events:
+            raw_type = event_type.encode()
+            body = self.BODY.pack(event_id, timestamp, len(raw_type)) + raw_type + payload.encode()
+            records.append((event_id, event_type, self.HEADER.pack(len(body), zlib.crc32(body)) + body))
+
+        segment = self._segment_for(utc_day(timestamp), records[0][0])
+        start = segment.written
+        data = b''.join(record for _, _, record in records)
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(segment.fd, data[written:])
+        except OSError:
+            # Частично записанные байты не должны остаться перед следующей записью
+            self._truncate(segment, start)
+            raise
+        segment.written = start + len(data)
+        self.dirty = True
+
+        writer.on_rollback(lambda: self._truncate(segment, start))
+        writer.on_commit(lambda: self._publish(segment, records, start, timestamp))
+        if self.fsync:
+            writer.before_commit(self.sync)
+
+    def _segment_for(self, day, first_id):
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or segment.day != day or segment.written >= self.segment_bytes:
+            return self._roll(day, first_id)
+        return segment
+
+    def _truncate(self, segment, offset):
+        """Вернуть файл сегмента к offset - концу последней удачной записи"""
+        try:
+            os.truncate(segment.path, offset)
+        except OSError as e:
+            # Следующая запись легла бы за мусором: до перезапуска не пишем,
+            # при старте хвост после закоммиченного id обрежет _recover
+            self.broken = e
+            raise
+        segment.written = offset
+        if offset == 0 and segment is self.segments[-1] and len(self.segments) > 1:
+            self._unroll(segment)
+
+    def _publish(self, segment, records, offset, timestamp):
+        """Сделать записи видимыми читателям после COMMIT"""
+        for event_id, event_type, record in records:
+            segment.indexed(event_id, offset, timestamp, event_type, self.index_interval)
+            offset += len(record)
+        segment.size = offset
+        self.next_id = records[-1][0] + 1
+
+    def sync(self):
+        """fsync активного сегмента - один раз на группу коммита"""
+        if self.dirty and self.segments:
+            self.dirty = False
+            os.fsync(self.segments[-1].fd)
+
+    def _roll(self, day, first_id):
+        if self.segments and self.segments[-1].fd is not None:
+            previous = self.segments[-1]
+            os.fsync(previous.fd)
+            os.close(previous.fd)
+            previous.fd = None
+
+        segment = LogSegment(os.path.join(self.path, f'{day}-{first_id:012d}.log'), day, first_id)
+        segment.fd = os.open(segment.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        with self.lock:
+            self.segments = self.segments + (segment,)
+        print(f"🗂️ New event log segment: {os.path.basename(segment.path)}")
+        return segment
+
+    def _unroll(self, segment):
+        """Убрать пустой сегмент, открытый откатившейся операцией"""
+        with self.lock:
+            self.segments = self.segments[:-1]
+        os.close(segment.fd)
+        os.remove(segment.path)
+
+        previous = self.segments[-1]
+        previous.fd = os.open(previous.path, os.O_WRONLY | os.O_APPEND)
+
+    # ---------- чтение ----------
+
+    def forward(self, after_id, event_type=None):
+        """Записи с id > after_id по возрастанию id: (id, время, тип, payload)"""
+        only_type = event_type.encode() if event_type else None
+        for segment in self.segments:
+            if segment.last_id <= after_id:
+                continue
+            data, size = segment.view()
+            if not size:
+                continue
+
+            blocks = len(segment.index)
+            block = max(bisect_right(segment.index_ids, after_id) - 1, 0)
+            for block in range(block, blocks):
+                if event_type and event_type not in segment.blocks[block]:
+                    continue
+                start, end = segment.block_range(block, size)
+                for event_id, timestamp, record_type, payload, _ in self._records(data, start, end, only_type=only_type):
+                    if event_id > after_id:
+                        yield event_id, timestamp, record_type, payload
+
+    def backward(self, before_id=None, event_type=None):
+        """Записи с id < before_id (или все) по убыванию id"""
+        only_type = event_type.encode() if event_type else None
+        for segment in reversed(self.segments):
+            if before_id is not None and segment.first_id >= before_id:
+                continue
+            data, size = segment.view()
+            if not size:
+                continue
+
+            blocks = len(segment.index)
+            if before_id is None:
+                block = blocks - 1
+            else:
+                block = min(bisect_right(segment.index_ids, before_id - 1) - 1, blocks - 1)
+            for block in range(block, -1, -1):
+                if event_type and event_type not in segment.blocks[block]:
+                    continue
+                start, end = segment.block_range(block, size)
+                records = [
+                    (event_id, timestamp, record_type, payload)
+                    for event_id, timestamp, record_type, payload, _
+                    in self._records(data, start, end, only_type=only_type)
+                    if before_id is None or event_id < before_id
+                ]
+                yield from reversed(records)
+
+    def read(self, event_type=None, before_id=None, after_id=None, limit=50):
+        """Страница истории в формате query_events (без notified_count)"""
+        if after_id is not None:
+            records = self.forward(after_id, event_type)
+        else:
+            records = self.backward(before_id, event_type)
+
+        events = []
+        for event_id, timestamp, record_type, payload in records:
+            if before_id is not None and event_id >= before_id:
+                break
+            events.append({
+                'id': event_id,
+                'event_type': record_type,
+                'payload': json.loads(bytes(payload)) if payload else None,
+                'published_at': format_published_at(int(timestamp))
+            })
+            if len(events) >= limit:
+                break
+        return events
+
+    def fetch(self, event_ids):
+        """{id: {'event_type', 'payload'}} для списка id, удалённые пропускаются"""
+        found = {}
+        wanted = set(event_ids)
+        first_ids = [segment.first_id for segment in self.segments]
+
+        by_block = defaultdict(set)
+        for event_id in wanted:
+            index = bisect_right(first_ids, event_id) - 1
+            if index < 0:
+                continue
+            segment = self.segments[index]
+            block = bisect_right(segment.index_ids, event_id) - 1
+            if block >= 0:
+                by_block[(index, block)].add(event_id)
+
+        for (index, block), ids in by_block.items():
+            segment = self.segments[index]
+            data, size = segment.view()
+            start, end = segment.block_range(block, size)
+            last = max(ids)
+
+            # Внутри блока разбираются только заголовки до нужных id
+            offset = start
+            while offset + self.RECORD.size <= end:
+                length, _, event_id, _, type_length = self.RECORD.unpack_from(data, offset)
+                record_end = offset + self.HEADER.size + length
+                if event_id in ids:
+                    type_start = offset + self.RECORD.size
+                    found[event_id] = {
+                        'event_type': data[type_start:type_start + type_length].decode(),
+                        'payload': data[type_start + type_length:record_end].decode()
+                    }
+                if event_id >= last:
+                    break
+                offset = record_end
+
+        return found
+
+    def id_at(self, timestamp):
+        """id последнего события, записанного раньше timestamp (unix-время)"""
+        for segment in self.segments:
+            if segment.last_timestamp < timestamp:
+                continue
+            data, size = segment.view()
+            stamps = [entry[2] for entry in segment.index]
+            block = max(bisect_left(stamps, timestamp) - 1, 0)
+            for event_id, record_timestamp, _, _ in self._records_from(segment, data, block, size):
+                if record_timestamp >= timestamp:
+                    return event_id - 1
+        return self.next_id - 1
+
+    def _records_from(self, segment, data, block, size):
+        start = segment.index[block][1]
+        for event_id, timestamp, event_type, payload, _ in self._records(data, start, size):
+            yield event_id, timestamp, event_type, payload
+
+    # ---------- retention ----------
+
+    def expire(self, cutoff_day):
+        """
+        Удалить сегменты суток раньше cutoff_day (кроме активного)
+
+        Возвращает [(first_id, last_id, {event_type: count})]
+        """
+        with self.lock:
+            expired = [segment for segment in self.segments[:-1] if segment.day < cutoff_day]
+            if not expired:
+                return []
+            self.segments = tuple(segment for segment in self.segments if segment not in expired)
+
+        dropped = []
+        for segment in expired:
+            # Открытые читателями mmap остаются валидными до их закрытия
+            os.remove(segment.path)
+            dropped.append((segment.first_id, segment.last_id, dict(segment.types)))
+            print(f"🗑️ Event log segment {os.path.basename(segment.path)} dropped")
+        return dropped
+
+    def stats(self):
+        segments = self.segments
+        return {
+            'backend': 'log',
+            'path': self.path,
+            'segments': len(segments),
+            'bytes': sum(segment.size for segment in segments),
+            'events': sum(segment.count for segment in segments),
+            'index_entries': sum(len(segment.index) for segment in segments),
+            'oldest_segment': os.path.basename(segments[0].path) if segments else None,
+            'fsync': self.fsync
+        }
+
+@lru_cache(maxsize=4096)
+def format_published_at(second):
+    """Время записи журнала (целые секунды) в формате published_at SQLite (UTC)"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(second))
+
+if STORAGE_BACKEND not in ('sqlite', 'log'):
+    raise ValueError(f'BUS_STORAGE must be sqlite or log, got {STORAGE_BACKEND}')
+
+event_log = SegmentedEventLog(
+    LOG_DIR, LOG_SEGMENT_BYTES, LOG_INDEX_INTERVAL, LOG_FSYNC
+) if STORAGE_BACKEND == 'log' else None
+
+# ============= DELIVERY =============
+
+class FanoutEngine:
+    """
+    Параллельная рассылка одного события всем подписчикам
+
+    Запросы выполняются в общем пуле потоков. Глобальный семафор
+    ограничивает число запросов в полёте, per_subscriber - число
+    одновременных запросов к одному подписчику. Задержка доставки
+    события определяется самым медленным подписчиком, а не суммой всех.
+
+    Запрос сверх лимита подписчика ждёт в очереди этого подписчика и не
+    занимает ни поток пула, ни глобальный слот: освободившийся поток
+    подписчика сам забирает следующий запрос из его очереди. Медленный
+    подписчик держит не больше per_subscriber слотов и не тормозит
+    остальных.
+    """
+
+    def __init__(self, max_in_flight, per_subscriber, max_queued):
+        self.max_in_flight = max_in_flight
+        self.per_subscriber = per_subscriber
+        self.max_queued = max_queued
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_in_flight,
+            thread_name_prefix='bus-fanout'
+        )
+        self.in_flight = BoundedSemaphore(max_in_flight)
+        # callback_url -> {'running': запущено, 'pending': deque[(fn, task, future)]}
+        self.subscribers = {}
+        self.lock = Lock()
+        self.queue_space = Condition(self.lock)
+        self.active = 0
+        self.queued = 0
+
+    def run(self, fn, tasks):
+        """
+        Выполнить fn(*task) для всех задач параллельно
+
+        tasks: [(callback_url, ...)] - первый элемент задачи определяет подписчика
+        """
+        futures = [self.submit(fn, task) for task in tasks]
+        return [future.result() for future in futures]
+
+    def submit(self, fn, task):
+        """Поставить fn(*task) в пул, не дожидаясь результата (Future)"""
+        future = Future()
+        with self.lock:
+            while True:
+                # Состояние перечитывается после ожидания: подписчик мог освободиться
+                state = self.subscribers.setdefault(task[0], {'running': 0, 'pending': deque()})
+                if state['running'] < self.per_subscriber:
+                    state['running'] += 1
+                    break
+                # Подписчик занят: ждать в его очереди, не занимая общих слотов
+                if self.queued < self.max_queued:
+                    state['pending'].append((fn, task, future))
+                    self.queued += 1
+                    return future
+                self.queue_space.wait()
+
+        # Не ставить в пул больше запросов, чем он может выполнить
+        self.in_flight.acquire()
+        try:
+            self.executor.submit(self._call, fn, task, future)
+        except Exception:
+            self.in_flight.release()
+            self._finish(task[0])
+            raise
+        return future
+
+    def _call(self, fn, task, future):
+        # Поток держит глобальный слот и выполняет очередь своего подписчика
+        try:
+            while True:
+                if future.set_running_or_notify_cancel():
+                    with self.lock:
+                        self.active += 1
+                    try:
+                        future.set_result(fn(*task))
+                    except BaseException as e:
+                        future.set_exception(e)
+                    finally:
+                        with self.lock:
+                            self.active -= 1
+
+                following = self._finish(task[0])
+                if following is None:
+                    return
+                fn, task, future = following
+        finally:
+            self.in_flight.release()
+
+    def _finish(self, callback_url):
+        """Следующий запрос подписчика или None (слот подписчика освобождён)"""
+        with self.lock:
+            state = self.subscribers[callback_url]
+            if state['pending']:
+                self.queued -= 1
+                self.queue_space.notify()
+                return state['pending'].popleft()
+            state['running'] -= 1
+            if not state['running']:
+                del self.subscribers[callback_url]
+            return None
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': self.active,
+                'queued': self.queued,
+                'max_in_flight': self.max_in_flight,
+                'per_subscriber_limit': self.per_subscriber,
+                'max_queued': self.max_queued
+            }
+
+fanout = FanoutEngine(FANOUT_MAX_IN_FLIGHT, FANOUT_PER_SUBSCRIBER, FANOUT_MAX_QUEUED)
+
+class HttpClientPool:
+    """
+    Пул keep-alive HTTP-сессий, по одной на origin подписчика
+
+    Каждая сессия держит не больше pool_size соединений, число
+    сессий ограничено max_origins (вытесняется давно не использованная),
+    сессии без запросов дольше idle_timeout закрываются. Метрики
+    показывают, сколько запросов обслужено переиспользованными
+    соединениями.
+    """
+
+    def __init__(self, pool_size, max_origins, idle_timeout):
+        self.pool_size = pool_size
+        self.max_origins = max_origins
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()
+        self.lock = Lock()
+        self.last_sweep = time.monotonic()
+        self.requests = 0
+        self.evicted = 0
+        self.closed_connections = 0
+
+    def _session(self, url):
+        parts = urlsplit(url)
+        origin = f'{parts.scheme}://{parts.netloc}'
+        now = time.monotonic()
+
+        with self.lock:
+            if now - self.last_sweep > self.idle_timeout / 4:
+                self._evict_idle(now)
+
+            entry = self.sessions.get(origin)
+            if entry is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                entry = {'session': session, 'adapter': adapter, 'last_used': now}
+                self.sessions[origin] = entry
+
+                if len(self.sessions) > self.max_origins:
+                    self._close(*self.sessions.popitem(last=False))
+            else:
+                self.sessions.move_to_end(origin)
+                entry['last_used'] = now
+
+            self.requests += 1
+            return entry['session']
+
+    def _evict_idle(self, now):
+        self.last_sweep = now
+        for origin, entry in list(self.sessions.items()):
+            if now - entry['last_used'] > self.idle_timeout:
+                del self.sessions[origin]
+                self._close(origin, entry)
+
+    def _close(self, origin, entry):
+        self.closed_connections += self._opened(entry)
+        self.evicted += 1
+        entry['session'].close()
+
+    def _opened(self, entry):
+        """Сколько TCP-соединений открыла сессия"""
+        pools = entry['adapter'].poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def post(self, url, **kwargs):
+        return self._session(url).post(url, **kwargs)
+
+    def stats(self):
+        with self.lock:
+            opened = self.closed_connections + sum(
+                self._opened(entry) for entry in self.sessions.values()
+            )
+            return {
+                'origins': len(self.sessions),
+                'requests': self.requests,
+                'connections_opened': opened,
+                'reused': max(self.requests - opened, 0),
+                'reuse_ratio': round(1 - opened / self.requests, 3) if self.requests else 0,
+                'evicted_sessions': self.evicted
+            }
+
+http_pool = HttpClientPool(HTTP_POOL_SIZE, HTTP_MAX_ORIGINS, HTTP_IDLE_TIMEOUT)
+
+class LocalSocketPool:
+    """
+    Доставка подписчикам на той же машине через Unix-сокет
+
+    Подписчик слушает сокет, шина подключается к нему и держит постоянные
+    соединения (до pool_size свободных на сокет). Кадр - 4 байта длины
+    (big-endian) и JSON: одиночное событие {"event", "payload"}, пачка -
+    тот же массив, что и при HTTP-доставке. На каждый кадр подписчик
+    отвечает кадром {"ok": true} или {"ok": false, "error": "..."}.
+    """
+
+    FRAME = struct.Struct('>I')
+
+    def __init__(self, pool_size, timeout, max_frame):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_frame = max_frame
+        self.idle = defaultdict(list)
+        self.lock = Lock()
+        self.frames = 0
+        self.connections_opened = 0
+        self.reconnects = 0
+
+    def send(self, path, frame):
+        """Отправить кадр и вернуть ответ подписчика (dict)"""
+        sock, reused = self._acquire(path)
+        try:
+            reply = self._exchange(sock, frame)
+        except ConnectionError:
+            sock.close()
+            if not reused:
+                raise
+            # Подписчик закрыл простаивавшее соединение (например, перезапустился)
+            with self.lock:
+                self.reconnects += 1
+            sock = self._connect(path)
+            try:
+                reply = self._exchange(sock, frame)
+            except Exception:
+                sock.close()
+                raise
+        except Exception:
+            sock.close()
+            raise
+
+        self._release(path, sock)
+        return reply
+
+    def _exchange(self, sock, frame):
+        sock.sendall(self.FRAME.pack(len(frame)) + frame)
+        size, = self.FRAME.unpack(self._read(sock, self.FRAME.size))
+        if size > self.max_frame:
+            raise ConnectionError(f'reply frame of {size} bytes is too large')
+        with self.lock:
+            self.frames += 1
+        return json.loads(self._read(sock, size))
+
+    @staticmethod
+    def _read(sock, size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionResetError('subscriber closed the connection')
+            data += chunk
+        return data
+
+    def _acquire(self, path):
+        with self.lock:
+            if self.idle[path]:
+                return self.idle[path].pop(), True
+        return self._connect(path), False
+
+    def _connect(self, path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(path)
+        except Exception:
+            sock.close()
+            raise
+        with self.lock:
+            self.connections_opened += 1
+        return sock
+
+    def _release(self, path, sock):
+        with self.lock:
+            if len(self.idle[path]) < self.pool_size:
+                self.idle[path].append(sock)
+                return
+        sock.close()
+
+    def forget(self, path):
+        """Закрыть свободные соединения сокета (подписок на него больше нет)"""
+        with self.lock:
+            idle = self.idle.pop(path, [])
+        for sock in idle:
+            sock.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'sockets': sum(1 for idle in self.idle.values() if idle),
+                'idle_connections': sum(len(idle) for idle in self.idle.values()),
+                'frames': self.frames,
+                'connections_opened': self.connections_opened,
+                'reconnects': self.reconnects
+            }
+
+local_pool = LocalSocketPool(LOCAL_POOL_SIZE, LOCAL_TIMEOUT, LOCAL_MAX_FRAME)
+
+class LatencyHistogram:
+    """
+    Логарифмическая гистограмма задержек в духе HDR Histogram
+
+    Значения в микросекундах; у каждого бакета 16 подбакетов на
+    степень двойки, так что погрешность перцентилей не больше ~6%
+    при фиксированном объёме памяти (меньше 400 счётчиков на 60 с).
+    Запись - одно целочисленное вычисление и инкремент счётчика.
+    """
+
+    SUB_BITS = 4
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.total = 0
+        self.max = 0
+
+    @classmethod
+    def _index(cls, value):
+        if value < 2 << cls.SUB_BITS:
+            return value
+        shift = value.bit_length() - cls.SUB_BITS - 1
+        return (shift << cls.SUB_BITS) + (value >> shift)
+
+    @classmethod
+    def _lower_bound(cls, index):
+        if index < 2 << cls.SUB_BITS:
+            return index
+        shift = (index >> cls.SUB_BITS) - 1
+        mantissa = index - (shift << cls.SUB_BITS)
+        return mantissa << shift
+
+    def record(self, microseconds):
+        self.counts[self._index(microseconds)] += 1
+        self.total += 1
+        if microseconds > self.max:
+            self.max = microseconds
+
+    def percentiles(self, quantiles):
+        """{q: значение в микросекундах} для отсортированных quantiles"""
+        result = {}
+        if not self.total:
+            return {q: 0 for q in quantiles}
+
+        seen = 0
+        pending = list(quantiles)
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            while pending and seen >= pending[0] * self.total:
+                # Середина бакета, но не больше реального максимума
+                lower = self._lower_bound(index)
+                upper = self._lower_bound(index + 1)
+                result[pending.pop(0)] = min((lower + upper) // 2, self.max)
+            if not pending:
+                break
+        return result
+
+class SubscriberMetrics:
+    """Счётчики и гистограмма задержек доставки одному callback_url"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.histogram = LatencyHistogram()
+        self.in_flight = 0
+        self.success = 0
+        self.failure = 0
+        self.timeout = 0
+
+    def begin(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def end(self, seconds, error):
+        with self.lock:
+            self.in_flight -= 1
+            self.histogram.record(int(seconds * 1000000))
+            if error is None:
+                self.success += 1
+            elif error == 'timeout':
+                self.timeout += 1
+            else:
+                self.failure += 1
+
+    def snapshot(self):
+        with self.lock:
+            latency = self.histogram.percentiles([0.5, 0.95, 0.99])
+            return {
+                'in_flight': self.in_flight,
+                'success': self.success,
+                'failure': self.failure,
+                'timeout': self.timeout,
+                'latency_ms': {
+                    'count': self.histogram.total,
+                    'p50': latency[0.5] / 1000,
+                    'p95': latency[0.95] / 1000,
+                    'p99': latency[0.99] / 1000,
+                    'max': self.histogram.max / 1000
+                }
+            }
+
+class DeliveryMetrics:
+    """
+    Метрики доставки по подписчикам
+
+    У каждого callback_url свой объект со своей блокировкой, так что
+    воркеры, доставляющие разным подписчикам, не конкурируют между собой.
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = Lock()
+
+    def get(self, callback_url):
+        metrics = self.subscribers.get(callback_url)
+        if metrics is None:
+            with self.lock:
+                metrics = self.subscribers.setdefault(callback_url, SubscriberMetrics())
+        return metrics
+
+    def snapshot(self):
+        return {
+            callback_url: metrics.snapshot()
+            for callback_url, metrics in list(self.subscribers.items())
+        }
+
+delivery_metrics = DeliveryMetrics()
+
+class CircuitBreaker:
+    """
+    Автомат closed / open / half_open для одного callback_url
+
+    closed: запросы идут, исходы последних window вызовов копятся
+    в скользящем окне. Когда в окне не меньше min_calls исходов и доля
+    ошибок или медленных ответов (дольше slow_ms) достигает порога,
+    автомат размыкается.
+    open: запросы не выполняются open_seconds секунд.
+    half_open: пропускается не больше probes пробных запросов;
+    успех всех проб замыкает автомат, любая неудача снова размыкает.
+    """
+
+    def __init__(self, window, min_calls, error_rate, slow_ms, slow_rate, open_seconds, probes):
+        self.window = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_ms / 1000
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.lock = Lock()
+        self.state = 'closed'
+        self.opened_until = 0
+        self.probes_in_flight = 0
+        self.probes_passed = 0
+        self.failures = 0
+        self.slow = 0
+        self.rejected = 0
+        self.opened = 0
+
+    def allow(self):
+        """Можно ли выполнить запрос сейчас"""
+        with self.lock:
+            if self.state == 'open':
+                if time.time() < self.opened_until:
+                    self.rejected += 1
+                    return False
+                self.state = 'half_open'
+                self.probes_in_flight = 0
+                self.probes_passed = 0
+
+            if self.state == 'half_open':
+                if self.probes_in_flight >= self.probes:
+                    self.rejected += 1
+                    return False
+                self.probes_in_flight += 1
+
+            return True
+
+    def record(self, seconds, error):
+        """Учесть исход запроса. Возвращает новое состояние при переходе, иначе None"""
+        failed = error is not None
+        slow = seconds >= self.slow_seconds
+
+        with self.lock:
+            if self.state == 'half_open':
+                self.probes_in_flight -= 1
+                if failed or slow:
+                    return self._open()
+                self.probes_passed += 1
+                if self.probes_passed >= self.probes:
+                    self.state = 'closed'
+                    self.window.clear()
+                    self.failures = self.slow = 0
+                    return 'closed'
+                return None
+
+            if self.state == 'open':
+                # Запрос, начатый до размыкания
+                return None
+
+            if len(self.window) == self.window.maxlen:
+                old_failed, old_slow = self.window[0]
+                self.failures -= old_failed
+                self.slow -= old_slow
+            self.window.append((failed, slow))
+            self.failures += failed
+            self.slow += slow
+
+            calls = len(self.window)
+            if calls >= self.min_calls and (
+                self.failures / calls >= self.error_rate or self.slow / calls >= self.slow_rate
+            ):
+                return self._open()
+            return None
+
+    def _open(self):
+        self.state = 'open'
+        self.opened_until = time.time() + self.open_seconds
+        self.opened += 1
+        return 'open'
+
+    def snapshot(self):
+        with self.lock:
+            calls = len(self.window)
+            return {
+                'state': self.state,
+                'error_rate': round(self.failures / calls, 3) if calls else 0,
+                'slow_rate': round(self.slow / calls, 3) if calls else 0,
+                'window_calls': calls,
+                'open_until': self.opened_until if self.state == 'open' else None,
+                'times_opened': self.opened,
+                'rejected': self.rejected
+            }
+
+class CircuitBreakers:
+    """Автоматы по callback_url, создаются при первой доставке"""
+
+    def __init__(self):
+        self.breakers = {}
+        self.lock = Lock()
+
+    def get(self, callback_url):
+        breaker = self.breakers.get(callback_url)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(callback_url, CircuitBreaker(
+                    BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_ERROR_RATE,
+                    BREAKER_SLOW_MS, BREAKER_SLOW_RATE, BREAKER_OPEN_SECONDS,
+                    BREAKER_HALF_OPEN_PROBES
+                ))
+        return breaker
+
+    def snapshot(self, callback_url):
+        breaker = self.breakers.get(callback_url)
+        return breaker.snapshot() if breaker else {'state': 'closed'}
+
+    def stats(self):
+        states = defaultdict(int)
+        for breaker in list(self.breakers.values()):
+            states[breaker.state] += 1
+        return {
+            'closed': states['closed'],
+            'open': states['open'],
+            'half_open': states['half_open']
+        }
+
+breakers = CircuitBreakers()
+
+def unpark_deliveries(callback_url):
+    """Вернуть отложенные при разомкнутом автомате доставки в работу немедленно"""
+    writer.submit(lambda conn: conn.execute('''
+        UPDATE deliveries SET next_attempt_at = ?
+        WHERE status = 'pending' AND callback_url = ? AND last_error = ?
+    ''', (time.time(), callback_url, CIRCUIT_OPEN)))
+
+def deliver(callback_url, event, payload):
+    """Доставить событие одному подписчику. Возвращает текст ошибки или None"""
+    return _measured(callback_url, event, json=payload)
+
+def deliver_batch(callback_url, body, count):
+    """Доставить пачку событий одним POST: body - готовый JSON-массив"""
+    return _measured(
+        callback_url, f'{count} events',
+        data=body, headers={'Content-Type': 'application/json'}
+    )
+
+def _measured(callback_url, event, **body):
+    breaker = breakers.get(callback_url)
+    if not breaker.allow():
+        return CIRCUIT_OPEN
+
+    metrics = delivery_metrics.get(callback_url)
+    metrics.begin()
+    started = time.perf_counter()
+
+    error = _deliver(callback_url, event, **body)
+
+    elapsed = time.perf_counter() - started
+    metrics.end(elapsed, error)
+
+    transition = breaker.record(elapsed, error)
+    if transition == 'open':
+        print(f"🔌 Circuit open for {callback_url}, parking deliveries")
+    elif transition == 'closed':
+        print(f"🔌 Circuit closed for {callback_url}, resuming backlog")
+        unpark_deliveries(callback_url)
+    return error
+
+def _deliver(callback_url, event, **body):
+    if callback_url.startswith(LOCAL_SCHEME):
+        return _deliver_local(callback_url, event, **body)
+
+    try:
+        response = http_pool.post(
+            callback_url,
+            timeout=5,
+            **body
+        )
+
+        if response.status_code == 200:
+            print(f"✅ Notified: {callback_url} about {event}")
+            return None
+
+        print(f"⚠️ Failed to notify {callback_url}: HTTP {response.status_code}")
+        return f'HTTP {response.status_code}'
+
+    except requests.exceptions.Timeout:
+        print(f"⏱️ Timeout notifying {callback_url}")
+        return 'timeout'
+    except Exception as e:
+        print(f"❌ Error notifying {callback_url}: {e}")
+        return str(e)
+
+def _deliver_local(callback_url, event, **body):
+    # Пачка уже сериализована батчером, одиночное событие - объект с его типом
+    if 'data' in body:
+        frame = body['data']
+    else:
+        frame = json.dumps({'event': event, 'payload': body['json']}).encode()
+
+    try:
+        reply = local_pool.send(callback_url[len(LOCAL_SCHEME):], frame)
+    except socket.timeout:
+        print(f"⏱️ Timeout notifying {callback_url}")
+        return 'timeout'
+    except Exception as e:
+        print(f"❌ Error notifying {callback_url}: {e}")
+        return str(e) or type(e).__name__
+
+    if isinstance(reply, dict) and reply.get('ok'):
+        print(f"✅ Notified: {callback_url} about {event}")
+        return None
+
+    error = reply.get('error') if isinstance(reply, dict) else None
+    print(f"⚠️ Failed to notify {callback_url}: {error or 'rejected'}")
+    return error or 'rejected'
+
+def subscriber_address(data):
+    """callback_url подписки: HTTP-адрес или unix://<socket_path>"""
+    if data.get('socket_path'):
+        return LOCAL_SCHEME + data['socket_path']
+    return data.get('callback_url')
+
+def retry_delay(attempts):
+    """Экспоненциальная задержка перед попыткой attempts + 1 (equal jitter)"""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def record_deliveries(results):
+    """
+    Сохранить результаты попыток доставки в outbox
+
+    results: [(delivery_id, event_id, attempts, error)],
+    attempts - с учётом текущей попытки. Доставки с ошибкой CIRCUIT_OPEN
+    откладываются в backlog без расхода попытки.
+    """
+    writer.submit(lambda conn: _record_deliveries(conn, results, time.time()))
+
+def _record_deliveries(conn, results, now):
+    notified = defaultdict(int)
+
+    for delivery_id, event_id, attempts, error in results:
+        if error is None:
+            notified[event_id] += 1
+            conn.execute('''
+                UPDATE deliveries
+                SET status = 'delivered', attempts = ?, last_error = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (attempts, delivery_id))
+        elif error == CIRCUIT_OPEN:
+            # Повтор не раньше, чем автомат перейдёт в half_open;
+            # при замыкании unpark_deliveries вернёт их сразу
+            conn.execute('''
+                UPDATE deliveries
+                SET status = 'pending', last_error = ?, next_attempt_at = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (error, now + BREAKER_OPEN_SECONDS, delivery_id))
+        elif attempts >= RETRY_MAX_ATTEMPTS:
+            conn.execute('''
+                UPDATE deliveries
+                SET status = 'failed', attempts = ?, last_error = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (attempts, error, delivery_id))
+        else:
+            conn.execute('''
+                UPDATE deliveries
+                SET status = 'pending', attempts = ?, last_error = ?,
+                    next_attempt_at = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (attempts, error, now + retry_delay(attempts), delivery_id))
+
+    # Обновить счётчики уведомлённых в сегментах событий
+    # (файлы журнала неизменяемы - там они считаются по outbox)
+    if event_log:
+        return
+    for event_id, count in notified.items():
+        table = segments.table_for(event_id)
+        if table:
+            conn.execute(
+                f'UPDATE {table} SET notified_count = notified_count + ? WHERE id = ?',
+                (count, event_id)
+            )
+
+def notify_subscribers(events, ordered=False):
+    """
+    Разослать группу событий подписчикам и записать результат в outbox
+
+    events: [(event_id, event, payload, deliveries)],
+    deliveries: [(delivery_id, callback_url)] - строки outbox события.
+    Доставки подписчикам в пакетном режиме уходят в буферы batcher.
+    ordered - события одного ключа партиции: каждому подписчику они
+    уходят последовательно, подписчики - параллельно.
+    """
+    targets = []
+    batched = defaultdict(list)
+
+    for event_id, event, payload, deliveries in events:
+        encoded = None
+        for delivery_id, callback_url in deliveries:
+            if not batcher.is_batched(callback_url):
+                targets.append((delivery_id, event_id, callback_url, event, payload))
+                continue
+            if encoded is None:
+                encoded = encode_event(event_id, event, payload)
+            batched[callback_url].append((delivery_id, event_id, 0, encoded))
+
+    if batched:
+        batcher.add(batched)
+    if not targets:
+        return
+
+    if ordered and len(targets) > 1:
+        chains = defaultdict(list)
+        for index, (_, _, callback_url, event, payload) in enumerate(targets):
+            chains[callback_url].append((index, event, payload))
+        errors = [None] * len(targets)
+        for chain, chain_errors in zip(chains.values(), fanout.run(deliver_in_order, chains.items())):
+            for (index, *_), error in zip(chain, chain_errors):
+                errors[index] = error
+    else:
+        errors = fanout.run(
+            deliver,
+            [(callback_url, event, payload) for _, _, callback_url, event, payload in targets]
+        )
+    record_deliveries([
+        (delivery_id, event_id, 1, error)
+        for (delivery_id, event_id, *_), error in zip(targets, errors)
+    ])
+
+def deliver_in_order(callback_url, chain):
+    """Доставить события подписчику одно за другим, вернуть ошибки по порядку"""
+    return [deliver(callback_url, event, payload) for _, event, payload in chain]
+
+def redeliver(delivery_id, event_id, event, payload, callback_url, attempts):
+    """Повторная попытка доставки из outbox"""
+    if batcher.is_batched(callback_url):
+        batcher.add({callback_url: [
+            (delivery_id, event_id, attempts, encode_event(event_id, event, payload))
+        ]})
+        return
+
+    error = deliver(callback_url, event, payload)
+    record_deliveries([(delivery_id, event_id, attempts + 1, error)])
+
+def encode_event(event_id, event, payload):
+    """Элемент JSON-массива пакетной доставки - сериализуется один раз на событие"""
+    return json.dumps({'id': event_id, 'event': event, 'payload': payload})
+
+def parse_batch_options(options):
+    """
+    Проверить опцию подписки batch: {"max_events": 100, "max_wait_ms": 200}
+
+    Возвращает (max_events, max_wait_ms), None для null или ValueError
+    """
+    if options is None:
+        return None
+    if not isinstance(options, dict):
+        raise ValueError('batch must be an object: {"max_events": ..., "max_wait_ms": ...}')
+
+    try:
+        max_events = int(options.get('max_events', BATCH_DEFAULT_EVENTS))
+        max_wait_ms = float(options.get('max_wait_ms', BATCH_DEFAULT_WAIT_MS))
+    except (TypeError, ValueError):
+        raise ValueError('batch.max_events and batch.max_wait_ms must be numbers')
+
+    if not 1 <= max_events <= BATCH_MAX_EVENTS or not 0 <= max_wait_ms <= BATCH_MAX_WAIT_MS:
+        raise ValueError(
+            f'batch.max_events must be 1..{BATCH_MAX_EVENTS}, '
+            f'batch.max_wait_ms - 0..{BATCH_MAX_WAIT_MS}'
+        )
+    return max_events, max_wait_ms
+
+class DeliveryBatcher:
+    """
+    Пакетная доставка для подписчиков с опцией batch
+
+    Доставки копятся в буфере callback_url и уходят одним POST
+    с JSON-массивом [{"id", "event", "payload"}, ...], как только
+    набралось max_events или истекло max_wait_ms с первой доставки
+    в буфере. Каждое событие сериализуется один раз для всех пакетных
+    подписчиков, а тело запроса собирается из готовых элементов и
+    переиспользуется подписчиками, у которых сбрасывается один и тот же
+    набор событий.
+
+    Результат POST записывается в outbox для каждой доставки пачки;
+    повторы идут через этот же буфер. Буфер живёт только в памяти:
+    его доставки имеют статус inflight и после перезапуска шины
+    возвращаются в очередь повторов.
+    """
+
+    def __init__(self):
+        # callback_url -> (max_events, max_wait в секундах)
+        self.options = {}
+        # callback_url -> [deadline, [(delivery_id, event_id, attempts, encoded)]]
+        self.buffers = {}
+        # Пачки к отправке потоком батчера без ожидания: [(callback_url, entries)]
+        self.ready = []
+        self.condition = Condition()
+        self.thread = None
+        self.batches = 0
+        self.events = 0
+        self.flushed_by_size = 0
+        self.flushed_by_time = 0
+        self.shared_bodies = 0
+
+    def start(self):
+        if self.thread:
+            return
+
+        self.thread = Thread(target=self._loop, name='bus-batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def configure(self, callback_url, options):
+        """
+        Включить (max_events, max_wait_ms) или выключить (None) пакетный режим
+
+        Вызывается при установке снимка подписок, в том числе потоком
+        писателя, поэтому не отправляет сам: накопленное выключенным
+        подписчиком досылает поток батчера.
+        """
+        with self.condition:
+            if options:
+                max_events, max_wait_ms = options
+                self.options[callback_url] = (max_events, max_wait_ms / 1000)
+                self.condition.notify()
+                return
+            self.options.pop(callback_url, None)
+            buffer = self.buffers.pop(callback_url, None)
+            if buffer:
+                self.ready.append((callback_url, buffer[1]))
+                self.condition.notify()
+
+    def is_batched(self, callback_url):
+        return callback_url in self.options
+
+    def get_options(self, callback_url):
+        options = self.options.get(callback_url)
+        if options is None:
+            return None
+        return {'max_events': options[0], 'max_wait_ms': options[1] * 1000}
+
+    def add(self, targets):
+        """
+        Добавить доставки в буферы подписчиков
+
+        targets: {callback_url: [(delivery_id, event_id, attempts, encoded)]},
+        attempts - число уже сделанных попыток. Полные пачки отправляются
+        сразу; подписчику, только что выключившему пакетный режим,
+        накопленное уходит одной пачкой без ожидания.
+        """
+        full = []
+
+        with self.condition:
+            for callback_url, entries in targets.items():
+                options = self.options.get(callback_url)
+                if options is None:
+                    full.append((callback_url, entries))
+                    continue
+
+                max_events, max_wait = options
+                buffer = self.buffers.get(callback_url)
+                if buffer is None:
+                    buffer = self.buffers[callback_url] = [time.monotonic() + max_wait, []]
+                    self.condition.notify()
+
+                buffer[1].extend(entries)
+                while len(buffer[1]) >= max_events:
+                    full.append((callback_url, buffer[1][:max_events]))
+                    del buffer[1][:max_events]
+                    self.flushed_by_size += 1
+
+                if not buffer[1]:
+                    del self.buffers[callback_url]
+
+        if full:
+            self._flush(full)
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                due = [
+                    (callback_url, buffer[1])
+                    for callback_url, buffer in self.buffers.items()
+                    if buffer[0] <= now
+                ]
+                ready, self.ready = self.ready, []
+                if not due and not ready:
+                    deadline = min((buffer[0] for buffer in self.buffers.values()), default=None)
+                    self.condition.wait(None if deadline is None else deadline - now)
+                    continue
+
+                for callback_url, _ in due:
+                    del self.buffers[callback_url]
+                self.flushed_by_time += len(due)
+
+            try:
+                self._flush(ready + due)
+            except Exception as e:
+                print(f"❌ Batch flush error: {e}")
+
+    def _flush(self, batches):
+        """Отправить пачки через пул рассылки, не дожидаясь ответов"""
+        bodies = {}
+
+        for callback_url, entries in batches:
+            key = tuple(entry[1] for entry in entries)
+            body = bodies.get(key)
+            if body is None:
+                body = bodies[key] = f"[{','.join(entry[3] for entry in entries)}]".encode()
+            else:
+                self.shared_bodies += 1
+
+            with self.condition:
+                self.batches += 1
+                self.events += len(entries)
+
+            fanout.submit(self._post, (callback_url, body, entries))
+
+    @staticmethod
+    def _post(callback_url, body, entries):
+        error = deliver_batch(callback_url, body, len(entries))
+        record_deliveries([
+            (delivery_id, event_id, attempts + 1, error)
+            for delivery_id, event_id, attempts, _ in entries
+        ])
+
+    def stats(self):
+        with self.condition:
+            return {
+                'subscribers': len(self.options),
+                'buffered': sum(len(buffer[1]) for buffer in self.buffers.values())
+                            + sum(len(entries) for _, entries in self.ready),
+                'batches': self.batches,
+                'events': self.events,
+                'avg_batch_size': round(self.events / self.batches, 1) if self.batches else 0,
+                'flushed_by_size': self.flushed_by_size,
+                'flushed_by_time': self.flushed_by_time,
+                'shared_bodies': self.shared_bodies
+            }
+
+batcher = DeliveryBatcher()
+
+class LaneQueue:
+    """
+    Очередь заданий из нескольких дорожек с взвешенным справедливым выбором
+
+    У каждой дорожки своя очередь на maxsize заданий, поэтому поток
+    малоценных событий не вытесняет важные. Следующая дорожка выбирается
+    плавным взвешенным round robin (как в nginx) среди непустых: при весах
+    8/4/1 на 13 заданий приходится 8 из high, 4 из normal и 1 из low,
+    и они перемешаны, а не идут пачками; пустые дорожки не простаивают.
+    """
+
+    def __init__(self, weights, maxsize):
+        self.weights = weights
+        self.maxsize = maxsize
+        self.lanes = {lane: deque() for lane in weights}
+        self.current = dict.fromkeys(weights, 0)
+        self.taken = dict.fromkeys(weights, 0)
+        self.condition = Condition()
+        self.size = 0
+
+    def put(self, lane, job, force=False):
+        """Поставить задание в дорожку; Full - дорожка заполнена (кроме force)"""
+        with self.condition:
+            queue = self.lanes[lane]
+            if not force and len(queue) >= self.maxsize:
+                raise Full
+            queue.append(job)
+            self.size += 1
+            self.condition.notify()
+
+    def get(self):
+        with self.condition:
+            while not self.size:
+                self.condition.wait()
+
+            total = 0
+            chosen = None
+            for lane, queue in self.lanes.items():
+                if not queue:
+                    continue
+                weight = self.weights[lane]
+                self.current[lane] += weight
+                total += weight
+                if chosen is None or self.current[lane] > self.current[chosen]:
+                    chosen = lane
+            self.current[chosen] -= total
+
+            self.size -= 1
+            self.taken[chosen] += 1
+            return self.lanes[chosen].popleft()
+
+    def qsize(self):
+        return self.size
+
+    def stats(self):
+        with self.condition:
+            return {
+                lane: {'weight': self.weights[lane], 'depth': len(queue), 'dispatched': self.taken[lane]}
+                for lane, queue in self.lanes.items()
+            }
+
+def build_routes(routes, name, valid=None):
+    """Trie {шаблон: значение} из настройки; некорректные записи пропускаются"""
+    trie = TopicTrie(TOPIC_CACHE_SIZE)
+    for pattern, value in routes.items():
+        if not is_valid_pattern(pattern) or (valid is not None and value not in valid):
+            print(f"⚠️ {name}: ignoring {pattern} → {value}")
+            continue
+        trie.add(pattern, value)
+    return trie
+
+lane_routes = build_routes(DELIVERY_LANE_ROUTES, 'BUS_DELIVERY_LANE_ROUTES', DELIVERY_LANES)
+partition_routes = build_routes(PARTITION_KEYS, 'BUS_PARTITION_KEYS')
+
+def delivery_lane(event):
+    """Дорожка события: из совпавших шаблонов - с наибольшим весом"""
+    lanes = lane_routes.match(event)
+    if not lanes:
+        return DEFAULT_LANE
+    return max(lanes, key=DELIVERY_LANES.get)
+
+def partition_key(event, payload):
+    """Ключ партиции из поля payload, заданного для события в BUS_PARTITION_KEYS"""
+    for field in partition_routes.match(event):
+        value = payload.get(field) if isinstance(payload, dict) else None
+        if value is not None:
+            return f'{field}={value}'
+    return None
+
+class DeliveryDispatcher:
+    """
+    Пул воркеров доставки с ограниченной очередью заданий
+
+    Вместо потока на каждый publish задания кладутся в очередь,
+    которую разбирает фиксированное число воркеров. Если очередь
+    заполнена, задание отбрасывается и учитывается в счётчике dropped.
+
+    Очередь разбита на дорожки с весами (LaneQueue). Задания с ключом
+    партиции выполняются строго по одному и в порядке постановки:
+    пока задание ключа в очереди или в работе, следующие ждут в его
+    цепочке и встают в дорожку по завершении предыдущего. Разные ключи
+    по-прежнему идут параллельно на всех воркерах.
+
+    queue_size ограничивает каждую дорожку и каждую цепочку, max_pending -
+    все ждущие задания вместе (в дорожках и цепочках, без выполняемых):
+    сверх него submit отказывает, как при полной дорожке. В памяти
+    одновременно не больше max_pending + workers заданий; задание -
+    группа событий одной публикации (до BUS_BATCH_MAX_EVENTS).
+    """
+
+    def __init__(self, handler, workers, queue_size, lanes=None, max_pending=None):
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_pending = max_pending or queue_size
+        self.queue = LaneQueue(lanes or {DEFAULT_LANE: 1}, queue_size)
+        self.lock = Lock()
+        self.threads = []
+        # ключ партиции -> задания, ждущие завершения текущего
+        self.chains = {}
+        # Задания в дорожках и цепочках, ещё не взятые воркером
+        self.pending = 0
+        self.active = 0
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+
+    def start(self):
+        """Запустить воркеры (повторный вызов ничего не делает)"""
+        if self.threads:
+            return
+
+        for i in range(self.workers):
+            thread = Thread(target=self._worker, name=f'bus-delivery-{i}')
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, *job, lane=DEFAULT_LANE, key=None):
+        """Поставить задание в очередь. False - очередь заполнена"""
+        with self.lock:
+            chain = self.chains.get(key) if key is not None else None
+            try:
+                if self.pending >= self.max_pending:
+                    raise Full
+                if chain is not None:
+                    if len(chain) >= self.queue_size:
+                        raise Full
+                    chain.append((lane, job))
+                else:
+                    self.queue.put(lane, (key, job))
+                    if key is not None:
+                        self.chains[key] = deque()
+            except Full:
+                self.dropped += 1
+                return False
+
+            self.pending += 1
+            self.submitted += 1
+        return True
+
+    def _worker(self):
+        while True:
+            key, job = self.queue.get()
+
+            with self.lock:
+                self.pending -= 1
+                self.active += 1
+
+            try:
+                self.handler(*job)
+            except Exception as e:
+                print(f"❌ Delivery worker error: {e}")
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.processed += 1
+                    if key is not None:
+                        self._advance(key)
+
+    def _advance(self, key):
+        """Следующее задание ключа - в его дорожку (под self.lock)"""
+        chain = self.chains[key]
+        if not chain:
+            del self.chains[key]
+            return
+        lane, job = chain.popleft()
+        self.queue.put(lane, (key, job), force=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'active_workers': self.active,
+                'queue_depth': self.queue.qsize(),
+                'queue_size': self.queue_size,
+                'pending': self.pending,
+                'max_pending': self.max_pending,
+                'submitted': self.submitted,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'ordered_keys': len(self.chains),
+                'lanes': self.queue.stats()
+            }
+
+class RedeliveryScheduler:
+    """
+    Фоновый планировщик повторной доставки
+
+    Периодически забирает из outbox доставки, у которых наступило
+    next_attempt_at, помечает их inflight и отдаёт отдельному пулу
+    повторов, чтобы ретраи не занимали воркеров свежего трафика.
+    """
+
+    def __init__(self, retry_dispatcher, interval, batch_size, stats_interval):
+        self.retry_dispatcher = retry_dispatcher
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stats_interval = stats_interval
+        self.thread = None
+        # Подсчёт outbox по статусам для /api/stats (кешируется)
+        self.counts = {}
+        self.counted_at = None
+        self.counts_lock = Lock()
+
+    def start(self):
+        if self.thread:
+            return
+
+        self.thread = Thread(target=self._loop, name='bus-redelivery')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                while self.poll() == self.batch_size:
+                    pass
+            except Exception as e:
+                print(f"❌ Redelivery scheduler error: {e}")
+            time.sleep(self.interval)
+
+    def poll(self):
+        """Запланировать одну пачку созревших доставок. Возвращает их число"""
+        conn = get_db()
+        cursor = conn.execute('''
+            SELECT id, event_id, callback_url, attempts
+            FROM deliveries
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY next_attempt_at
+            LIMIT ?
+        ''', (time.time(), self.batch_size))
+        due = cursor.fetchall()
+        event_ids = [row['event_id'] for row in due]
+        events = event_log.fetch(event_ids) if event_log else segments.fetch(conn, event_ids)
+        conn.close()
+
+        if not due:
+            return 0
+
+        # Событие уже удалено по сроку хранения - доставлять нечего
+        expired = [(row['id'],) for row in due if row['event_id'] not in events]
+        if expired:
+            writer.submit(lambda conn: conn.executemany('''
+                UPDATE deliveries
+                SET status = 'failed', last_error = 'event expired',
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', expired))
+
+        rows = [row for row in due if row['event_id'] in events]
+        if not rows:
+            return len(due)
+
+        writer.execute(lambda conn: conn.executemany(
+            "UPDATE deliveries SET status = 'inflight' WHERE id = ?",
+            [(row['id'],) for row in rows]
+        ))
+
+        # Что не поместилось в очередь повторов - вернуть в pending
+        rejected = []
+        for row in rows:
+            event = events[row['event_id']]
+            payload = json.loads(event['payload']) if event['payload'] else {}
+            if not self.retry_dispatcher.submit(
+                row['id'], row['event_id'], event['event_type'],
+                payload, row['callback_url'], row['attempts']
+            ):
+                rejected.append((row['id'],))
+
+        if rejected:
+            writer.submit(lambda conn: conn.executemany(
+                "UPDATE deliveries SET status = 'pending' WHERE id = ?",
+                rejected
+            ))
+
+        return len(due) - len(rejected)
+
+    def status_counts(self):
+        """
+        Число доставок outbox по статусам, не чаще раза в stats_interval
+
+        Строки outbox меняют несколько потоков и другие процессы шины,
+        поэтому счёт берётся из БД, но частые опросы /api/stats
+        получают готовый результат.
+        """
+        with self.counts_lock:
+            now = time.monotonic()
+            if self.counted_at is not None and now - self.counted_at < self.stats_interval:
+                return self.counts
+
+            conn = get_db()
+            cursor = conn.execute('''
+                SELECT status, COUNT(*) as count
+                FROM deliveries
+                WHERE status IN ('pending', 'inflight', 'failed')
+                GROUP BY status
+            ''')
+            self.counts = {row['status']: row['count'] for row in cursor.fetchall()}
+            conn.close()
+            self.counted_at = now
+            return self.counts
+
+    def stats(self):
+        counts = self.status_counts()
+        return {
+            'pending': counts.get('pending', 0),
+            'inflight': counts.get('inflight', 0),
+            'failed': counts.get('failed', 0),
+            'counted_every_seconds': self.stats_interval,
+            'retry_pool': self.retry_dispatcher.stats()
+        }
+
+dispatcher = DeliveryDispatcher(
+    notify_subscribers, DELIVERY_WORKERS, DELIVERY_QUEUE_SIZE, DELIVERY_LANES, DELIVERY_QUEUE_TOTAL
+)
+retry_dispatcher = DeliveryDispatcher(redeliver, RETRY_WORKERS, RETRY_QUEUE_SIZE)
+redelivery = RedeliveryScheduler(retry_dispatcher, RETRY_POLL_INTERVAL, RETRY_BATCH, OUTBOX_STATS_INTERVAL)
+
+# ============= ADMISSION =============
+
+class TokenBucket:
+    """
+    Корзина токенов: rate токенов в секунду, не больше burst
+
+    Пачка больше burst допускается при полной корзине и уводит её
+    в минус, так что следующие публикации ждут, пока долг погасится.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def take(self, count):
+        """Взять count токенов. Возвращает 0 или секунды до их появления"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            need = min(count, self.burst)
+            if self.tokens >= need:
+                self.tokens -= count
+                return 0
+            return (need - self.tokens) / self.rate
+
+    def give(self, count):
+        """Вернуть токены, взятые под отклонённую публикацию"""
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + count)
+
+class AdmissionControl:
+    """
+    Допуск публикаций при перегрузке
+
+    Публикация отклоняется с 429 и Retry-After, если:
+    - backlog - в outbox больше max_pending недоставленных доставок
+      (pending и inflight; значение кешируется на depth_interval секунд);
+    - producer - исчерпана корзина отправителя (service_id из тела,
+      заголовок X-Service-Id или адрес клиента);
+    - global - исчерпана общая корзина шины.
+    Нулевой rate или max_pending выключает соответствующую проверку.
+    Корзин отправителей не больше max_producers, давно молчавшие
+    вытесняются первыми.
+    """
+
+    def __init__(self, rate, burst, producer_rate, producer_burst,
+                 max_producers, max_pending, depth_interval):
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.producer_rate = producer_rate
+        self.producer_burst = producer_burst
+        self.max_producers = max_producers
+        self.max_pending = max_pending
+        self.depth_interval = depth_interval
+        self.producers = OrderedDict()
+        self.lock = Lock()
+        self.depth = 0
+        self.depth_checked = 0
+        self.admitted = 0
+        self.rejected = defaultdict(int)
+
+    def _producer_bucket(self, producer):
+        with self.lock:
+            bucket = self.producers.get(producer)
+            if bucket is None:
+                bucket = self.producers[producer] = TokenBucket(self.producer_rate, self.producer_burst)
+                if len(self.producers) > self.max_producers:
+                    self.producers.popitem(last=False)
+            else:
+                self.producers.move_to_end(producer)
+            return bucket
+
+    def pending_depth(self):
+        """Число недоставленных доставок в outbox (кешируется)"""
+        now = time.monotonic()
+        if now - self.depth_checked < self.depth_interval:
+            return self.depth
+
+        conn = get_db()
+        self.depth = conn.execute('''
+            SELECT COUNT(*) FROM deliveries WHERE status IN ('pending', 'inflight')
+        ''').fetchone()[0]
+        conn.close()
+        self.depth_checked = now
+        return self.depth
+
+    def admit(self, producer, count):
+        """Допустить count событий. Возвращает None или (причина, Retry-After в секундах)"""
+        if self.max_pending and self.pending_depth() >= self.max_pending:
+            return self._reject('backlog', self.depth_interval)
+
+        producer_bucket = self._producer_bucket(producer) if self.producer_rate > 0 else None
+        if producer_bucket:
+            wait = producer_bucket.take(count)
+            if wait:
+                return self._reject('producer', wait)
+
+        if self.bucket:
+            wait = self.bucket.take(count)
+            if wait:
+                if producer_bucket:
+                    producer_bucket.give(count)
+                return self._reject('global', wait)
+
+        with self.lock:
+            self.admitted += count
+        return None
+
+    def _reject(self, reason, wait):
+        with self.lock:
+            self.rejected[reason] += 1
+        return reason, max(1, math.ceil(wait))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+                'producers': len(self.producers),
+                'pending_depth': self.depth,
+                'max_pending': self.max_pending,
+                'rate': self.bucket.rate if self.bucket else None,
+                'producer_rate': self.producer_rate or None
+            }
+
+admission = AdmissionControl(
+    ADMISSION_RATE, ADMISSION_BURST, ADMISSION_PRODUCER_RATE, ADMISSION_PRODUCER_BURST,
+    ADMISSION_MAX_PRODUCERS, ADMISSION_MAX_PENDING, ADMISSION_DEPTH_INTERVAL
+)
+
+def producer_id(data):
+    """Отправитель публикации для корзины токенов"""
+    service_id = data.get('service_id') if isinstance(data, dict) else None
+    return service_id or request.headers.get('X-Service-Id') or request.remote_addr
+
+def overloaded(reason, retry_after):
+    """Ответ 429 отклонённой публикации"""
+    print(f"🚦 Publish rejected ({reason}), retry after {retry_after}s")
+    response = jsonify({
+        'success': False,
+        'error': 'message bus is overloaded, retry later',
+        'reason': reason,
+        'retry_after': retry_after
+    })
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+# ============= DEAD LETTERS =============
+
+class DeadLetterQuery:
+    """
+    Отбор dead letters - доставок в статусе failed
+
+    Строки outbox читаются keyset-страницами по id (частичный индекс
+    idx_deliveries_failed); callback_url и префикс ошибки проверяет SQL,
+    шаблон типа события - trie в памяти по событиям из журнала.
+    """
+
+    def __init__(self, callback_url=None, pattern=None, error=None, ids=None):
+        self.callback_url = callback_url
+        self.pattern = pattern
+        self.error = error
+        self.ids = ids
+        self.matcher = None
+        if pattern:
+            self.matcher = TopicTrie(DEAD_LETTERS_PAGE)
+            self.matcher.add(pattern, True)
+
+    @classmethod
+    def from_request(cls, data):
+        """Из query-параметров или тела redrive. ValueError - некорректный фильтр"""
+        pattern = data.get('event')
+        if pattern and not is_valid_pattern(pattern):
+            raise ValueError('wildcards * and # must be whole segments, e.g. "order.*" or "product.#"')
+
+        ids = data.get('ids')
+        if ids is not None:
+            if not isinstance(ids, list) or len(ids) > DEAD_LETTERS_PAGE \
+                    or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+                raise ValueError(f'ids must be an array of at most {DEAD_LETTERS_PAGE} delivery ids')
+
+        return cls(data.get('callback_url'), pattern, data.get('error'), ids)
+
+    def describe(self):
+        return {
+            key: value for key, value in (
+                ('callback_url', self.callback_url), ('event', self.pattern),
+                ('error', self.error), ('ids', self.ids)
+            ) if value is not None
+        }
+
+    def page(self, conn, cursor_id, limit, newest_first):
+        """
+        Одна страница: (dead letters с событиями, id последней просмотренной
+        строки или None, если строк больше нет)
+        """
+        conditions = ["status = 'failed'"]
+        params = []
+        if cursor_id is not None:
+            conditions.append('id < ?' if newest_first else 'id > ?')
+            params.append(cursor_id)
+        if self.callback_url:
+            conditions.append('callback_url = ?')
+            params.append(self.callback_url)
+        if self.error:
+            conditions.append("last_error LIKE ? ESCAPE '\\'")
+            params.append(self.error.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        if self.ids is not None:
+            conditions.append(f"id IN ({','.join('?' * len(self.ids))})")
+            params.extend(self.ids)
+
+        rows = conn.execute(f'''
+            SELECT id, event_id, callback_url, attempts, last_error, created_at, updated_at
+            FROM deliveries
+            WHERE {' AND '.join(conditions)}
+            ORDER BY id {'DESC' if newest_first else ''}
+            LIMIT ?
+        ''', params + [limit]).fetchall()
+        if not rows:
+            return [], None
+
+        event_ids = [row['event_id'] for row in rows]
+        events = event_log.fetch(event_ids) if event_log else segments.fetch(conn, event_ids)
+
+        letters = []
+        for row in rows:
+            event = events.get(row['event_id'])
+            event_type = event['event_type'] if event else None
+            if self.matcher and (event is None or not self.matcher.match(event_type)):
+                continue
+            letters.append((row, event))
+        return letters, rows[-1]['id']
+
+def dead_letter_info(row, event, with_payload=False):
+    info = {
+        'id': row['id'],
+        'event_id': row['event_id'],
+        'event': event['event_type'] if event else None,
+        'callback_url': row['callback_url'],
+        'attempts': row['attempts'],
+        'last_error': row['last_error'],
+        'created_at': row['created_at'],
+        'failed_at': row['updated_at']
+    }
+    if with_payload:
+        # Событие могло истечь по сроку хранения - тогда payload нет
+        info['payload'] = json.loads(event['payload']) if event and event['payload'] else None
+    return info
+
+class RedriveJob:
+    """Одна повторная отправка dead letters (состояние для /api/dead-letters/redrive)"""
+
+    def __init__(self, job_id, query, rate, limit):
+        self.id = job_id
+        self.query = query
+        self.rate = rate
+        self.limit = limit
+        self.status = 'running'
+        self.scanned_id = 0
+        self.redriven = 0
+        self.skipped = 0
+        self.paused_seconds = 0.0
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self.cancelled = False
+
+    def info(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'filter': self.query.describe(),
+            'rate': self.rate,
+            'limit': self.limit or None,
+            'redriven': self.redriven,
+            'skipped': self.skipped,
+            'scanned_id': self.scanned_id,
+            'paused_seconds': round(self.paused_seconds, 1),
+            'actual_rate': round(self.redriven / elapsed, 1) if elapsed > 0 else 0,
+            'error': self.error,
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat(),
+            'finished_at': datetime.fromtimestamp(self.finished_at).isoformat() if self.finished_at else None
+        }
+
+class DeadLetterRedrive:
+    """
+    Фоновые задания повторной отправки dead letters
+
+    Задание идёт по отобранным failed-доставкам страницами по id и
+    возвращает их в outbox (pending, attempts = 0) не быстрее rate строк
+    в секунду. Дальше их доставляет обычный планировщик повторов со своим
+    пулом воркеров, так что живые публикации не ждут redrive. Пока в outbox
+    не меньше max_pending недоставленных строк, задание стоит: большой
+    redrive не упирает публикации в 429 допуска по backlog.
+    """
+
+    def __init__(self, max_jobs, max_pending, history):
+        self.max_jobs = max_jobs
+        self.max_pending = max_pending
+        self.history = history
+        self.jobs = OrderedDict()
+        self.lock = Lock()
+        self.next_id = 1
+
+    def start(self, query, rate, limit):
+        """Запустить задание. RuntimeError - если заданий уже max_jobs"""
+        with self.lock:
+            running = sum(1 for job in self.jobs.values() if job.status == 'running')
+            if running >= self.max_jobs:
+                raise RuntimeError(f'{running} redrive jobs are already running')
+
+            job = RedriveJob(self.next_id, query, rate, limit)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history:
+                oldest = next(iter(self.jobs.values()))
+                if oldest.status == 'running':
+                    break
+                self.jobs.popitem(last=False)
+
+        thread = Thread(target=self._run, args=(job,), name=f'bus-redrive-{job.id}')
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return [job.info() for job in reversed(self.jobs.values())]
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job:
+            job.cancelled = True
+        return job
+
+    def _run(self, job):
+        print(f"♻️ Redrive #{job.id} started: {job.query.describe() or 'all dead letters'} at {job.rate:g}/s")
+        # Мелкие страницы - равномерный поток вместо всплесков раз в секунду
+        page_size = max(1, min(DEAD_LETTERS_PAGE, int(job.rate / 10) or 1))
+        bucket = TokenBucket(job.rate, page_size)
+
+        try:
+            while not job.cancelled:
+                if job.limit and job.redriven >= job.limit:
+                    break
+
+                if self.max_pending and admission.pending_depth() >= self.max_pending:
+                    time.sleep(1)
+                    job.paused_seconds += 1
+                    continue
+
+                size = page_size if not job.limit else min(page_size, job.limit - job.redriven)
+                conn = get_db()
+                try:
+                    letters, last_id = job.query.page(conn, job.scanned_id, size, False)
+                finally:
+                    conn.close()
+                if last_id is None:
+                    break
+                job.scanned_id = last_id
+
+                # Событие истекло - доставлять нечего, строка остаётся в failed
+                ids = [(row['id'],) for row, event in letters if event is not None]
+                job.skipped += len(letters) - len(ids)
+                if not ids:
+                    continue
+
+                wait = bucket.take(len(ids))
+                while wait:
+                    time.sleep(wait)
+                    wait = bucket.take(len(ids))
+
+                now = time.time()
+                job.redriven += writer.execute(lambda conn: conn.executemany('''
+                    UPDATE deliveries
+                    SET status = 'pending', attempts = 0, next_attempt_at = ?,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND status = 'failed'
+                ''', [(now, delivery_id) for delivery_id, in ids]).rowcount)
+
+            job.status = 'cancelled' if job.cancelled else 'done'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            print(f"❌ Redrive #{job.id} failed: {e}")
+
+        job.finished_at = time.time()
+        print(f"♻️ Redrive #{job.id} {job.status}: {job.redriven} deliveries back in outbox")
+
+    def stats(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return {
+            'running_jobs': sum(1 for job in jobs if job.status == 'running'),
+            'redriven': sum(job.redriven for job in jobs)
+        }
+
+redrive = DeadLetterRedrive(REDRIVE_MAX_JOBS, REDRIVE_MAX_PENDING, REDRIVE_HISTORY)
+
+# ============= IDEMPOTENCY =============
+
+class IdempotencyIndex:
+    """
+    Индекс idempotency_key опубликованных событий за окно window секунд
+
+    Ключи лежат в таблице publish_keys (key -> event_id) и в LRU
+    в памяти на cache_size последних ключей. Промах LRU окончателен,
+    пока из него не вытеснялся ещё живой ключ - тогда проверка обходится
+    без SQL; иначе ключ ищется по первичному ключу таблицы. Индекс
+    читается и меняется только в потоке писателя, в той же транзакции,
+    что и запись событий, поэтому два одновременных повтора не запишут
+    событие дважды.
+
+    Истёкшие ключи удаляет фоновый поток порциями по expire_chunk через
+    писателя, пока они не кончатся, - таблица не растёт при любой
+    частоте публикаций с ключами.
+    """
+
+    def __init__(self, window, cache_size, expire_interval, expire_chunk):
+        self.window = window
+        self.cache_size = cache_size
+        self.expire_interval = expire_interval
+        self.expire_chunk = expire_chunk
+        self.thread = None
+        # key -> (event_id, created_at)
+        self.cache = OrderedDict()
+        # Ключи, записанные в ещё не зафиксированной группе писателя
+        self.uncommitted = set()
+        # created_at самого свежего вытесненного из LRU ключа
+        self.evicted_until = 0.0
+        self.expired = 0
+        self.lookups = 0
+        self.duplicates = 0
+        self.db_lookups = 0
+
+    def load(self, conn):
+        """Поднять в LRU самые свежие ключи окна"""
+        cutoff = time.time() - self.window
+        rows = conn.execute('''
+            SELECT key, event_id, created_at FROM publish_keys
+            WHERE created_at >= ?
+            ORDER BY created_at DESC
+            LIMIT ?
+        ''', (cutoff, self.cache_size + 1)).fetchall()
+
+        if len(rows) > self.cache_size:
+            self.evicted_until = rows.pop()['created_at']
+        for row in reversed(rows):
+            self.cache[row['key']] = (row['event_id'], row['created_at'])
+
+    def find(self, conn, key, now):
+        """id события, уже опубликованного с этим ключом в окне, или None"""
+        self.lookups += 1
+        cutoff = now - self.window
+
+        entry = self.cache.get(key)
+        if entry is not None:
+            if entry[1] >= cutoff:
+                self.cache.move_to_end(key)
+                self.duplicates += 1
+                return entry[0]
+            del self.cache[key]
+            return None
+
+        # Ключ из незафиксированной группы (или откаченной) проверяет таблица
+        if self.evicted_until < cutoff and key not in self.uncommitted:
+            return None
+
+        self.db_lookups += 1
+        row = conn.execute(
+            'SELECT event_id, created_at FROM publish_keys WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or row['created_at'] < cutoff:
+            self.uncommitted.discard(key)
+            return None
+        self.duplicates += 1
+        return row['event_id']
+
+    def remember(self, conn, keyed, now):
+        """Записать [(key, event_id)]; в LRU они попадут после COMMIT"""
+        conn.executemany(
+            'INSERT OR REPLACE INTO publish_keys (key, event_id, created_at) VALUES (?, ?, ?)',
+            [(key, event_id, now) for key, event_id in keyed]
+        )
+        self.uncommitted.update(key for key, _ in keyed)
+        writer.on_commit(lambda: self._cache(keyed, now))
+
+    def _cache(self, keyed, now):
+        for key, event_id in keyed:
+            self.uncommitted.discard(key)
+            self.cache[key] = (event_id, now)
+            self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            _, (_, created_at) = self.cache.popitem(last=False)
+            self.evicted_until = max(self.evicted_until, created_at)
+
+    def start(self):
+        if self.thread:
+            return
+
+        self.thread = Thread(target=self._loop, name='bus-idempotency')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.expire_interval)
+            try:
+                self.expire(time.time())
+            except Exception as e:
+                print(f"❌ Idempotency keys expiry error: {e}")
+
+    def expire(self, now):
+        """Удалить все ключи старше окна, по порции на операцию писателя"""
+        cutoff = now - self.window
+
+        def delete_chunk(conn):
+            return conn.execute('''
+                DELETE FROM publish_keys WHERE key IN (
+                    SELECT key FROM publish_keys WHERE created_at < ? LIMIT ?
+                )
+            ''', (cutoff, self.expire_chunk)).rowcount
+
+        deleted = 0
+        while True:
+            count = writer.execute(delete_chunk)
+            deleted += count
+            if count < self.expire_chunk:
+                break
+
+        self.expired += deleted
+        return deleted
+
+    def stats(self):
+        return {
+            'window_seconds': self.window,
+            'cached_keys': len(self.cache),
+            'expired': self.expired,
+            'lookups': self.lookups,
+            'duplicates': self.duplicates,
+            'db_lookups': self.db_lookups
+        }
+
+idempotency = IdempotencyIndex(
+    IDEMPOTENCY_WINDOW, IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_EXPIRE_INTERVAL, IDEMPOTENCY_EXPIRE_CHUNK
+)
+
+def idempotency_key(item, index=None):
+    """
+    idempotency_key события: поле тела или (для одиночной публикации)
+    заголовок Idempotency-Key. ValueError - если ключ некорректен.
+    """
+    key = item.get('idempotency_key')
+    if key is None and index is None:
+        key = request.headers.get('Idempotency-Key')
+    if key is None:
+        return None
+
+    where = 'idempotency_key' if index is None else f'events[{index}].idempotency_key'
+    if not isinstance(key, str) or not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise ValueError(f'{where} must be a string of 1..{IDEMPOTENCY_KEY_MAX_LENGTH} characters')
+    return key
+
+# ============= PUBLISHING =============
+
+def store_events(items):
+    """
+    Сохранить пачку событий и строки outbox одной транзакцией
+
+    items: [(event, payload)]
+    Возвращает [(event_id, event, payload, deliveries)] для пула доставки
+    """
+    return writer.execute(lambda conn: _store_events(conn, items, time.time()))
+
+def store_keyed_events(items, keys):
+    """
+    store_events с проверкой idempotency_key (keys - ключ или None
+    для каждого события)
+
+    Событие с ключом, уже опубликованным в окне, не записывается
+    и не доставляется повторно. Возвращает (stored, event_ids):
+    записанные события как у store_events и id для каждого из items -
+    новый или исходного события.
+    """
+    return writer.execute(lambda conn: _store_keyed_events(conn, items, keys, time.time()))
+
+def _store_keyed_events(conn, items, keys, now):
+    event_ids = [None] * len(items)
+    # Повтор ключа внутри той же пачки: индекс -> индекс первого вхождения
+    repeats = {}
+    first_seen = {}
+    fresh = []
+
+    for index, key in enumerate(keys):
+        if key is not None:
+            if key in first_seen:
+                repeats[index] = first_seen[key]
+                continue
+            event_ids[index] = idempotency.find(conn, key, now)
+            if event_ids[index] is not None:
+                continue
+            first_seen[key] = index
+        fresh.append(index)
+
+    stored = _store_events(conn, [items[index] for index in fresh], now) if fresh else []
+    for index, (event_id, *_) in zip(fresh, stored):
+        event_ids[index] = event_id
+    for index, first in repeats.items():
+        event_ids[index] = event_ids[first]
+
+    if first_seen:
+        idempotency.remember(conn, [(key, event_ids[index]) for key, index in first_seen.items()], now)
+    return stored, event_ids
+
+def _store_events(conn, items, now):
+    if event_log:
+        # id выдаются тем же счётчиком, что и для сегментов SQLite
+        first_event_id = segments.reserve(conn, len(items))
+        event_log.append([
+            (first_event_id + offset, event, json.dumps(payload))
+            for offset, (event, payload) in enumerate(items)
+        ], now)
+    else:
+        table, first_event_id = segments.allocate(conn, len(items))
+        conn.executemany(f'''
+            INSERT INTO {table} (id, event_type, payload)
+            VALUES (?, ?, ?)
+        ''', [
+            (first_event_id + offset, event, json.dumps(payload))
+            for offset, (event, payload) in enumerate(items)
+        ])
+    event_types = [event for event, _ in items]
+    writer.on_commit(lambda: counters.add(event_types, first_event_id + len(items) - 1))
+    # SSE-потоки получают события в порядке id: колбэки коммита идут по порядку операций
+    writer.on_commit(lambda: streams.broadcast(
+        (first_event_id + offset, event, payload) for offset, (event, payload) in enumerate(items)
+    ))
+
+    snapshot = subscriptions.current(conn)
+    targets = []
+    for offset, (event, payload) in enumerate(items):
+        for callback_url in snapshot.match(event, payload):
+            targets.append((first_event_id + offset, callback_url))
+
+    first_delivery_id = 0
+    if targets:
+        conn.executemany('''
+            INSERT INTO deliveries (event_id, callback_url, status, next_attempt_at)
+            VALUES (?, ?, 'inflight', ?)
+        ''', [(event_id, callback_url, now) for event_id, callback_url in targets])
+        first_delivery_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0] - len(targets) + 1
+
+    deliveries = defaultdict(list)
+    for offset, (event_id, callback_url) in enumerate(targets):
+        deliveries[event_id].append((first_delivery_id + offset, callback_url))
+
+    return [
+        (first_event_id + offset, event, payload, deliveries[first_event_id + offset])
+        for offset, (event, payload) in enumerate(items)
+    ]
+
+def dispatch_events(stored, partition_keys=None):
+    """
+    Передать группу сохранённых событий пулу доставки
+
+    События делятся на задания по дорожкам и ключам партиции
+    (partition_keys - {event_id: ключ} от отправителя, иначе ключ
+    берётся из payload по BUS_PARTITION_KEYS). Возвращает False, если
+    очередь заполнена и доставка части событий отложена планировщику
+    повторов.
+    """
+    # Задание на ключ (в самой важной из дорожек его событий), без ключа - на дорожку
+    jobs = {}
+    for item in stored:
+        event_id, event, payload, deliveries = item
+        if not deliveries:
+            continue
+        lane = delivery_lane(event)
+        key = (partition_keys or {}).get(event_id) or partition_key(event, payload)
+        job = jobs.setdefault(key if key is not None else (lane,), [lane, key, []])
+        if DELIVERY_LANES[lane] > DELIVERY_LANES[job[0]]:
+            job[0] = lane
+        job[2].append(item)
+
+    rejected = [
+        events for lane, key, events in jobs.values()
+        if not dispatcher.submit(events, key is not None, lane=lane, key=key)
+    ]
+    if not rejected:
+        return True
+
+    delivery_ids = [
+        (delivery_id,)
+        for events in rejected for *_, deliveries in events for delivery_id, _ in deliveries
+    ]
+    writer.submit(lambda conn: conn.executemany(
+        "UPDATE deliveries SET status = 'pending' WHERE id = ?",
+        delivery_ids
+    ))
+    return False
+
+# ============= EVENT HISTORY =============
+
+def query_events(conn, event_type=None, before_id=None, after_id=None, limit=50):
+    """
+    Страница истории событий по keyset-курсору
+
+    after_id задаёт чтение вперёд (id по возрастанию), иначе - назад
+    от before_id или от самого нового события (id по убыванию).
+    Сегменты читаются по очереди в том же порядке, пока не наберётся
+    limit событий; в каждом используется индекс (event_type, id).
+    """
+    if event_log:
+        events = event_log.read(event_type, before_id, after_id, limit)
+        counts = notified_counts(conn, [event['id'] for event in events])
+        for event in events:
+            event['notified_count'] = counts.get(event['id'], 0)
+        return events
+
+    conditions = []
+    params = []
+
+    if event_type:
+        conditions.append('event_type = ?')
+        params.append(event_type)
+    if before_id is not None:
+        conditions.append('id < ?')
+        params.append(before_id)
+    if after_id is not None:
+        conditions.append('id > ?')
+        params.append(after_id)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    order = 'ASC' if after_id is not None else 'DESC'
+
+    events = []
+    for table in segments.tables(before_id, after_id):
+        try:
+            cursor = conn.execute(f'''
+                SELECT * FROM {table}
+                {where}
+                ORDER BY id {order}
+                LIMIT ?
+            ''', params + [limit - len(events)])
+        except sqlite3.OperationalError as e:
+            if is_missing_table(e):
+                continue
+            raise
+
+        events.extend(row_to_event(row) for row in cursor.fetchall())
+        if len(events) >= limit:
+            break
+
+    return events
+
+def notified_counts(conn, event_ids):
+    """
+    {event_id: число доставленных} по outbox - notified_count для журнала
+
+    Один запрос по диапазону id страницы через индекс idx_deliveries_event
+    """
+    if not event_ids:
+        return {}
+    cursor = conn.execute('''
+        SELECT event_id, COUNT(*) FROM deliveries
+        WHERE event_id BETWEEN ? AND ? AND status = 'delivered'
+        GROUP BY event_id
+    ''', (min(event_ids), max(event_ids)))
+    return dict(cursor.fetchall())
+
+def row_to_event(row):
+    event = dict(row)
+    # Парсить payload
+    if event['payload']:
+        try:
+            event['payload'] = json.loads(event['payload'])
+        except:
+            pass
+    return event
+
+def stream_events(event_type, before_id, after_id, limit):
+    """NDJSON: по событию на строку, чтение страницами без накопления в памяти"""
+    conn = get_db()
+    sent = 0
+
+    try:
+        while not limit or sent < limit:
+            page_size = min(EVENTS_STREAM_PAGE, limit - sent) if limit else EVENTS_STREAM_PAGE
+            page = query_events(conn, event_type, before_id, after_id, page_size)
+            if not page:
+                break
+
+            yield ''.join(json.dumps(event, ensure_ascii=False) + '\n' for event in page)
+            sent += len(page)
+
+            if after_id is not None:
+                after_id = page[-1]['id']
+            else:
+                before_id = page[-1]['id']
+
+            if len(page) < page_size:
+                break
+    finally:
+        conn.close()
+
+def parse_timestamp(value):
+    """
+    Момент времени для replay: unix-время в секундах или ISO 8601
+    ("2026-10-18T12:00:00Z"); без часового пояса считается UTC.
+    Возвращает строку в формате published_at или ValueError
+    """
+    try:
+        seconds = float(value)
+    except ValueError:
+        moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if moment.tzinfo:
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+        return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+    # inf, nan и годы за пределами datetime - та же ошибка формата
+    try:
+        moment = datetime.utcfromtimestamp(seconds)
+    except (ValueError, OverflowError, OSError):
+        raise ValueError(f'timestamp {value} is out of range')
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+def event_id_at(conn, published_at):
+    """
+    Курсор replay для момента времени: id последнего события,
+    опубликованного раньше published_at
+
+    id выдаются писателем по порядку вместе с published_at, поэтому
+    внутри сегмента время не убывает и граница ищется двоичным
+    поиском по первичному ключу, без сканирования таблицы.
+    """
+    if event_log:
+        return event_log.id_at(calendar.timegm(time.strptime(published_at, '%Y-%m-%d %H:%M:%S')))
+
+    day = published_at[:10].replace('-', '')
+    snapshot = segments.current()
+    next_id = segments.last_id(conn) + 1
+
+    for index, (first_id, table, segment_day) in enumerate(snapshot):
+        # Сегменты прошлых суток целиком старше искомого момента
+        if segment_day < day:
+            continue
+
+        low = first_id
+        high = snapshot[index + 1][0] if index + 1 < len(snapshot) else next_id
+        while low < high:
+            middle = (low + high) // 2
+            row = conn.execute(
+                f'SELECT published_at FROM {table} WHERE id >= ? ORDER BY id LIMIT 1',
+                (middle,)
+            ).fetchone()
+            if row is None or row['published_at'] >= published_at:
+                high = middle
+            else:
+                low = middle + 1
+        return low - 1
+
+    return next_id - 1
+
+def replay_events(after_id, pattern, limit):
+    """
+    NDJSON-поток событий с id > after_id по возрастанию id
+
+    Страницы по REPLAY_PAGE событий читаются keyset-запросами по
+    первичному ключу (для точного типа - по индексу (event_type, id)).
+    Строка собирается из сохранённого JSON payload без разбора и
+    повторной сериализации. Шаблон с * и # проверяется trie в памяти.
+    Поток идёт до текущего конца журнала или до limit событий.
+    """
+    wildcard = any(segment in ('*', '#') for segment in pattern.split('.'))
+    matcher = None
+    if wildcard and pattern != '#':
+        matcher = TopicTrie(REPLAY_PAGE)
+        matcher.add(pattern, True)
+
+    if event_log:
+        yield from replay_log(after_id, None if wildcard else pattern, matcher, limit)
+        return
+
+    condition = '' if wildcard else 'event_type = ? AND'
+    params = [] if wildcard else [pattern]
+    names = {}
+    sent = 0
+
+    conn = get_db()
+    try:
+        while True:
+            read = False
+            for table in segments.tables(after_id=after_id):
+                while not limit or sent < limit:
+                    try:
+                        rows = conn.execute(f'''
+                            SELECT id, event_type, payload, published_at, notified_count
+                            FROM {table}
+                            WHERE {condition} id > ?
+                            ORDER BY id
+                            LIMIT ?
+                        ''', params + [after_id, REPLAY_PAGE]).fetchall()
+                    except sqlite3.OperationalError as e:
+                        if is_missing_table(e):
+                            break
+                        raise
+                    if not rows:
+                        break
+
+                    read = True
+                    after_id = rows[-1]['id']
+                    if matcher:
+                        rows = [row for row in rows if matcher.match(row['event_type'])]
+                    if limit:
+                        rows = rows[:limit - sent]
+                    sent += len(rows)
+
+                    lines = []
+                    for event_id, event_type, payload, published_at, notified_count in rows:
+                        name = names.get(event_type)
+                        if name is None:
+                            name = names[event_type] = json.dumps(event_type, ensure_ascii=False)
+                        lines.append(
+                            f'{{"id": {event_id}, "event_type": {name}, '
+                            f'"payload": {payload or "null"}, "published_at": "{published_at}", '
+                            f'"notified_count": {notified_count}}}\n'
+                        )
+                    if lines:
+                        yield ''.join(lines)
+
+            # Пока читали, мог появиться сегмент новых суток
+            if not read or (limit and sent >= limit):
+                return
+    finally:
+        conn.close()
+
+def replay_log(after_id, event_type, matcher, limit):
+    """replay_events для журнала: payload берётся из mmap без копирования"""
+    names = {}
+    stamps = {}
+    sent = 0
+    page = []
+
+    conn = get_db()
+    try:
+        for record in event_log.forward(after_id, event_type):
+            if matcher and not matcher.match(record[2]):
+                continue
+            page.append(record)
+            sent += 1
+            if len(page) < REPLAY_PAGE and sent != limit:
+                continue
+
+            yield replay_page(conn, page, names, stamps)
+            page = []
+            if sent == limit:
+                return
+
+        if page:
+            yield replay_page(conn, page, names, stamps)
+    finally:
+        conn.close()
+
+def replay_page(conn, page, names, stamps):
+    counts = notified_counts(conn, [record[0] for record in page])
+    line = b'{"id": %d, "event_type": %b, "payload": %b, "published_at": "%b", "notified_count": %d}\n'
+    chunks = []
+    for event_id, timestamp, event_type, payload in page:
+        name = names.get(event_type)
+        if name is None:
+            name = names[event_type] = json.dumps(event_type, ensure_ascii=False).encode()
+        stamp = stamps.get(int(timestamp))
+        if stamp is None:
+            stamp = stamps[int(timestamp)] = format_published_at(int(timestamp)).encode()
+        chunks.append(line % (event_id, name, payload or b'null', stamp, counts.get(event_id, 0)))
+    return b''.join(chunks)
+
+# ============= STREAMING =============
+
+class EventStream:
+    """
+    Один SSE-клиент: шаблон топика и ограниченный буфер событий
+
+    Если клиент читает медленнее, чем публикуются события, буфер
+    переполняется, поток помечается overflowed и закрывается -
+    клиент переподключается с Last-Event-ID и догоняет из истории.
+    """
+
+    def __init__(self, pattern, buffer_size):
+        self.pattern = pattern
+        self.queue = Queue(maxsize=buffer_size)
+        self.overflowed = False
+
+    def push(self, item):
+        if self.overflowed:
+            return False
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except Full:
+            self.overflowed = True
+            return False
+
+class StreamHub:
+    """Реестр SSE-потоков; рассылка через тот же trie шаблонов, что и подписки"""
+
+    def __init__(self, max_clients, buffer_size):
+        self.max_clients = max_clients
+        self.buffer_size = buffer_size
+        self.topics = TopicTrie(TOPIC_CACHE_SIZE)
+        self.lock = Lock()
+        self.clients = 0
+        self.overflows = 0
+
+    def open(self, pattern):
+        """Зарегистрировать поток или None, если клиентов слишком много"""
+        with self.lock:
+            if self.clients >= self.max_clients:
+                return None
+            self.clients += 1
+
+        stream = EventStream(pattern, self.buffer_size)
+        self.topics.add(pattern, stream)
+        return stream
+
+    def close(self, stream):
+        self.topics.remove(stream.pattern, stream)
+        with self.lock:
+            self.clients -= 1
+            if stream.overflowed:
+                self.overflows += 1
+
+    def broadcast(self, events):
+        """
+        Положить опубликованные события [(id, event, payload)] в буферы
+        подходящих потоков; вызывается писателем после COMMIT, по порядку id
+        """
+        if not self.clients:
+            return
+
+        for event_id, event, payload in events:
+            for stream in self.topics.match(event):
+                stream.push((event_id, event, payload))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'clients': self.clients,
+                'max_clients': self.max_clients,
+                'buffer_size': self.buffer_size,
+                'overflows': self.overflows
+            }
+
+streams = StreamHub(STREAM_MAX_CLIENTS, STREAM_BUFFER_SIZE)
+
+def sse_message(event_id, event, payload):
+    data = json.dumps({'id': event_id, 'event': event, 'payload': payload}, ensure_ascii=False)
+    return f'id: {event_id}\nevent: {event}\ndata: {data}\n\n'
+
+def sse_events(stream, last_event_id):
+    """
+    Тело SSE-ответа
+
+    Поток регистрируется до чтения истории, поэтому события,
+    опубликованные во время догоняния, не теряются. Из буфера
+    пропускаются только события, уже отданные историей (id не больше
+    её последнего id); остальные идут как есть, в порядке коммита.
+    """
+    pattern = stream.pattern
+    exact = '*' not in pattern and '#' not in pattern
+    matcher = TopicTrie(TOPIC_CACHE_SIZE)
+    matcher.add(pattern, True)
+
+    try:
+        yield 'retry: 1000\n\n'
+
+        # Догнать пропущенное из истории событий
+        last_id = last_event_id
+        if last_id is not None:
+            conn = get_db()
+            try:
+                while True:
+                    page = query_events(
+                        conn, pattern if exact else None,
+                        after_id=last_id, limit=EVENTS_STREAM_PAGE
+                    )
+                    if not page:
+                        break
+
+                    for event in page:
+                        if exact or matcher.match(event['event_type']):
+                            yield sse_message(event['id'], event['event_type'], event['payload'])
+                    last_id = page[-1]['id']
+
+                    if len(page) < EVENTS_STREAM_PAGE:
+                        break
+            finally:
+                conn.close()
+
+        # Живые события
+        while not stream.overflowed:
+            try:
+                event_id, event, payload = stream.queue.get(timeout=STREAM_KEEPALIVE)
+            except Empty:
+                yield ': keepalive\n\n'
+                continue
+
+            if last_id is not None and event_id <= last_id:
+                continue
+            yield sse_message(event_id, event, payload)
+
+        yield ': buffer overflow, reconnect with Last-Event-ID\n\n'
+    finally:
+        streams.close(stream)
+
+# ============= ENDPOINTS =============
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({
+        'status': 'healthy',
+        'service': 'message-bus',
+        'version': '1.0.0',
+        'port': PORT,
+        'active_subscriptions': subscriptions.current().count(),
+        'delivery': dispatcher.stats(),
+        'timestamp': datetime.now().isoformat()
+    })
+
+@app.route('/api/subscribe', methods=['POST'])
+def subscribe():
+    """
+    Подписаться на событие
+
+    event может быть шаблоном: "order.*" - один сегмент,
+    "product.#" - любое число сегментов
+
+    Body:
+    {
+      "event": "product.created",
+      "callback_url": "http://127.0.0.1:5003/events/product_created",
+      "service_id": "order-service" (опционально),
+      "batch": {"max_events": 100, "max_wait_ms": 200} (опционально),
+      "filter": "payload.category == 'Телефоны' and total > 100000" (опционально)
+    }
+
+    Вместо callback_url можно передать "socket_path": "/path/to/service.sock" -
+    события придут кадрами через Unix-сокет (см. LocalSocketPool), подписка
+    хранится с callback_url "unix:///path/to/service.sock".
+
+    batch включает пакетную доставку на callback_url: события приходят
+    JSON-массивом [{"id", "event", "payload"}, ...]. Опция относится
+    к callback_url целиком; "batch": null выключает её.
+
+    filter задаёт условие на payload для этой подписки (см. EventFilter);
+    события, которые ему не отвечают, не доставляются. Повторная подписка
+    с filter заменяет его, "filter": null снимает.
+    """
+    data = request.get_json()
+    callback_url = subscriber_address(data)
+
+    # Валидация
+    if not data.get('event') or not callback_url:
+        return jsonify({
+            'success': False,
+            'error': 'event and callback_url (or socket_path) are required'
+        }), 400
+
+    if callback_url.startswith(LOCAL_SCHEME) and not os.path.isabs(callback_url[len(LOCAL_SCHEME):]):
+        return jsonify({
+            'success': False,
+            'error': 'socket_path must be an absolute path'
+        }), 400
+
+    event = data['event']
+    service_id = data.get('service_id')
+
+    if not is_valid_pattern(event):
+        return jsonify({
+            'success': False,
+            'error': 'wildcards * and # must be whole segments, e.g. "order.*" or "product.#"'
+        }), 400
+
+    try:
+        batch = parse_batch_options(data.get('batch'))
+        source = data.get('filter')
+        if source is not None and not isinstance(source, str):
+            raise ValueError('filter must be a string expression')
+        event_filter = EventFilter(source) if source else None
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+
+    def save(conn):
+        created = conn.execute('''
+            INSERT OR IGNORE INTO subscriptions (event_type, callback_url, service_id, filter)
+            VALUES (?, ?, ?, ?)
+        ''', (event, callback_url, service_id, source or None)).rowcount == 1
+
+        if not created and 'filter' in data:
+            conn.execute(
+                'UPDATE subscriptions SET filter = ? WHERE event_type = ? AND callback_url = ?',
+                (source or None, event, callback_url)
+            )
+        if 'batch' in data:
+            conn.execute(
+                'UPDATE subscriptions SET batch = ? WHERE callback_url = ?',
+                (json.dumps(batch) if batch else None, callback_url)
+            )
+        return created
+
+    # БД и новый снимок подписок; остальные процессы увидят новую версию
+    if subscriptions.apply(save):
+        print(f"📥 New subscription: {event} → {callback_url}")
+
+    if event_filter:
+        print(f"🔎 Filter for {event} → {callback_url}: {source}")
+
+    if batch:
+        print(f"📦 Batch delivery for {callback_url}: {batch[0]} events / {batch[1]:g} ms")
+
+    snapshot = subscriptions.current()
+    event_filter = snapshot.filters.get((event, callback_url))
+    return jsonify({
+        'success': True,
+        'message': f'Subscribed to {event}',
+        'subscribers_count': len(snapshot.subscribers.get(event, ())),
+        'batch': batcher.get_options(callback_url),
+        'filter': event_filter.source if event_filter else None
+    })
+
+@app.route('/api/unsubscribe', methods=['POST'])
+def unsubscribe():
+    """
+    Отписаться от события
+
+    Body:
+    {
+      "event": "product.created",
+      "callback_url": "http://127.0.0.1:5003/events/product_created"
+    }
+
+    Для подписки через Unix-сокет вместо callback_url - "socket_path".
+    """
+    data = request.get_json()
+    event = data.get('event')
+    callback_url = subscriber_address(data)
+
+    # Последняя подписка callback_url уносит и его опцию batch: новый снимок
+    # выключит пакетный режим и закроет постоянные соединения с сокетом
+    removed = subscriptions.apply(lambda conn: conn.execute('''
+        DELETE FROM subscriptions
+        WHERE event_type = ? AND callback_url = ?
+    ''', (event, callback_url)).rowcount)
+
+    if removed:
+        print(f"📤 Unsubscribed: {event} → {callback_url}")
+
+    return jsonify({
+        'success': True,
+        'message': f'Unsubscribed from {event}'
+    })
+
+@app.route('/api/publish', methods=['POST'])
+def publish():
+    """
+    Опубликовать событие
+
+    Body:
+    {
+      "event": "product.created",
+      "payload": {
+        "product_id": 123,
+        "name": "iPhone 15 Pro",
+        "price": 119990
+      },
+      "service_id": "product-service" (опционально),
+      "idempotency_key": "product.created:123" (опционально),
+      "partition_key": "order-42" (опционально)
+    }
+
+    partition_key упорядочивает доставку: события с одним ключом приходят
+    каждому подписчику в порядке публикации. Без него ключ берётся из
+    payload по BUS_PARTITION_KEYS (по умолчанию order_id для order.#).
+
+    idempotency_key (или заголовок Idempotency-Key) делает повтор
+    публикации безопасным: событие с ключом, уже опубликованным за
+    последние BUS_IDEMPOTENCY_WINDOW секунд, не записывается и не
+    доставляется, ответ содержит "duplicate": true и id исходного события.
+
+    При перегрузке отвечает 429 с заголовком Retry-After.
+    """
+    data = request.get_json()
+
+    if not data.get('event'):
+        return jsonify({
+            'success': False,
+            'error': 'event is required'
+        }), 400
+
+    event = data['event']
+    payload = data.get('payload', {})
+
+    try:
+        key = idempotency_key(data)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+
+    rejected = admission.admit(producer_id(data), 1)
+    if rejected:
+        return overloaded(*rejected)
+
+    stored, [event_id] = store_keyed_events([(event, payload)], [key])
+
+    if not stored:
+        print(f"♻️ Duplicate publish of {event} (key {key}), event id={event_id}")
+        return jsonify({
+            'success': True,
+            'message': f'Event {event} already published',
+            'event_id': event_id,
+            'duplicate': True
+        })
+
+    [(_, _, _, deliveries)] = stored
+
+    # Передать рассылку пулу доставки (и SSE-потокам)
+    partition = data.get('partition_key')
+    dispatched = dispatch_events(stored, {event_id: str(partition)} if partition is not None else None)
+
+    if not deliveries:
+        print(f"📢 Event published: {event} (no subscribers)")
+        return jsonify({
+            'success': True,
+            'message': f'Event {event} published',
+            'event_id': event_id,
+            'notified': 0
+        })
+
+    if not dispatched:
+        print(f"⚠️ Delivery queue full, event {event} (id={event_id}) deferred")
+        return jsonify({
+            'success': True,
+            'message': f'Event {event} published',
+            'event_id': event_id,
+            'subscribers': len(deliveries),
+            'status': 'deferred'
+        })
+
+    print(f"📢 Event published: {event} (notifying {len(deliveries)} subscribers)")
+
+    return jsonify({
+        'success': True,
+        'message': f'Event {event} published',
+        'event_id': event_id,
+        'subscribers': len(deliveries),
+        'status': 'notifying'
+    })
+
+@app.route('/api/publish/batch', methods=['POST'])
+def publish_batch():
+    """
+    Опубликовать пачку событий одной транзакцией
+
+    Body:
+    {
+      "events": [
+        {"event": "order.created", "payload": {...}, "idempotency_key": "order.created:42"},
+        {"event": "product.created", "payload": {...}}
+      ]
+    }
+    (допускается и просто массив событий)
+
+    События с уже опубликованным idempotency_key пропускаются,
+    в event_ids для них - id исходных событий. У событий может быть
+    partition_key, как в /api/publish.
+
+    Пачка расходует по токену на событие; при перегрузке - 429.
+    """
+    data = request.get_json()
+    items = data.get('events') if isinstance(data, dict) else data
+
+    if not isinstance(items, list) or not items:
+        return jsonify({
+            'success': False,
+            'error': 'events must be a non-empty array'
+        }), 400
+
+    if len(items) > BATCH_MAX_EVENTS:
+        return jsonify({
+            'success': False,
+            'error': f'batch is limited to {BATCH_MAX_EVENTS} events'
+        }), 413
+
+    keys = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('event'):
+            return jsonify({
+                'success': False,
+                'error': f'events[{index}]: event is required'
+            }), 400
+        try:
+            keys.append(idempotency_key(item, index))
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+
+    rejected = admission.admit(producer_id(data), len(items))
+    if rejected:
+        return overloaded(*rejected)
 
-def init_db():
-    conn = get_db()
+    stored, event_ids = store_keyed_events([(item['event'], item.get('payload', {})) for item in items], keys)
+    subscribers_count = sum(len(deliveries) for *_, deliveries in stored)
+    duplicates = len(items) - len(stored)
 
-    # История событий
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            event_type TEXT NOT NULL,
-            payload TEXT,
-            published_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            notified_count INTEGER DEFAULT 0
-        )
-    ''')
+    status = 'notifying' if subscribers_count else 'published'
+    partition_keys = {
+        event_ids[index]: str(item['partition_key'])
+        for index, item in enumerate(items) if item.get('partition_key') is not None
+    }
+    if stored and not dispatch_events(stored, partition_keys):
+        status = 'deferred'
+        print(f"⚠️ Delivery queue full, batch of {len(stored)} events deferred")
 
-    # Подписки (для персистентности)
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            event_type TEXT NOT NULL,
-            callback_url TEXT NOT NULL,
-            service_id TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(event_type, callback_url)
-        )
-    ''')
+    print(f"📢 Batch published: {len(stored)} events (notifying {subscribers_count} subscribers)"
+          + (f", {duplicates} duplicates skipped" if duplicates else ''))
 
-    conn.commit()
-    conn.close()
+    return jsonify({
+        'success': True,
+        'message': f'{len(stored)} events published',
+        'event_ids': event_ids,
+        'duplicates': duplicates,
+        'subscribers': subscribers_count,
+        'status': status
+    })
 
-    # Загрузить подписки из БД в память
-    load_subscriptions()
+def negative_limit():
+    """Ответ 400: SQLite понял бы отрицательный LIMIT как «без ограничения»"""
+    return jsonify({
+        'success': False,
+        'error': 'limit must be a non-negative integer (0 - no limit)'
+    }), 400
 
-    print("✅ Message Bus database initialized")
+@app.route('/api/events', methods=['GET'])
+def get_events():
+    """
+    История событий
 
-def load_subscriptions():
-    """Загрузить подписки из БД при старте"""
-    conn = get_db()
-    cursor = conn.execute('SELECT event_type, callback_url FROM subscriptions')
+    Query params:
+    - event: фильтр по типу события
+    - limit: размер страницы (в NDJSON-режиме 0 - без ограничения)
+    - before_id: события старше курсора (по убыванию id)
+    - after_id: события новее курсора (по возрастанию id)
+    - format=ndjson: потоковая выдача, по событию на строку
+    """
+    event_type = request.args.get('event')
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
 
-    for row in cursor.fetchall():
-        event_type = row['event_type']
-        callback_url = row['callback_url']
+    if request.args.get('format') == 'ndjson':
+        limit = request.args.get('limit', 0, type=int)
+        if limit < 0:
+            return negative_limit()
+        return Response(
+            stream_with_context(stream_events(event_type, before_id, after_id, limit)),
+            mimetype='application/x-ndjson'
+        )
 
-        if callback_url not in subscribers[event_type]:
-            subscribers[event_type].append(callback_url)
+    limit = max(1, min(request.args.get('limit', 50, type=int), EVENTS_MAX_LIMIT))
 
+    conn = get_db()
+    events = query_events(conn, event_type, before_id, after_id, limit)
     conn.close()
 
-    total = sum(len(urls) for urls in subscribers.values())
-    print(f"📥 Loaded {total} subscriptions from database")
-
-# ============= ENDPOINTS =============
+    # Курсор следующей страницы в том же направлении
+    cursor = {}
+    if len(events) == limit and events:
+        if after_id is not None:
+            cursor['after_id'] = events[-1]['id']
+        else:
+            cursor['before_id'] = events[-1]['id']
 
-@app.route('/health', methods=['GET'])
-def health():
     return jsonify({
-        'status': 'healthy',
-        'service': 'message-bus',
-        'version': '1.0.0',
-        'port': 5999,
-        'active_subscriptions': sum(len(urls) for urls in subscribers.values()),
-        'timestamp': datetime.now().isoformat()
+        'success': True,
+        'events': events,
+        'total': len(events),
+        'next': cursor or None
     })
 
-@app.route('/api/subscribe', methods=['POST'])
-def subscribe():
+@app.route('/api/stream', methods=['GET'])
+def stream():
     """
-    Подписаться на событие
+    Server-Sent Events: живая подписка одним долгим соединением
 
-    Body:
-    {
-      "event": "product.created",
-      "callback_url": "http://127.0.0.1:5003/events/product_created",
-      "service_id": "order-service" (опционально)
-    }
+    Query params:
+    - event: тип события или шаблон ("order.*", "product.#"), по умолчанию все
+    - last_event_id: продолжить после этого id (или заголовок Last-Event-ID)
     """
-    data = request.get_json()
+    pattern = request.args.get('event', '#')
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
 
-    # Валидация
-    if not data.get('event') or not data.get('callback_url'):
+    if not is_valid_pattern(pattern):
         return jsonify({
             'success': False,
-            'error': 'event and callback_url are required'
+            'error': 'wildcards * and # must be whole segments, e.g. "order.*" or "product.#"'
         }), 400
 
-    event = data['event']
-    callback_url = data['callback_url']
-    service_id = data.get('service_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'error': 'Last-Event-ID must be an integer'
+        }), 400
 
-    # Добавить в память
-    if callback_url not in subscribers[event]:
-        subscribers[event].append(callback_url)
+    event_stream = streams.open(pattern)
+    if event_stream is None:
+        return jsonify({
+            'success': False,
+            'error': 'too many stream clients'
+        }), 503
 
-        # Сохранить в БД
-        conn = get_db()
-        try:
-            conn.execute('''
-                INSERT INTO subscriptions (event_type, callback_url, service_id)
-                VALUES (?, ?, ?)
-            ''', (event, callback_url, service_id))
-            conn.commit()
-        except sqlite3.IntegrityError:
-            # Уже существует
-            pass
-        conn.close()
+    return Response(
+        stream_with_context(sse_events(event_stream, last_event_id)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
-        print(f"📥 New subscription: {event} → {callback_url}")
+def consumer_group_info(row, last_id=None):
+    """Группа потребителей с отставанием от конца журнала"""
+    if last_id is None:
+        last_id = segments.last_id()
+    return {
+        'group': row['name'],
+        'event': row['event_type'],
+        'committed_id': row['committed_id'],
+        'last_event_id': last_id,
+        'lag': max(last_id - row['committed_id'], 0),
+        'updated_at': row['updated_at']
+    }
 
+def load_consumer_group(name):
+    conn = get_db()
+    row = conn.execute('SELECT * FROM consumer_groups WHERE name = ?', (name,)).fetchone()
+    conn.close()
+    return row
+
+def group_not_found(name):
     return jsonify({
-        'success': True,
-        'message': f'Subscribed to {event}',
-        'subscribers_count': len(subscribers[event])
-    })
+        'success': False,
+        'error': f'consumer group {name} not found'
+    }), 404
 
-@app.route('/api/unsubscribe', methods=['POST'])
-def unsubscribe():
+@app.route('/api/consumers', methods=['POST'])
+def create_consumer_group():
     """
-    Отписаться от события
+    Создать группу потребителей
 
     Body:
     {
-      "event": "product.created",
-      "callback_url": "http://127.0.0.1:5003/events/product_created"
+      "group": "inventory",
+      "event": "order.*" (опционально, по умолчанию все события),
+      "start": "latest" | "earliest" (опционально, по умолчанию latest),
+      "since": "2026-10-18T00:00:00Z" (опционально, вместо start)
     }
     """
-    data = request.get_json()
-    event = data.get('event')
-    callback_url = data.get('callback_url')
+    data = request.get_json() or {}
+    name = data.get('group')
+    pattern = data.get('event', '#')
+
+    if not name:
+        return jsonify({
+            'success': False,
+            'error': 'group is required'
+        }), 400
 
-    if event in subscribers and callback_url in subscribers[event]:
-        subscribers[event].remove(callback_url)
+    if not is_valid_pattern(pattern):
+        return jsonify({
+            'success': False,
+            'error': 'wildcards * and # must be whole segments, e.g. "order.*" or "product.#"'
+        }), 400
 
-        # Удалить из БД
+    if data.get('since') is not None:
+        try:
+            published_at = parse_timestamp(str(data['since']))
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'error': 'since must be unix time or ISO 8601'
+            }), 400
         conn = get_db()
-        conn.execute('''
-            DELETE FROM subscriptions
-            WHERE event_type = ? AND callback_url = ?
-        ''', (event, callback_url))
-        conn.commit()
+        committed_id = event_id_at(conn, published_at)
         conn.close()
+    elif data.get('start', 'latest') == 'earliest':
+        committed_id = 0
+    else:
+        committed_id = segments.last_id()
 
-        print(f"📤 Unsubscribed: {event} → {callback_url}")
+    try:
+        writer.execute(lambda conn: conn.execute('''
+            INSERT INTO consumer_groups (name, event_type, committed_id)
+            VALUES (?, ?, ?)
+        ''', (name, pattern, committed_id)))
+    except sqlite3.IntegrityError:
+        return jsonify({
+            'success': False,
+            'error': f'consumer group {name} already exists'
+        }), 409
+
+    print(f"👥 Consumer group created: {name} ({pattern}) at {committed_id}")
 
     return jsonify({
         'success': True,
-        'message': f'Unsubscribed from {event}'
+        'consumer': consumer_group_info(load_consumer_group(name))
     })
 
-@app.route('/api/publish', methods=['POST'])
-def publish():
+@app.route('/api/consumers', methods=['GET'])
+def get_consumer_groups():
+    """Группы потребителей с committed_id и отставанием"""
+    conn = get_db()
+    rows = conn.execute('SELECT * FROM consumer_groups ORDER BY name').fetchall()
+    last_id = segments.last_id(conn)
+    conn.close()
+
+    return jsonify({
+        'success': True,
+        'consumers': [consumer_group_info(row, last_id) for row in rows],
+        'total': len(rows)
+    })
+
+@app.route('/api/consumers/<name>', methods=['GET'])
+def get_consumer_group(name):
+    row = load_consumer_group(name)
+    if row is None:
+        return group_not_found(name)
+
+    return jsonify({
+        'success': True,
+        'consumer': consumer_group_info(row)
+    })
+
+@app.route('/api/consumers/<name>', methods=['DELETE'])
+def delete_consumer_group(name):
+    deleted = writer.execute(lambda conn: conn.execute(
+        'DELETE FROM consumer_groups WHERE name = ?', (name,)
+    ).rowcount)
+    if not deleted:
+        return group_not_found(name)
+
+    print(f"👥 Consumer group deleted: {name}")
+
+    return jsonify({
+        'success': True,
+        'message': f'Consumer group {name} deleted'
+    })
+
+@app.route('/api/consumers/<name>/commit', methods=['POST'])
+def commit_consumer_offset(name):
     """
-    Опубликовать событие
+    Зафиксировать смещение группы
 
     Body:
     {
-      "event": "product.created",
-      "payload": {
-        "product_id": 123,
-        "name": "iPhone 15 Pro",
-        "price": 119990
-      }
+      "offset": 12345  - id последнего обработанного события
     }
+    Меньшее значение перематывает группу назад.
     """
-    data = request.get_json()
+    data = request.get_json() or {}
+    offset = data.get('offset')
 
-    if not data.get('event'):
+    if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
         return jsonify({
             'success': False,
-            'error': 'event is required'
+            'error': 'offset must be a non-negative integer event id'
         }), 400
 
-    event = data['event']
-    payload = data.get('payload', {})
+    updated = writer.execute(lambda conn: conn.execute('''
+        UPDATE consumer_groups
+        SET committed_id = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE name = ?
+    ''', (offset, name)).rowcount)
+    if not updated:
+        return group_not_found(name)
 
-    # Сохранить событие в БД
-    conn = get_db()
-    cursor = conn.execute('''
-        INSERT INTO events (event_type, payload)
-        VALUES (?, ?)
-    ''', (event, json.dumps(payload)))
-    event_id = cursor.lastrowid
-    conn.commit()
+    return jsonify({
+        'success': True,
+        'consumer': consumer_group_info(load_consumer_group(name))
+    })
+
+@app.route('/api/replay', methods=['GET'])
+def replay():
+    """
+    Replay журнала событий в NDJSON, по возрастанию id
 
-    # Получить подписчиков
-    callback_urls = subscribers.get(event, [])
+    Query params (начало - одно из):
+    - group: с committed_id группы (и по её шаблону событий)
+    - from_id: с событий новее этого id
+    - since: с момента времени (unix-время или ISO 8601)
+    Дополнительно:
+    - event: тип события или шаблон (по умолчанию все / шаблон группы)
+    - limit: максимум событий (0 - до конца журнала)
 
-    if not callback_urls:
+    Заголовок X-Replay-After содержит id, после которого начат поток.
+    Смещение группы не двигается: потребитель фиксирует его сам
+    через POST /api/consumers/<group>/commit после обработки.
+    """
+    group = request.args.get('group')
+    pattern = request.args.get('event')
+    limit = request.args.get('limit', 0, type=int)
+    if limit < 0:
+        return negative_limit()
+
+    if group:
+        row = load_consumer_group(group)
+        if row is None:
+            return group_not_found(group)
+        after_id = row['committed_id']
+        pattern = pattern or row['event_type']
+    elif request.args.get('from_id') is not None:
+        after_id = request.args.get('from_id', type=int)
+        if after_id is None:
+            return jsonify({
+                'success': False,
+                'error': 'from_id must be an integer'
+            }), 400
+    elif request.args.get('since'):
+        try:
+            published_at = parse_timestamp(request.args['since'])
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'error': 'since must be unix time or ISO 8601'
+            }), 400
+        conn = get_db()
+        after_id = event_id_at(conn, published_at)
         conn.close()
-        print(f"📢 Event published: {event} (no subscribers)")
+    else:
         return jsonify({
-            'success': True,
-            'message': f'Event {event} published',
-            'notified': 0
-        })
+            'success': False,
+            'error': 'one of group, from_id or since is required'
+        }), 400
 
-    # Уведомить подписчиков асинхронно
-    def notify_subscribers():
-        notified = 0
+    pattern = pattern or '#'
+    if not is_valid_pattern(pattern):
+        return jsonify({
+            'success': False,
+            'error': 'wildcards * and # must be whole segments, e.g. "order.*" or "product.#"'
+        }), 400
 
-        for callback_url in callback_urls:
-            try:
-                response = requests.post(
-                    callback_url,
-                    json=payload,
-                    timeout=5
-                )
+    return Response(
+        stream_with_context(replay_events(after_id, pattern, limit)),
+        mimetype='application/x-ndjson',
+        headers={'X-Replay-After': str(after_id)}
+    )
 
-                if response.status_code == 200:
-                    notified += 1
-                    print(f"✅ Notified: {callback_url} about {event}")
-                else:
-                    print(f"⚠️ Failed to notify {callback_url}: HTTP {response.status_code}")
+@app.route('/api/dead-letters', methods=['GET'])
+def get_dead_letters():
+    """
+    Dead letters - доставки, исчерпавшие попытки, от новых к старым
 
-            except requests.exceptions.Timeout:
-                print(f"⏱️ Timeout notifying {callback_url}")
-            except Exception as e:
-                print(f"❌ Error notifying {callback_url}: {e}")
+    Query params:
+    - callback_url: только этого подписчика
+    - event: тип события или шаблон с * и #
+    - error: начало текста последней ошибки ("HTTP 5", "timeout")
+    - before_id: курсор - доставки с id меньше
+    - limit: размер страницы
+    """
+    try:
+        query = DeadLetterQuery.from_request(request.args)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
 
-        # Обновить счётчик уведомлённых
-        conn = get_db()
-        conn.execute(
-            'UPDATE events SET notified_count = ? WHERE id = ?',
-            (notified, event_id)
-        )
-        conn.commit()
-        conn.close()
+    limit = max(1, min(request.args.get('limit', 50, type=int), DEAD_LETTERS_PAGE))
+    cursor_id = request.args.get('before_id', type=int)
+
+    letters = []
+    conn = get_db()
+    while len(letters) < limit:
+        page, last_id = query.page(conn, cursor_id, limit, True)
+        if last_id is None:
+            break
+        cursor_id = last_id
+        letters.extend(dead_letter_info(row, event) for row, event in page)
+    conn.close()
 
-    # Запустить в фоне
-    thread = Thread(target=notify_subscribers)
-    thread.daemon = True
-    thread.start()
+    letters = letters[:limit]
+    return jsonify({
+        'success': True,
+        'dead_letters': letters,
+        'total': len(letters),
+        'next': {'before_id': letters[-1]['id']} if len(letters) == limit else None
+    })
+
+@app.route('/api/dead-letters/summary', methods=['GET'])
+def get_dead_letters_summary():
+    """Число dead letters по подписчикам и последним ошибкам"""
+    conn = get_db()
+    rows = conn.execute('''
+        SELECT callback_url, last_error, COUNT(*) as count, MAX(updated_at) as last_failed_at
+        FROM deliveries
+        WHERE status = 'failed'
+        GROUP BY callback_url, last_error
+        ORDER BY count DESC
+    ''').fetchall()
+    conn.close()
+
+    return jsonify({
+        'success': True,
+        'summary': [dict(row) for row in rows],
+        'total': sum(row['count'] for row in rows)
+    })
 
+@app.route('/api/dead-letters/<int:delivery_id>', methods=['GET'])
+def get_dead_letter(delivery_id):
+    """Dead letter с payload события и состоянием автомата подписчика"""
+    conn = get_db()
+    letters, _ = DeadLetterQuery(ids=[delivery_id]).page(conn, None, 1, True)
     conn.close()
 
-    print(f"📢 Event published: {event} (notifying {len(callback_urls)} subscribers)")
+    if not letters:
+        return jsonify({
+            'success': False,
+            'error': f'dead letter {delivery_id} not found'
+        }), 404
 
+    row, event = letters[0]
     return jsonify({
         'success': True,
-        'message': f'Event {event} published',
-        'subscribers': len(callback_urls),
-        'status': 'notifying'
+        'dead_letter': dict(
+            dead_letter_info(row, event, with_payload=True),
+            circuit=breakers.snapshot(row['callback_url'])
+        )
     })
 
-@app.route('/api/events', methods=['GET'])
-def get_events():
-    """История событий"""
-    limit = request.args.get('limit', 50, type=int)
-    event_type = request.args.get('event')
+@app.route('/api/dead-letters/redrive', methods=['POST'])
+def start_redrive():
+    """
+    Вернуть dead letters в доставку фоновым заданием
 
-    conn = get_db()
+    Body (все поля опциональны, без фильтров - все dead letters):
+    {
+      "callback_url": "http://127.0.0.1:5001/events/order_created",
+      "event": "order.*",
+      "error": "HTTP 5",
+      "ids": [101, 102],
+      "rate": 200,      - строк в секунду (по умолчанию BUS_REDRIVE_RATE)
+      "limit": 10000    - не больше стольких доставок
+    }
 
-    if event_type:
-        cursor = conn.execute('''
-            SELECT * FROM events
-            WHERE event_type = ?
-            ORDER BY published_at DESC
-            LIMIT ?
-        ''', (event_type, limit))
-    else:
-        cursor = conn.execute('''
-            SELECT * FROM events
-            ORDER BY published_at DESC
-            LIMIT ?
-        ''', (limit,))
+    Отвечает 202 с заданием; ход - GET /api/dead-letters/redrive/<job_id>.
+    """
+    data = request.get_json(silent=True) or {}
 
-    events = []
-    for row in cursor.fetchall():
-        event = dict(row)
-        # Парсить payload
-        if event['payload']:
-            try:
-                event['payload'] = json.loads(event['payload'])
-            except:
-                pass
-        events.append(event)
+    try:
+        query = DeadLetterQuery.from_request(data)
+        rate = data.get('rate', REDRIVE_DEFAULT_RATE)
+        limit = data.get('limit') or 0
+        if not isinstance(rate, (int, float)) or isinstance(rate, bool) or not 0 < rate <= REDRIVE_MAX_RATE:
+            raise ValueError(f'rate must be 0..{REDRIVE_MAX_RATE:g} deliveries per second')
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit < 0:
+            raise ValueError('limit must be a non-negative integer')
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
 
-    conn.close()
+    try:
+        job = redrive.start(query, float(rate), limit)
+    except RuntimeError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 409
 
     return jsonify({
         'success': True,
-        'events': events,
-        'total': len(events)
+        'job': job.info()
+    }), 202
+
+@app.route('/api/dead-letters/redrive', methods=['GET'])
+def get_redrive_jobs():
+    jobs = redrive.list()
+    return jsonify({
+        'success': True,
+        'jobs': jobs,
+        'total': len(jobs)
+    })
+
+@app.route('/api/dead-letters/redrive/<int:job_id>', methods=['GET'])
+def get_redrive_job(job_id):
+    job = redrive.get(job_id)
+    if job is None:
+        return redrive_job_not_found(job_id)
+
+    return jsonify({
+        'success': True,
+        'job': job.info()
     })
 
+@app.route('/api/dead-letters/redrive/<int:job_id>', methods=['DELETE'])
+def cancel_redrive_job(job_id):
+    """Остановить задание; уже возвращённые в outbox доставки остаются там"""
+    job = redrive.cancel(job_id)
+    if job is None:
+        return redrive_job_not_found(job_id)
+
+    return jsonify({
+        'success': True,
+        'job': job.info()
+    })
+
+def redrive_job_not_found(job_id):
+    return jsonify({
+        'success': False,
+        'error': f'redrive job {job_id} not found'
+    }), 404
+
+def subscription_filter(snapshot, event, callback_url):
+    """Выражение фильтра подписки и сколько событий он пропустил"""
+    event_filter = snapshot.filters.get((event, callback_url))
+    if event_filter is None:
+        return None
+    return dict(event_filter.stats(), expression=event_filter.source)
+
+def parked_deliveries():
+    """{callback_url: число доставок в backlog разомкнутого автомата}"""
+    conn = get_db()
+    cursor = conn.execute('''
+        SELECT callback_url, COUNT(*) as count
+        FROM deliveries
+        WHERE status = 'pending' AND last_error = ?
+        GROUP BY callback_url
+    ''', (CIRCUIT_OPEN,))
+    parked = {row['callback_url']: row['count'] for row in cursor.fetchall()}
+    conn.close()
+    return parked
+
 @app.route('/api/subscriptions', methods=['GET'])
 def get_subscriptions():
-    """Список всех подписок"""
+    """Список всех подписок с состоянием circuit breaker подписчиков"""
     event_type = request.args.get('event')
+    parked = parked_deliveries()
+    snapshot = subscriptions.current()
+
+    def circuit(url):
+        return dict(breakers.snapshot(url), parked=parked.get(url, 0))
 
     if event_type:
-        urls = subscribers.get(event_type, [])
+        urls = list(snapshot.subscribers.get(event_type, ()))
         return jsonify({
             'success': True,
             'event': event_type,
             'subscribers': urls,
+            'circuits': {url: circuit(url) for url in urls},
             'count': len(urls)
         })
 
     # Все подписки
     all_subs = []
-    for event, urls in subscribers.items():
+    for event, urls in snapshot.subscribers.items():
         for url in urls:
             all_subs.append({
                 'event': event,
-                'callback_url': url
+                'callback_url': url,
+                'batch': batcher.get_options(url),
+                'filter': subscription_filter(snapshot, event, url),
+                'circuit': circuit(url)
             })
 
     return jsonify({
@@ -347,42 +5452,57 @@ def get_subscriptions():
         'total': len(all_subs)
     })
 
+@app.route('/api/stats/deliveries', methods=['GET'])
+def get_delivery_stats():
+    """
+    Метрики доставки по подписчикам: p50/p95/p99 задержки,
+    успехи/ошибки/таймауты и запросы в полёте.
+    Самые медленные (по p99) подписчики идут первыми.
+    """
+    snapshot = delivery_metrics.snapshot()
+    subscribers_stats = sorted(
+        ({'callback_url': callback_url, **metrics} for callback_url, metrics in snapshot.items()),
+        key=lambda item: -item['latency_ms']['p99']
+    )
+
+    return jsonify({
+        'success': True,
+        'subscribers': subscribers_stats,
+        'total': len(subscribers_stats)
+    })
+
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
     """Статистика Message Bus"""
-    conn = get_db()
-
-    # Всего событий
-    cursor = conn.execute('SELECT COUNT(*) as total FROM events')
-    total_events = cursor.fetchone()['total']
-
-    # События за последний час
-    cursor = conn.execute('''
-        SELECT COUNT(*) as count FROM events
-        WHERE published_at >= datetime('now', '-1 hour')
-    ''')
-    events_last_hour = cursor.fetchone()['count']
-
-    # Топ событий
-    cursor = conn.execute('''
-        SELECT event_type, COUNT(*) as count
-        FROM events
-        GROUP BY event_type
-        ORDER BY count DESC
-        LIMIT 10
-    ''')
-    top_events = [dict(row) for row in cursor.fetchall()]
-
-    conn.close()
+    # Счётчики в памяти - без сканирования сегментов истории
+    total_events, events_last_hour, top = counters.snapshot()
+    top_events = [{'event_type': event_type, 'count': count} for event_type, count in top]
+    snapshot = subscriptions.current()
 
     return jsonify({
         'success': True,
         'stats': {
             'total_events': total_events,
             'events_last_hour': events_last_hour,
-            'total_subscriptions': sum(len(urls) for urls in subscribers.values()),
-            'unique_events': len(subscribers),
-            'top_events': top_events
+            'total_subscriptions': snapshot.count(),
+            'unique_events': len(snapshot.subscribers),
+            'subscriptions': subscriptions.stats(),
+            'top_events': top_events,
+            'delivery': dispatcher.stats(),
+            'fanout': fanout.stats(),
+            'batching': batcher.stats(),
+            'circuits': breakers.stats(),
+            'admission': admission.stats(),
+            'idempotency': idempotency.stats(),
+            'outbox': redelivery.stats(),
+            'redrive': redrive.stats(),
+            'http': http_pool.stats(),
+            'local': local_pool.stats(),
+            'retention': retention.stats(),
+            'streams': streams.stats(),
+            'writer': writer.stats(),
+            'counters': counters.stats(),
+            'storage': event_log.stats() if event_log else {'backend': 'sqlite'}
         }
     })
 
@@ -396,14 +5516,32 @@ if __name__ == '__main__':
 
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
     init_db()
+    writer.start()
+    dispatcher.start()
+    retry_dispatcher.start()
+    redelivery.start()
+    retention.start()
+    counters.start()
+    batcher.start()
+    idempotency.start()
+    print(f"📬 Delivery pool: {DELIVERY_WORKERS} workers, queue size {DELIVERY_QUEUE_SIZE} per lane, "
+          f"{DELIVERY_QUEUE_TOTAL} total")
+    print(f"📡 Fan-out: {FANOUT_MAX_IN_FLIGHT} in flight, {FANOUT_PER_SUBSCRIBER} per subscriber")
 
-    print("🌐 Server running on http://127.0.0.1:5999")
+    print(f"🌐 Server running on http://127.0.0.1:{PORT}")
     print("📝 Endpoints:")
     print("   POST /api/subscribe    - Подписаться на событие")
     print("   POST /api/unsubscribe  - Отписаться")
     print("   POST /api/publish      - Опубликовать событие")
+    print("   POST /api/publish/batch - Опубликовать пачку событий")
     print("   GET  /api/events       - История событий")
+    print("   GET  /api/stream       - SSE-поток событий")
+    print("   GET  /api/replay       - Replay журнала (NDJSON)")
+    print("   POST /api/consumers    - Создать группу потребителей")
+    print("   GET  /api/dead-letters - Недоставленные события")
+    print("   POST /api/dead-letters/redrive - Повторная отправка dead letters")
     print("   GET  /api/subscriptions - Список подписок")
+    print("   GET  /api/stats/deliveries - Задержки доставки по подписчикам")
     print("=" * 50)
 
-    app.run(host='0.0.0.0', port=5999, debug=False)
+    app.run(host='0.0.0.0', port=PORT, debug=False)
@@ -8,10 +8,12 @@ Service Registry - Центральный реестр всех микросер
 - Предоставление списка активных сервисов Flutter приложению
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response
 import sqlite3
 import os
+import uuid
 from datetime import datetime
+from threading import Lock
 import json
 
 app = Flask(__name__)
@@ -63,6 +65,77 @@ def init_db():
     conn.close()
     print("✅ Registry database initialized")
 
+# ============= SERVICES CACHE =============
+
+class ServicesCache:
+    """
+    Готовые ответы GET /api/services
+
+    Flutter hub опрашивает список по таймеру, а меняется он только при
+    регистрации, удалении сервиса и обновлении health check. Каждое такое
+    изменение увеличивает version и сбрасывает тела; тело для пары
+    (status, category) строится из БД один раз на версию и отдаётся
+    уже сериализованным.
+
+    ETag - идентификатор запуска и версия: клиент с актуальным
+    If-None-Match получает 304 без обращения к БД. Изменения, внесённые
+    в registry.db в обход API, кэш не видит.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.boot = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.bodies = {}
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def fresh(self, if_none_match):
+        """ETag, если у клиента актуальная версия списка, иначе None"""
+        with self.lock:
+            etag = f'{self.boot}-{self.version}'
+            if if_none_match.contains_weak(etag):
+                self.not_modified += 1
+                return etag
+        return None
+
+    def bump(self):
+        """Список изменился (вызывать после commit)"""
+        with self.lock:
+            self.version += 1
+            self.bodies.clear()
+
+    def get(self, key, build):
+        """(body, etag) для фильтра key; build() читает БД при промахе"""
+        with self.lock:
+            version = self.version
+            body = self.bodies.get(key)
+            if body is not None:
+                self.hits += 1
+                return body, f'{self.boot}-{version}'
+            self.misses += 1
+
+        body = build()
+
+        # Список мог измениться во время чтения - такое тело не кэшируем
+        with self.lock:
+            if self.version == version:
+                self.bodies[key] = body
+        return body, f'{self.boot}-{version}'
+
+    def stats(self):
+        with self.lock:
+            return {
+                'version': self.version,
+                'cached_bodies': len(self.bodies),
+                'hits': self.hits,
+                'misses': self.misses,
+                'not_modified': self.not_modified
+            }
+
+services_cache = ServicesCache()
+
 # ============= ENDPOINTS =============
 
 @app.route('/health', methods=['GET'])
@@ -84,10 +157,30 @@ def get_services():
     Query params:
     - status: active/inactive (фильтр по статусу)
     - category: фильтр по категории
+
+    Ответ отдаётся с ETag; при совпадающем If-None-Match - 304 без тела
     """
     status = request.args.get('status', 'active')
     category = request.args.get('category')
 
+    etag = services_cache.fresh(request.if_none_match)
+    if etag:
+        return not_modified(etag)
+
+    body, etag = services_cache.get((status, category), lambda: build_services(status, category))
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def build_services(status, category):
+    """Сериализованный ответ /api/services из БД"""
     conn = get_db()
     query = 'SELECT * FROM services WHERE status = ?'
     params = [status]
@@ -113,7 +206,7 @@ def get_services():
 
     conn.close()
 
-    return jsonify({
+    return json.dumps({
         'success': True,
         'services': services,
         'total': len(services),
@@ -206,6 +299,7 @@ def register_service():
 
         conn.commit()
         conn.close()
+        services_cache.bump()
 
         print(f"✅ Service registered: {data['id']} ({data['name']}) on port {data['port']}")
 
@@ -249,6 +343,7 @@ def unregister_service(service_id):
 
     conn.commit()
     conn.close()
+    services_cache.bump()
 
     print(f"❌ Service unregistered: {service_id}")
 
@@ -264,13 +359,17 @@ def update_health(service_id):
     Вызывается самим сервисом или health check скриптом
     """
     conn = get_db()
-    conn.execute(
+    cursor = conn.execute(
         'UPDATE services SET last_health_check = CURRENT_TIMESTAMP WHERE id = ?',
         (service_id,)
     )
     conn.commit()
     conn.close()
 
+    # last_health_check входит в ответ /api/services
+    if cursor.rowcount:
+        services_cache.bump()
+
     return jsonify({'success': True})
 
 @app.route('/api/categories', methods=['GET'])
@@ -338,7 +437,8 @@ def get_stats():
             'total_services': total,
             'active_services': active,
             'inactive_services': total - active,
-            'by_category': by_category
+            'by_category': by_category,
+            'services_cache': services_cache.stats()
         }
     })
 
@@ -16,6 +16,16 @@ import os
 from datetime import datetime
 import requests
 import json
+import socket
+import sys
+
+# Клиент локальной доставки событий лежит рядом с Message Bus
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'infrastructure', 'message-bus'))
+try:
+    from bus_client import LocalSubscriber
+except ImportError:
+    LocalSubscriber = None
 
 app = Flask(__name__)
 
@@ -26,6 +36,11 @@ DB_PATH = os.path.expanduser('~/termux-backend/data/products.db')
 REGISTRY_URL = 'http://127.0.0.1:5000'
 MESSAGE_BUS_URL = 'http://127.0.0.1:5999'
 
+# События от Message Bus через Unix-сокет (без HTTP); '0' - по HTTP callback
+EVENTS_SOCKET = os.path.expanduser('~/termux-backend/run/product-service.sock')
+LOCAL_EVENTS = os.environ.get('PRODUCT_LOCAL_EVENTS', '1') == '1'
+ORDER_CREATED_CALLBACK = f'http://127.0.0.1:{SERVICE_PORT}/events/order_created'
+
 # ============= DATABASE =============
 
 def get_db():
@@ -126,17 +141,45 @@ def register_in_registry():
 
 def subscribe_to_events():
     """Подписаться на события из Message Bus"""
+    if LOCAL_EVENTS and LocalSubscriber and hasattr(socket, 'AF_UNIX'):
+        try:
+            subscribe_local()
+            return
+        except Exception as e:
+            print(f"⚠️ Local event socket unavailable, falling back to HTTP: {e}")
+
     try:
         # Подписаться на order.created (чтобы уменьшать stock)
         requests.post(f'{MESSAGE_BUS_URL}/api/subscribe', json={
             'event': 'order.created',
-            'callback_url': f'http://127.0.0.1:{SERVICE_PORT}/events/order_created',
+            'callback_url': ORDER_CREATED_CALLBACK,
             'service_id': SERVICE_ID
         })
         print("✅ Subscribed to order.created event")
     except Exception as e:
         print(f"⚠️ Could not subscribe to events: {e}")
 
+def subscribe_local():
+    """Получать order.created через Unix-сокет вместо HTTP callback"""
+    subscriber = LocalSubscriber(EVENTS_SOCKET, on_local_event)
+    subscriber.start()
+    subscriber.subscribe(MESSAGE_BUS_URL, 'order.created', service_id=SERVICE_ID)
+
+    print(f"✅ Subscribed to order.created event via {EVENTS_SOCKET}")
+
+    # Подписка по HTTP от прошлых запусков дала бы повторное списание остатков
+    try:
+        requests.post(f'{MESSAGE_BUS_URL}/api/unsubscribe', json={
+            'event': 'order.created',
+            'callback_url': ORDER_CREATED_CALLBACK
+        }, timeout=5)
+    except Exception as e:
+        print(f"⚠️ Could not remove HTTP subscription: {e}")
+
+def on_local_event(event, payload):
+    if event == 'order.created':
+        decrease_stock(payload)
+
 # ============= ENDPOINTS =============
 
 @app.route('/health', methods=['GET'])
@@ -254,7 +297,9 @@ def create_product():
                 'name': data['name'],
                 'price': data['price'],
                 'category': data.get('category')
-            }
+            },
+            # Повтор публикации после таймаута не создаст второе событие
+            'idempotency_key': f'product.created:{product_id}'
         })
     except:
         pass
@@ -354,8 +399,12 @@ def on_order_created():
     Обработчик события order.created
     Уменьшает stock когда создан заказ
     """
-    event = request.get_json()
+    decrease_stock(request.get_json())
 
+    return jsonify({'success': True})
+
+def decrease_stock(event):
+    """Списать остатки по заказу из события order.created"""
     # event содержит: order_id, items: [{product_id, quantity}]
     items = event.get('items', [])
 
@@ -377,8 +426,6 @@ def on_order_created():
 
     print(f"📦 Stock decreased for order {event.get('order_id')}")
 
-    return jsonify({'success': True})
-
 # ============= MAIN =============
 
 if __name__ == '__main__':